@@ -108,3 +108,8 @@ def test_session(test_engine, request):
     request.addfinalizer(fin)
 
     return session
+
+
+@pytest.fixture(scope="session")
+def zeta_fname(data_dir):
+    return os.path.join(data_dir, 'knox_long_recombination_zeta.dat')
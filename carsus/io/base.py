@@ -1,10 +1,36 @@
 """This module defines base classes for parsers and ingesters."""
 
+import hashlib
+import threading
+import numpy as np
 import pandas as pd
 
 from util import to_flat_dict
+from itertools import chain
 from abc import ABCMeta, abstractmethod
-from carsus.model import DataSource
+from sqlalchemy import inspect, func, select, and_
+from sqlalchemy.orm.interfaces import ONETOMANY
+from astropy.units import set_enabled_equivalencies
+from carsus.model import DataSource, Level, LevelQuantity, Transition, Line, LineQuantity, \
+    ECollision, ECollisionQuantity, ECollisionTempStrength, IngestCheckpoint
+from carsus.util import convert_atomic_number2symbol
+
+# Compatibility with Python 2, where the module is called Queue:
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+# pandas < 0.20 does not have hash_pandas_object, `hash_content` hashes the values then
+try:
+    from pandas.util import hash_pandas_object
+except ImportError:
+    hash_pandas_object = None
+
+
+BULK_BATCHSIZE = 10000  # rows sent to the database in one executemany call
+
+PREFETCH_QUEUE_SIZE = 2  # items prepared ahead by the producer of `iter_prefetched`
 
 
 class ParserError(ValueError):
@@ -110,6 +136,636 @@ class IngesterError(ValueError):
     pass
 
 
+def to_model_unit(model, quantity):
+    """
+    Convert a quantity to the values stored in the `_value` column of a quantity model
+
+    Parameters
+    ----------
+    model : QuantityMixin subclass
+    quantity : astropy.units.Quantity or array_like
+        Plain numbers are taken to be in the unit of the model
+
+    Returns
+    -------
+    numpy.ndarray
+    """
+    if not hasattr(quantity, 'unit'):
+        return np.asarray(quantity)
+    with set_enabled_equivalencies(model.equivalencies):
+        return np.asarray(quantity.to(model.unit).value)
+
+
+def iter_prefetched(iterable, maxsize=PREFETCH_QUEUE_SIZE):
+    """
+    Iterate over `iterable` while a background thread prepares the next items
+
+    The thread puts the items into a queue that holds at most `maxsize` of
+    them. Preparing the next items (e.g. reading and parsing the data of an ion)
+    thus overlaps with processing the current one (e.g. writing it to the
+    database), while memory usage stays bounded. An exception raised by the
+    producer is raised again in the consumer.
+
+    Parameters
+    ----------
+    iterable : iterable
+        Must not use the database session of the consumer
+    maxsize : int
+        Maximum number of items waiting in the queue
+        (default: PREFETCH_QUEUE_SIZE)
+    """
+    items = queue.Queue(maxsize)
+    stop = threading.Event()
+    done = object()
+
+    def put(entry):
+        # Give up when the consumer has stopped iterating
+        while not stop.is_set():
+            try:
+                items.put(entry, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    return
+        except Exception as e:
+            put((done, e))
+        else:
+            put((done, None))
+
+    producer = threading.Thread(target=produce)
+    producer.daemon = True
+    producer.start()
+    try:
+        while True:
+            item, error = items.get()
+            if item is done:
+                if error is not None:
+                    raise error
+                break
+            yield item
+    finally:
+        stop.set()
+        producer.join()
+
+
+class SessionBatcher(object):
+    """
+    Keeps the memory usage of an ingest flat by releasing the ingested objects.
+
+    The ingesters add the objects they create to the session with `add` and
+    call `release` when they have finished an ion. If `batch_size` or `commit`
+    is given, the session is flushed, optionally committed, and the objects
+    added with `add` (together with the objects in their one-to-many
+    collections, like the energies of a level) are expunged every
+    `batch_size` objects and on `release`. Other objects in the session are
+    left alone; the objects in the unique cache of the session (data sources,
+    ions, temperatures) are expired, so that they do not hold on to the
+    objects appended to their collections. Otherwise the session is left
+    untouched.
+
+    Parameters
+    ----------
+    session : SQLAlchemy session
+    batch_size : int
+        Number of objects after which the session is released
+        (default: None, only when an ion is finished)
+    commit : bool
+        Commit the session every time it is released (default: False)
+
+    Methods
+    -------
+    add(obj)
+        Add an object to the session and release the session when a batch is full
+    release()
+        Flush (and commit) the session and expunge the added objects
+    """
+
+    def __init__(self, session, batch_size=None, commit=False):
+        if batch_size is not None and batch_size < 1:
+            raise ValueError("batch_size must be a positive integer, not {}".format(batch_size))
+        self.session = session
+        self.batch_size = batch_size
+        self.commit = commit
+        self.objects = list()
+
+    @property
+    def enabled(self):
+        return self.batch_size is not None or self.commit
+
+    def add(self, obj):
+        self.session.add(obj)
+        if not self.enabled:
+            return
+        self.objects.append(obj)
+        if self.batch_size is not None and len(self.objects) >= self.batch_size:
+            self.release()
+
+    def release(self):
+        if not self.enabled:
+            return
+
+        # Collected before the commit expires the collections
+        added_objects = [owned for obj in self.objects for owned in _iter_owned_objects(obj)]
+
+        self.session.flush()
+        if self.commit:
+            self.session.commit()
+
+        for obj in added_objects:
+            if obj in self.session:
+                self.session.expunge(obj)
+        for obj in self.session.info.get('unique_cache', {}).values():
+            if obj in self.session:
+                self.session.expire(obj)
+        self.objects = list()
+
+
+def _iter_owned_objects(obj):
+    """ Yield `obj` and the objects in its loaded one-to-many collections, recursively """
+    yield obj
+    state = inspect(obj)
+    for relationship in state.mapper.relationships:
+        if relationship.direction is not ONETOMANY or relationship.key not in state.dict:
+            continue
+        children = state.dict[relationship.key]
+        if not relationship.uselist:
+            children = [children] if children is not None else []
+        for child in children:
+            for owned in _iter_owned_objects(child):
+                yield owned
+
+
+def _hash_values(md5_hash, values):
+    """ Add the values of an index or a column to `md5_hash` """
+    if hash_pandas_object is not None:
+        try:
+            md5_hash.update(hash_pandas_object(values, index=False).values.data)
+            return
+        except TypeError:
+            pass
+    values = np.asarray(values)
+    if values.dtype != object:
+        md5_hash.update(np.ascontiguousarray(values).tobytes())
+    else:
+        for value in values:
+            md5_hash.update(np.asarray(value).tobytes())
+
+
+def hash_content(data):
+    """
+    Return the MD5 hash of a DataFrame (None for missing data)
+
+    Columns of arrays, like the temperatures of collisions, are hashed value by value.
+    """
+    md5_hash = hashlib.md5()
+    if data is not None:
+        _hash_values(md5_hash, data.index)
+        for name, column in data.iteritems():
+            md5_hash.update(str(name).encode())
+            _hash_values(md5_hash, column)
+    return md5_hash.hexdigest()
+
+
+class IonCheckpoints(object):
+    """
+    Per-ion checkpoints of an ingest from a data source.
+
+    A checkpoint (an `IngestCheckpoint` row) records that a stage ("levels",
+    "lines", "collisions") of an ion has been ingested, together with the
+    hash of the ingested data (see `hash_content`). `mark` adds it to the
+    session, so it is committed together with the data of the ion and an ion
+    is either completely ingested and checkpointed or not at all.
+
+    A resumed ingest skips the stages that have a checkpoint. An update
+    (`replace=True`) also removes and ingests again the stages whose data has
+    changed, and `remove_missing` removes the ions that are no longer in the
+    data source. The changed ions are collected in `added`, `modified`
+    and `removed`.
+
+    Replacing the levels of an ion removes its lines and collisions, which
+    refer to them, so these have to be ingested again in the same update.
+
+    Parameters
+    ----------
+    session : SQLAlchemy session
+    data_source : DataSource instance
+    stages : list of str
+        The stages that are ingested. Replacing the levels of an ion raises
+        an IngesterError if it has other checkpointed stages that are not
+        in the list (default: None, all stages are ingested)
+
+    Methods
+    -------
+    is_done(atomic_number, ion_charge, stage)
+        Return True if the stage of the ion has a checkpoint
+    needs_ingest(atomic_number, ion_charge, stage, content_hash=None, replace=False)
+        Return True if the stage of the ion has to be ingested
+    mark(atomic_number, ion_charge, stage, content_hash=None)
+        Add the checkpoint of the stage of the ion to the session
+    remove(atomic_number, ion_charge, stage)
+        Delete the data of the stage of the ion and its checkpoint
+    remove_missing(selected_ions=None)
+        Remove the ions that have a checkpoint but have not been ingested again
+    summary()
+        Return a summary of the added, modified and removed ions
+    """
+
+    def __init__(self, session, data_source, stages=None):
+        self.session = session
+        self.data_source = data_source
+        self.stages = stages
+        session.flush()
+
+        q_checkpoints = session.query(IngestCheckpoint.atomic_number, IngestCheckpoint.ion_charge,
+                                      IngestCheckpoint.stage, IngestCheckpoint.content_hash).\
+            filter(IngestCheckpoint.data_source == data_source)
+        self.content_hashes = dict(((atomic_number, ion_charge, stage), content_hash)
+                                   for atomic_number, ion_charge, stage, content_hash in q_checkpoints)
+        self.checkpointed_ions = set(key[:2] for key in self.content_hashes)
+
+        # Ions that already have levels from this data source, e.g. from an ingest without checkpoints
+        q_ions = session.query(Level.atomic_number, Level.ion_charge).\
+            filter(Level.data_source == data_source).distinct()
+        self.ions_with_levels = set(tuple(row) for row in q_ions)
+
+        self.seen = set()
+        self.added = set()
+        self.modified = set()
+        self.removed = set()
+
+    def is_done(self, atomic_number, ion_charge, stage):
+        return (int(atomic_number), int(ion_charge), stage) in self.content_hashes
+
+    def needs_ingest(self, atomic_number, ion_charge, stage, content_hash=None, replace=False):
+        """
+        Return True if the stage of the ion has to be ingested
+
+        A stage that has a checkpoint is skipped, unless `replace` is True and
+        its content hash differs, in which case the old data is removed first.
+        Raise an IngesterError if the levels of the ion have been ingested
+        without a checkpoint, or if they would be replaced without the stages
+        that refer to them.
+        """
+        ion = (int(atomic_number), int(ion_charge))
+        key = ion + (stage,)
+        self.seen.add(ion)
+
+        if key in self.content_hashes:
+            if not replace or self.content_hashes[key] == content_hash:
+                return False
+            if stage == "levels" and self.stages is not None:
+                dependent_stages = [other_stage for other_stage in ["lines", "collisions"]
+                                    if ion + (other_stage,) in self.content_hashes and
+                                    other_stage not in self.stages]
+                if dependent_stages:
+                    raise IngesterError("Levels of {0} {1} from {2} have changed and replacing them "
+                                        "removes the {3} of the ion. Update with {4} as well".format(
+                                            convert_atomic_number2symbol(atomic_number), ion_charge,
+                                            self.data_source.short_name, " and ".join(dependent_stages),
+                                            ", ".join("{0}=True".format(other_stage)
+                                                      for other_stage in dependent_stages)))
+            self.remove(atomic_number, ion_charge, stage)
+        elif stage == "levels" and ion in self.ions_with_levels:
+            raise IngesterError("Levels of {0} {1} from {2} have been ingested without a checkpoint. "
+                                "Remove them before resuming the ingest".format(
+                                    convert_atomic_number2symbol(atomic_number), ion_charge,
+                                    self.data_source.short_name))
+
+        if ion in self.checkpointed_ions:
+            self.modified.add(ion)
+        else:
+            self.added.add(ion)
+        return True
+
+    def mark(self, atomic_number, ion_charge, stage, content_hash=None):
+        key = (int(atomic_number), int(ion_charge), stage)
+        if key in self.content_hashes:
+            return
+        self.session.add(IngestCheckpoint(atomic_number=key[0], ion_charge=key[1], stage=stage,
+                                          content_hash=content_hash,
+                                          data_source_id=self.data_source.data_source_id))
+        self.content_hashes[key] = content_hash
+
+    def remove(self, atomic_number, ion_charge, stage):
+        """
+        Delete the data of the stage of the ion and its checkpoint
+
+        The lines and collisions refer to the levels, so removing
+        the levels removes all stages of the ion.
+        """
+        atomic_number, ion_charge = int(atomic_number), int(ion_charge)
+        data_source_id = self.data_source.data_source_id
+        self.session.flush()
+
+        level_ids = select([Level.level_id]).where(and_(Level.data_source_id == data_source_id,
+                                                        Level.atomic_number == atomic_number,
+                                                        Level.ion_charge == ion_charge))
+        stages = ["lines", "collisions", "levels"] if stage == "levels" else [stage]
+
+        for transition_stage, model, quantity_columns in [
+                ("lines", Line, [LineQuantity.__table__.c.line_id]),
+                ("collisions", ECollision, [ECollisionQuantity.__table__.c.e_col_id,
+                                            ECollisionTempStrength.__table__.c.e_col_id])]:
+            if transition_stage not in stages:
+                continue
+            transition_ids = select([Transition.transition_id]).\
+                where(and_(Transition.type == inspect(model).polymorphic_identity,
+                           Transition.data_source_id == data_source_id,
+                           Transition.lower_level_id.in_(level_ids)))
+            # The quantities first, the transitions are needed to select them
+            for column in quantity_columns:
+                self.session.execute(column.table.delete().where(column.in_(transition_ids)))
+            model_id, = model.__table__.primary_key
+            self.session.execute(model.__table__.delete().where(model_id.in_(transition_ids)))
+            self.session.execute(Transition.__table__.delete().
+                                 where(Transition.transition_id.in_(transition_ids)))
+
+        if stage == "levels":
+            self.session.execute(LevelQuantity.__table__.delete().
+                                 where(LevelQuantity.level_id.in_(level_ids)))
+            self.session.execute(Level.__table__.delete().where(Level.level_id.in_(level_ids)))
+            self.ions_with_levels.discard((atomic_number, ion_charge))
+
+        self.session.execute(IngestCheckpoint.__table__.delete().
+                             where(and_(IngestCheckpoint.data_source_id == data_source_id,
+                                        IngestCheckpoint.atomic_number == atomic_number,
+                                        IngestCheckpoint.ion_charge == ion_charge,
+                                        IngestCheckpoint.stage.in_(stages))))
+        for removed_stage in stages:
+            self.content_hashes.pop((atomic_number, ion_charge, removed_stage), None)
+
+    def remove_missing(self, selected_ions=None):
+        """
+        Remove the ions that have a checkpoint but have not been ingested again
+
+        Parameters
+        ----------
+        selected_ions : set of tuples
+            Only remove these (atomic_number, ion_charge) (default: None, all ions)
+        """
+        for ion in sorted(self.checkpointed_ions - self.seen):
+            if selected_ions is not None and ion not in selected_ions:
+                continue
+            self.remove(ion[0], ion[1], "levels")
+            self.removed.add(ion)
+
+    def summary(self):
+        """ Return a summary of the added, modified and removed ions """
+        lines = list()
+        for name, ions in [("Added", self.added),
+                           ("Modified", self.modified),
+                           ("Removed", self.removed)]:
+            ion_names = ", ".join("{0} {1}".format(convert_atomic_number2symbol(atomic_number), ion_charge)
+                                  for atomic_number, ion_charge in sorted(ions))
+            lines.append("{0}: {1} ions{2}".format(name, len(ions), " ({0})".format(ion_names) if ions else ""))
+        lines.append("Unchanged: {0} ions".format(len(self.seen - self.added - self.modified)))
+        return "\n".join(lines)
+
+
+class LevelIdMap(object):
+    """
+    Maps (atomic_number, ion_charge, level_index) to the ids of the levels of a data source.
+
+    The levels are read with one query and stored in dense arrays. The ids of
+    the levels of an ion are in a block of `level_ids` that starts at
+    `ion_start[atomic_number, ion_charge]` and has an entry for every level
+    index below `ion_size[atomic_number, ion_charge]` (-1 if there is no level
+    with this index).
+
+    Parameters
+    ----------
+    session : SQLAlchemy session
+    data_source : DataSource instance
+    atomic_numbers : list of int
+        Only read the levels of these elements
+        (default: None, read all levels of the data source)
+
+    Methods
+    -------
+    from_ids(atomic_number, ion_charge, level_index, level_id)
+        Create the map from known level ids, without a query
+    lookup(atomic_number, ion_charge, level_index)
+        Return the level ids, -1 for missing levels
+    get_ids(atomic_number, ion_charge, level_index)
+        Return the level ids, raise an IngesterError listing all missing levels
+    """
+
+    def __init__(self, session, data_source, atomic_numbers=None):
+        q_lvls = session.query(Level.atomic_number, Level.ion_charge,
+                               Level.level_index, Level.level_id).\
+            filter(Level.data_source == data_source).\
+            filter(Level.level_index >= 0)
+        if atomic_numbers is not None:
+            q_lvls = q_lvls.filter(Level.atomic_number.in_([int(_) for _ in atomic_numbers]))
+
+        # Reading the flattened rows of the Core statement is much faster than building
+        # ORM tuples, but pending levels are not flushed automatically
+        session.flush()
+        atomic_number, ion_charge, level_index, level_id = \
+            np.fromiter(chain.from_iterable(session.execute(q_lvls.statement)), dtype=np.int64).reshape(-1, 4).T
+        self.set_levels(atomic_number, ion_charge, level_index, level_id)
+
+    @classmethod
+    def from_ids(cls, atomic_number, ion_charge, level_index, level_id):
+        """
+        Create the map from the ids of levels that have just been inserted
+
+        Parameters
+        ----------
+        atomic_number, ion_charge, level_index, level_id : int or array_like of int
+        """
+        level_id_map = cls.__new__(cls)
+        level_id_map.set_levels(*np.broadcast_arrays(
+            *[np.asarray(_, dtype=np.int64) for _ in (atomic_number, ion_charge, level_index, level_id)]))
+        return level_id_map
+
+    def set_levels(self, atomic_number, ion_charge, level_index, level_id):
+        """ Store the ids of the levels in the dense arrays """
+        shape = (atomic_number.max() + 1, ion_charge.max() + 1) if len(level_id) > 0 else (0, 0)
+        self.ion_size = np.zeros(shape, dtype=np.int64)
+        np.maximum.at(self.ion_size, (atomic_number, ion_charge), level_index + 1)
+        self.ion_start = (np.cumsum(self.ion_size) - self.ion_size.ravel()).reshape(shape)
+
+        self.level_ids = np.full(self.ion_size.sum(), -1, dtype=np.int64)
+        self.level_ids[self.ion_start[atomic_number, ion_charge] + level_index] = level_id
+
+    def __len__(self):
+        return int((self.level_ids != -1).sum())
+
+    def lookup(self, atomic_number, ion_charge, level_index):
+        """
+        Return the ids of the levels, -1 for the levels that are not in the map
+
+        Parameters
+        ----------
+        atomic_number, ion_charge, level_index : int or array_like of int
+
+        Returns
+        -------
+        numpy.ndarray
+        """
+        atomic_number, ion_charge, level_index = np.broadcast_arrays(
+            *[np.asarray(_, dtype=np.int64) for _ in (atomic_number, ion_charge, level_index)])
+
+        ids = np.full(atomic_number.shape, -1, dtype=np.int64)
+        n_atomic_numbers, n_ion_charges = self.ion_size.shape
+        known = (atomic_number >= 0) & (atomic_number < n_atomic_numbers) & \
+                (ion_charge >= 0) & (ion_charge < n_ion_charges)
+
+        start = np.zeros_like(ids)
+        size = np.zeros_like(ids)
+        start[known] = self.ion_start[atomic_number[known], ion_charge[known]]
+        size[known] = self.ion_size[atomic_number[known], ion_charge[known]]
+        known &= (level_index >= 0) & (level_index < size)
+
+        ids[known] = self.level_ids[start[known] + level_index[known]]
+        return ids
+
+    def get_ids(self, atomic_number, ion_charge, level_index):
+        """
+        Return the ids of the levels
+
+        Raises
+        ------
+        IngesterError
+            If some levels are not in the map. The message lists all of them.
+        """
+        ids = self.lookup(atomic_number, ion_charge, level_index)
+        missing = ids == -1
+        if missing.any():
+            atomic_number, ion_charge, level_index = np.broadcast_arrays(
+                *[np.asarray(_) for _ in (atomic_number, ion_charge, level_index)])
+            missing_levels = pd.DataFrame({"atomic_number": atomic_number[missing],
+                                           "ion_charge": ion_charge[missing],
+                                           "level_index": level_index[missing]}).\
+                drop_duplicates().sort_values(["atomic_number", "ion_charge", "level_index"])
+            ions_msg = ["{} {}: {}".format(convert_atomic_number2symbol(atomic_number), ion_charge,
+                                           ", ".join(str(_) for _ in ion_levels["level_index"]))
+                        for (atomic_number, ion_charge), ion_levels
+                        in missing_levels.groupby(["atomic_number", "ion_charge"])]
+            raise IngesterError("{} levels from this source have not been found ({}). "
+                                "You must ingest levels before transitions".
+                                format(len(missing_levels), "; ".join(ions_msg)))
+        return ids
+
+
+class BulkInserter(object):
+    """
+    Inserts prepared DataFrames with SQLAlchemy Core instead of the ORM.
+
+    Every row of a DataFrame becomes one instance of a model. The rows are
+    sent in `executemany` batches, table by table, so that models with joined
+    table inheritance (e.g. `Line` -> `transition` and `line`) are supported.
+    The primary keys are allocated once per call (see `allocate_ids`).
+
+    Parameters
+    ----------
+    session : SQLAlchemy session
+    batchsize : int
+        Number of rows sent to the database at once
+        (default: BULK_BATCHSIZE)
+
+    Methods
+    -------
+    allocate_ids(model, n)
+        Return `n` unused primary keys for the model
+    insert(model, rows)
+        Insert the rows and return their primary keys
+    """
+
+    def __init__(self, session, batchsize=BULK_BATCHSIZE):
+        self.session = session
+        self.batchsize = batchsize
+
+    def allocate_ids(self, model, n):
+        """
+        Return `n` unused primary keys for the model
+
+        On PostgreSQL the keys are taken from the sequence of the primary key,
+        which keeps the sequence ahead of the inserted keys for later inserts
+        by the ORM and is safe with concurrent writers. Otherwise the block
+        starts after the largest key in the base table of the model, so all
+        pending ORM objects must have been flushed.
+
+        The second case assumes a single writer: another connection inserting
+        into the same table between the `max` query and the insert gets the
+        same keys, and the insert fails with an integrity error. MySQL's
+        AUTO_INCREMENT counter may also be ahead of the largest key (e.g.
+        after deletes); the block is still unused then, and MySQL moves the
+        counter past explicitly inserted keys. Use PostgreSQL or a single
+        ingest at a time when inserting with `BulkInserter`.
+        """
+        pk, = inspect(model).primary_key
+        if self.session.get_bind(mapper=inspect(model)).dialect.name == 'postgresql':
+            sequence = self.session.query(func.pg_get_serial_sequence(pk.table.fullname, pk.name)).scalar()
+            if sequence is not None:
+                ids = self.session.query(func.nextval(sequence)).\
+                    select_from(func.generate_series(1, n).alias()).all()
+                return np.array([row[0] for row in ids], dtype=np.int64)
+        start = self.session.query(func.max(pk)).scalar() or 0
+        return np.arange(start + 1, start + n + 1)
+
+    def insert(self, model, rows):
+        """
+        Insert the rows into the tables of the model
+
+        Parameters
+        ----------
+        model : SQLAlchemy model
+        rows : pandas.DataFrame or dict
+            Columns are named after the attributes of the model, e.g. `_value`
+            and `data_source_id` for quantities. The primary keys and the
+            polymorphic identity are filled in; omitted columns get
+            their defaults. NaN values are stored as NULL.
+
+        Returns
+        -------
+        ids : numpy.ndarray
+            Primary keys of the inserted rows
+        """
+        rows = pd.DataFrame(rows)
+        mapper = inspect(model)
+
+        # Pending ORM objects must get their keys before a block is allocated
+        self.session.flush()
+        ids = self.allocate_ids(model, len(rows))
+        if rows.empty:
+            return ids
+
+        table_values = dict((table, dict()) for table in mapper.tables)
+        for prop in mapper.column_attrs:
+            for column in prop.columns:
+                if column.primary_key:
+                    values = ids
+                elif column is mapper.polymorphic_on:
+                    values = np.repeat(mapper.polymorphic_identity, len(rows))
+                elif prop.key in rows:
+                    values = rows[prop.key]
+                else:
+                    continue
+                table_values[column.table][column.name] = np.asarray(values)
+
+        # `mapper.tables` starts with the base table, which the others reference
+        for table in mapper.tables:
+            names = list(table_values[table].keys())
+            # Only one batch at a time is converted to Python objects
+            for start in range(0, len(rows), self.batchsize):
+                columns = list()
+                for name in names:
+                    values = pd.Series(table_values[table][name][start:start + self.batchsize]).astype(object)
+                    columns.append(values.where(values.notnull(), None).tolist())
+                records = [dict(zip(names, record)) for record in zip(*columns)]
+                self.session.execute(table.insert(), records)
+
+        return ids
+
+
 class BaseIngester(object):
     """
     Abstract base class for ingesters.
@@ -1,62 +1,300 @@
 import pandas as pd
 import numpy as np
+import multiprocessing
+import hashlib
 import pickle
 import os
 import re
 
+from fractions import Fraction
+
 from numpy.testing import assert_almost_equal
+from pandas import HDFStore
 from astropy import units as u
-from sqlalchemy import and_
 from pyparsing import ParseException
-from carsus.io.base import IngesterError
-from carsus.io.util import convert_species_tuple2chianti_str
-from carsus.util import convert_atomic_number2symbol, parse_selected_species
+from carsus.io.base import IngesterError, BulkInserter, IonCheckpoints, LevelIdMap, SessionBatcher, \
+    hash_content, iter_prefetched, to_model_unit
+from carsus.io.util import convert_species_tuple2chianti_str, parse_fortran_format, read_fixed_width_records
+from carsus.util import convert_atomic_number2symbol, convert_symbol2atomic_number, parse_selected_species
 from carsus.model import DataSource, Ion, Level, LevelEnergy,\
     Line,LineGFValue, LineAValue, LineWavelength, MEDIUM_VACUUM, \
     ECollision, ECollisionEnergy, ECollisionGFValue, ECollisionTempStrength
 
-# Compatibility with older versions and pip versions:
-try:
-    from ChiantiPy.tools.io import versionRead
-    import ChiantiPy.core as ch
-except ImportError:
-    # Shamefully copied from their github source:
-    def versionRead():
-        """
-        Read the version number of the CHIANTI database
-        """
-        xuvtop = os.environ['XUVTOP']
-        vFileName = os.path.join(xuvtop, 'VERSION')
-        vFile = open(vFileName)
-        versionStr = vFile.readline()
-        vFile.close()
-        return versionStr.strip()
-    import chianti.core as ch
 
-masterlist_ions_path = os.path.join(
-    os.getenv('XUVTOP'), "masterlist", "masterlist_ions.pkl"
-)
+def versionRead():
+    """
+    Read the version number of the CHIANTI database
+
+    The same as `ChiantiPy.tools.io.versionRead`, which would import ChiantiPy.
+    """
+    xuvtop = os.environ['XUVTOP']
+    vFileName = os.path.join(xuvtop, 'VERSION')
+    vFile = open(vFileName)
+    versionStr = vFile.readline()
+    vFile.close()
+    return versionStr.strip()
+
+
+# ChiantiPy and the masterlists of every $XUVTOP, loaded on first use
+_chianti_core = None
+_masterlist_ions = dict()
+
+
+def get_chianti_core():
+    """
+    Return the `core` module of ChiantiPy, imported on first use
+
+    Older and pip versions of ChiantiPy are imported as `chianti`.
+    """
+    global _chianti_core
+    if _chianti_core is None:
+        try:
+            import ChiantiPy.core as ch
+        except ImportError:
+            import chianti.core as ch
+        _chianti_core = ch
+    return _chianti_core
+
+
+def get_masterlist_ions():
+    """
+    Return the names of the ions in the masterlist of $XUVTOP, read on first use
+
+    The "d" ions are excluded for now.
+    """
+    xuvtop = os.environ['XUVTOP']
+    if xuvtop not in _masterlist_ions:
+        masterlist_ions_path = os.path.join(xuvtop, "masterlist", "masterlist_ions.pkl")
+        with open(masterlist_ions_path, 'rb') as masterlist_ions_file:
+            masterlist_ions = pickle.load(masterlist_ions_file).keys()
+        _masterlist_ions[xuvtop] = [_ for _ in masterlist_ions
+                                    if re.match("^[a-z]+_\d+$", _)]
+    return _masterlist_ions[xuvtop]
+
+
+# Conversion of the ionization potentials, the same constant as in ChiantiPy
+CHIANTI_INVCM2EV = 1. / 8.06554465e+3
+
+ELVLC_FORTRAN_FORMAT = 'I7,A30,A5,I5,A5,F5.1,F15.3,F15.3'
+ELVLC_COLUMNS = ['lvl', 'conf', 'label', 'spin', 'spd', 'j', 'ecm', 'ecmth']
+
+WGFA_FORTRAN_FORMAT = '2I5,F15.3,2E15.3'
+WGFA_COLUMNS = ['lvl1', 'lvl2', 'wvl', 'gf', 'avalue']
+
+SCUPS_COLUMNS = ['lvl1', 'lvl2', 'de', 'gf', 'lim', 'ntemp', 'ttype', 'cups']
+
+CHIANTI_CACHE_VERSION = 1  # increased when the layout of the cached DataFrames changes
+
+
+def read_chianti_records(fname):
+    """
+    Return the lines of the data records of a CHIANTI file
+
+    The records end with a line of at most one value, usually -1,
+    which is followed by the references.
+    """
+    with open(fname, 'rb') as f:
+        lines = f.read().splitlines()
+    n_records = next((i for i, line in enumerate(lines) if len(line.split(None, 2)) < 2), len(lines))
+    return lines[:n_records]
+
+
+def read_elvlc(fname):
+    """
+    Read a CHIANTI .elvlc file
+
+    The records are parsed column-wise (see `read_fixed_width_records`). The
+    values are the ones of ChiantiPy's `elvlcRead`, including the "pretty"
+    configuration and term.
+
+    Returns
+    -------
+        dict
+            lvl, conf, label, spin, spd, j, ecm, ecmth and pretty as arrays
+    """
+    records = read_fixed_width_records(read_chianti_records(fname),
+                                       parse_fortran_format(ELVLC_FORTRAN_FORMAT), ELVLC_COLUMNS)
+    for name in ['conf', 'label', 'spd']:
+        records[name] = records[name].fillna('')
+
+    j_fractions = dict((j, str(Fraction(j))) for j in records['j'].unique())
+    terms = records['spin'].astype(np.int64).astype(str) + records['spd'] + records['j'].map(j_fractions)
+    records['pretty'] = (records['conf'] + ' ' + terms).str.strip()
+
+    return dict((name, records[name].values) for name in records.columns)
+
+
+def read_wgfa(fname):
+    """
+    Read a CHIANTI .wgfa file
+
+    Returns
+    -------
+        dict
+            lvl1, lvl2, wvl, gf and avalue as arrays
+    """
+    records = read_fixed_width_records(read_chianti_records(fname),
+                                       parse_fortran_format(WGFA_FORTRAN_FORMAT), WGFA_COLUMNS)
+    return dict((name, records[name].values) for name in records.columns)
+
+
+def read_scups(fname):
+    """
+    Read a CHIANTI .scups file
+
+    Every transition has three lines: its parameters, the scaled temperatures
+    and the scaled collision strengths. Each kind of line is parsed for all
+    transitions at once.
+
+    Returns
+    -------
+        dict
+            lvl1, lvl2, de, gf, lim, ntemp, ttype and cups as arrays,
+            btemp and bscups as lists of arrays
+    """
+    with open(fname, 'rb') as f:
+        lines = f.read().splitlines()
+    n_lines = next((i for i, line in enumerate(lines) if line[:3] == b' -1'), len(lines))
+    n_transitions = n_lines // 3
 
-masterlist_ions_file = open(masterlist_ions_path, 'rb')
-masterlist_ions = pickle.load(masterlist_ions_file).keys()
-# Exclude the "d" ions for now
-masterlist_ions = [_ for _ in masterlist_ions
-                   if re.match("^[a-z]+_\d+$", _)]
+    parameters = np.fromstring(b' '.join(lines[0:3*n_transitions:3]), sep=' ').\
+        reshape(n_transitions, len(SCUPS_COLUMNS))
+    scups = dict(zip(SCUPS_COLUMNS, parameters.T))
+    for name in ['lvl1', 'lvl2', 'ntemp', 'ttype']:
+        scups[name] = scups[name].astype(np.int64)
 
-masterlist_version = versionRead()
+    splits = np.cumsum(scups['ntemp'])[:-1]
+    scups['btemp'] = np.split(np.fromstring(b' '.join(lines[1:3*n_transitions:3]), sep=' '), splits)
+    scups['bscups'] = np.split(np.fromstring(b' '.join(lines[2:3*n_transitions:3]), sep=' '), splits)
+    return scups
+
+
+def read_chianti_ip(fname):
+    """ Read the ionization potentials of chianti.ip in eV, keyed by (atomic_number, ion stage) """
+    values = np.fromstring(b' '.join(read_chianti_records(fname)), sep=' ').reshape(-1, 3)
+    return dict(((int(atomic_number), int(ion_stage)), ip * CHIANTI_INVCM2EV)
+                for atomic_number, ion_stage, ip in values)
 
 
 class ChiantiIonReaderError(Exception):
     pass
 
 
+class ChiantiIonInfo(object):
+    """
+        The attributes of a `chianti.core.ion` instance that are used after
+        its data has been read (see `ChiantiIonReader.detach`)
+    """
+
+    attributes = ['Z', 'Ion', 'Ip', 'Spectroscopic']
+
+    def __init__(self, ion):
+        self.Z = ion.Z
+        self.Ion = ion.Ion
+        self.Ip = ion.Ip
+        self.Spectroscopic = ion.Spectroscopic
+
+    def to_dict(self):
+        return dict((name, getattr(self, name)) for name in self.attributes)
+
+    @classmethod
+    def from_dict(cls, info):
+        info_obj = cls.__new__(cls)
+        info_obj.__dict__.update(info)
+        return info_obj
+
+
+class ChiantiIonFiles(object):
+    """
+        Reads the data of an ion directly from its CHIANTI files under $XUVTOP
+
+        Provides the attributes of a `chianti.core.ion` instance that are used
+        by `ChiantiIonReader`. A file is read when its attribute is first
+        accessed; a missing file raises an AttributeError, like the attribute
+        of a `chianti.core.ion` without this data.
+
+        Attributes
+        ----------
+        Z, Ion: int
+            atomic number and ion stage (ion_charge + 1)
+        Ip: float
+            ionization potential [eV]
+        Spectroscopic: str
+        Elvlc, Wgfa, Scups: dict
+            see `read_elvlc`, `read_wgfa` and `read_scups`
+    """
+
+    # Ionization potentials of every $XUVTOP, read once
+    ip_cache = dict()
+
+    def __init__(self, ion_name):
+        self.ion_name = ion_name
+        element, ion_stage = ion_name.split('_')
+        self.Z = convert_symbol2atomic_number(element.capitalize())
+        self.Ion = int(ion_stage)
+        self.Spectroscopic = '{0} {1}'.format(element.capitalize(), self.Ion - 1)
+        self.dirname = os.path.join(os.environ['XUVTOP'], element, ion_name)
+        self._data = dict()
+
+    @property
+    def Ip(self):
+        ip_fname = os.path.join(os.environ['XUVTOP'], 'ip', 'chianti.ip')
+        if ip_fname not in self.ip_cache:
+            self.ip_cache[ip_fname] = read_chianti_ip(ip_fname)
+        return self.ip_cache[ip_fname][(self.Z, self.Ion)]
+
+    def release(self):
+        """ Drop the data of the files that have been read """
+        self._data.clear()
+
+    def read_file(self, extension, read_func):
+        if extension not in self._data:
+            fname = os.path.join(self.dirname, '{0}.{1}'.format(self.ion_name, extension))
+            if not os.path.exists(fname):
+                raise AttributeError('No {0} file for ion {1}'.format(extension, self.ion_name))
+            self._data[extension] = read_func(fname)
+        return self._data[extension]
+
+    @property
+    def Elvlc(self):
+        return self.read_file('elvlc', read_elvlc)
+
+    @property
+    def Wgfa(self):
+        return self.read_file('wgfa', read_wgfa)
+
+    @property
+    def Scups(self):
+        return self.read_file('scups', read_scups)
+
+
+def _read_chianti_ion(args):
+    """ Read the data of an ion in a worker process """
+    ion_name, backend, cache_dir = args
+    return ChiantiIonReader(ion_name, backend=backend, cache_dir=cache_dir).detach()
+
+
 class ChiantiIonReader(object):
     """
         Class for reading ion data from the CHIANTI database
 
+        Parameters
+        ----------
+        ion_name: str
+            e.g. "fe_13"
+        backend: str
+            "chiantipy" to read the ion with `chianti.core.ion` or "native" to
+            read its files with `ChiantiIonFiles` (default: "chiantipy")
+        cache_dir: str
+            directory for an HDF5 cache of the `levels`, `lines` and
+            `collisions` DataFrames. The cache is keyed by the CHIANTI version,
+            the ion, the path of $XUVTOP and the sizes and modification times
+            of the ion's files. On a cache hit the ion is not read at all and
+            the reader is detached (default: None, no cache)
+
         Attributes
         ----------
-        ion: chianti.core.ion instance
+        ion: chianti.core.ion, ChiantiIonFiles or ChiantiIonInfo instance
 
         Methods
         -------
@@ -77,6 +315,16 @@ class ChiantiIonReader(object):
 
         bound_collisions
             Same as `collisions`, but only for bound levels (with energy < ionization_potential)
+
+        detach
+            Read all data and drop the `chianti.core.ion` instance, so that
+            the reader can be pickled
+
+        release
+            Drop the DataFrames that have been read
+
+        reattach
+            Make the data of a released detached reader available again
     """
 
     elvlc_dict = {
@@ -109,36 +357,202 @@ class ChiantiIonReader(object):
         'cups': 'cups'  # BT92 scaling parameter
     }
 
-    def __init__(self, ion_name):
+    backends = ['chiantipy', 'native']
+
+    collisions_array_columns = ['temperatures', 'collision_strengths']
+
+    def __init__(self, ion_name, backend='chiantipy', cache_dir=None):
 
-        self.ion = ch.ion(ion_name)
+        if backend not in self.backends:
+            raise ValueError('backend must be one of {0}, not {1}'.format(self.backends, backend))
+        self.ion_name = ion_name
+        self.backend = backend
+        self.cache_dir = cache_dir
+        self._cache_key = None
         self._levels = None
         self._lines = None
         self._collisions = None
+        self._last_bound_level = None
+        self._released = False
+
+        if cache_dir is not None and self.read_cache():
+            return
+
+        self.ion = self.open_ion()
+
+        if cache_dir is not None:
+            self.detach()
+            self.write_cache()
+
+    def open_ion(self):
+        """ Return the ion read with the backend """
+        if self.backend == 'chiantipy':
+            return get_chianti_core().ion(self.ion_name)
+        return ChiantiIonFiles(self.ion_name)
+
+    @property
+    def cache_key(self):
+        """ MD5 hash of the CHIANTI version, the ion, the backend, $XUVTOP and the ion's files """
+        if self._cache_key is None:
+            xuvtop = os.path.realpath(os.environ['XUVTOP'])
+            element = self.ion_name.split('_')[0]
+            dirname = os.path.join(xuvtop, element, self.ion_name)
+            md5_hash = hashlib.md5()
+            md5_hash.update('version={0};ion={1};backend={2};xuvtop={3};cache_version={4};'.format(
+                versionRead(), self.ion_name, self.backend, xuvtop, CHIANTI_CACHE_VERSION).encode())
+            if os.path.isdir(dirname):
+                for fname in sorted(os.listdir(dirname)):
+                    stat = os.stat(os.path.join(dirname, fname))
+                    md5_hash.update('{0}:{1}:{2};'.format(fname, stat.st_size, stat.st_mtime).encode())
+            self._cache_key = md5_hash.hexdigest()
+        return self._cache_key
+
+    @property
+    def cache_fname(self):
+        return os.path.join(self.cache_dir, 'chianti_{0}_{1}.h5'.format(self.ion_name, self.cache_key))
+
+    def read_cache(self):
+        """
+        Load the DataFrames and the ion attributes from the cache
+
+        Returns
+        -------
+            bool
+                True on a cache hit
+        """
+        if not os.path.exists(self.cache_fname):
+            return False
+        with HDFStore(self.cache_fname, mode='r') as store:
+            for name in ["levels", "lines", "collisions"]:
+                if name in store:
+                    df = store[name]
+                    if name == "collisions":
+                        # The arrays of the collisions are stored flattened
+                        for column in self.collisions_array_columns:
+                            sizes = store["collisions_{0}_sizes".format(column)].values
+                            stops = np.cumsum(sizes)
+                            starts = stops - sizes
+                            values = store["collisions_" + column].values
+                            df[column] = pd.Series([values[start:stop] for start, stop in zip(starts, stops)],
+                                                   index=df.index)
+                        df = df[store.get_storer(name).attrs.columns]
+                    setattr(self, "_" + name, df)
+            self.ion = ChiantiIonInfo.from_dict(store.get_storer('ion').attrs.ion_info)
+        return True
+
+    def write_cache(self):
+        """
+        Write the DataFrames and the ion attributes of a detached reader to the cache
+
+        The file is written under a temporary name and renamed, so that
+        readers in other processes never see an incomplete cache.
+        """
+        if not os.path.isdir(self.cache_dir):
+            try:
+                os.makedirs(self.cache_dir)
+            except OSError:
+                # Created by another process
+                if not os.path.isdir(self.cache_dir):
+                    raise
+        tmp_fname = '{0}.{1}.tmp'.format(self.cache_fname, os.getpid())
+        with HDFStore(tmp_fname, mode='w') as store:
+            for name in ["levels", "lines", "collisions"]:
+                df = getattr(self, "_" + name)
+                if df is None:
+                    continue
+                if name == "collisions":
+                    # Store the temperatures and collision strengths as flat arrays
+                    # instead of pickling an array for every collision
+                    for column in self.collisions_array_columns:
+                        store.put("collisions_{0}_sizes".format(column),
+                                  pd.Series([len(_) for _ in df[column]]))
+                        store.put("collisions_" + column,
+                                  pd.Series(np.concatenate([np.empty(0)] + df[column].tolist())))
+                    columns = df.columns.tolist()
+                    store.put(name, df.drop(self.collisions_array_columns, axis=1))
+                    store.get_storer(name).attrs.columns = columns
+                    continue
+                store.put(name, df)
+            store.put('ion', pd.Series([self.ion.Spectroscopic]))
+            store.get_storer('ion').attrs.ion_info = self.ion.to_dict()
+        os.rename(tmp_fname, self.cache_fname)
+
+    def detach(self):
+        """
+        Read the levels, lines and collisions and replace `ion` by a `ChiantiIonInfo`
+
+        Data that is not available raises a ChiantiIonReaderError
+        when it is accessed, as before.
+
+        Returns
+        -------
+            self
+        """
+        for name in ["levels", "lines", "collisions"]:
+            try:
+                getattr(self, name)
+            except ChiantiIonReaderError:
+                pass
+        self.ion = ChiantiIonInfo(self.ion)
+        return self
+
+    def reattach(self):
+        """
+        Make the data of a released detached reader available again
+
+        The DataFrames are read from the cache if there is one, otherwise
+        the ion is read again with the backend.
+        """
+        if not self._released:
+            return
+        self._released = False
+        if self.cache_dir is not None and self.read_cache():
+            return
+        self.ion = self.open_ion()
 
     @property
     def levels(self):
+        self.reattach()
         if self._levels is None:
             self._levels = self.read_levels()
         return self._levels
 
     @property
     def lines(self):
+        self.reattach()
         if self._lines is None:
             self._lines = self.read_lines()
         return self._lines
 
     @property
     def collisions(self):
+        self.reattach()
         if self._collisions is None:
             self._collisions = self.read_collisions()
         return self._collisions
 
+    def release(self):
+        """
+        Drop the DataFrames to free their memory, they are read again when accessed
+
+        A detached reader, e.g. one read from the cache or in a worker
+        process, reads them from the cache or with the backend (see `reattach`).
+        """
+        self._released = isinstance(self.ion, ChiantiIonInfo)
+        self._levels = None
+        self._lines = None
+        self._collisions = None
+        self._last_bound_level = None
+        if isinstance(self.ion, ChiantiIonFiles):
+            self.ion.release()
+
     @property
     def last_bound_level(self):
-        ionization_potential = u.eV.to(u.Unit("cm-1"), value=self.ion.Ip, equivalencies=u.spectral())
-        last_row = self.levels.loc[self.levels['energy'] < ionization_potential].tail(1)
-        return last_row.index[0]
+        if self._last_bound_level is None:
+            ionization_potential = u.eV.to(u.cm**-1, value=self.ion.Ip, equivalencies=u.spectral())
+            last_row = self.levels.loc[self.levels['energy'] < ionization_potential].tail(1)
+            self._last_bound_level = last_row.index[0]
+        return self._last_bound_level
 
     @property
     def bound_levels(self):
@@ -217,16 +631,8 @@ class ChiantiIonReader(object):
         lines = lines.loc[~(lines["wavelength"] == 0)]
 
         # theoretical wavelengths have negative values
-        def parse_wavelength(row):
-            if row["wavelength"] < 0:
-                wvl = -row["wavelength"]
-                method = "th"
-            else:
-                wvl = row["wavelength"]
-                method = "m"
-            return pd.Series([wvl, method])
-
-        lines[["wavelength", "method"]] = lines.apply(parse_wavelength, axis=1)
+        lines["method"] = np.where(lines["wavelength"] < 0, "th", "m")
+        lines["wavelength"] = lines["wavelength"].abs()
 
         lines = lines.set_index(["lower_level_index", "upper_level_index"])
         lines = lines.sort_index()
@@ -264,6 +670,21 @@ class ChiantiIngester(object):
             (default None)
         ds_short_name: str
             Short name of the datasource
+        batch_size: int
+            Flush the session and expunge the ingested objects every `batch_size`
+            objects and after every ion (default: None, only after every ion
+            if `commit` is set, otherwise the session is left as it is)
+        commit: bool
+            Commit the session every time it is flushed (default: False)
+        n_workers: int
+            Number of processes that read the ions. The readers are
+            detached (see `ChiantiIonReader.detach`) and sent back to the
+            ingester (default: None, read the ions in this process)
+        backend: str
+            Backend of the `ChiantiIonReader` instances (default: "chiantipy")
+        cache_dir: str
+            Directory of the on-disk cache of the `ChiantiIonReader` instances
+            (default: None, no cache)
 
         Attributes
         ----------
@@ -277,19 +698,22 @@ class ChiantiIngester(object):
             Persists data into the database
     """
 
-    masterlist_ions = masterlist_ions
     ds_prefix = 'chianti'
 
-    def __init__(self, session, ions=None, ds_short_name=None):
+    def __init__(self, session, ions=None, ds_short_name=None, batch_size=None, commit=False,
+                 n_workers=None, backend='chiantipy', cache_dir=None):
         if ds_short_name is None:
             ds_short_name = '{}_v{}'.format(
                     self.ds_prefix,
-                    masterlist_version)
+                    versionRead())
 
         self.session = session
+        self.batcher = SessionBatcher(session, batch_size=batch_size, commit=commit)
         # ToDo write a parser for Spectral Notation
         self.ion_readers = list()
         self.ions = list()
+        #: (atomic_number, ion_charge) of the selected ions, None if all ions are selected
+        self.selected_ions = None
 
         if ions is not None:
             try:
@@ -297,39 +721,245 @@ class ChiantiIngester(object):
             except ParseException:
                 raise ValueError('Input is not a valid species string {}'.format(ions))
             self.ions = [convert_species_tuple2chianti_str(_) for _ in ions]
+            self.selected_ions = set((int(atomic_number), int(ion_charge)) for atomic_number, ion_charge in ions)
         else:
-            self.ions = masterlist_ions
+            self.ions = self.masterlist_ions
 
+        available_ions = list()
         for ion in self.ions:
             if ion in self.masterlist_ions:
-                self.ion_readers.append(ChiantiIonReader(ion))
+                available_ions.append(ion)
             else:
                 print("Ion {0} is not available".format(ion))
 
+        if n_workers is not None and n_workers > 1 and len(available_ions) > 1:
+            pool = multiprocessing.Pool(min(n_workers, len(available_ions)))
+            try:
+                self.ion_readers = pool.map(_read_chianti_ion,
+                                        [(ion, backend, cache_dir) for ion in available_ions],
+                                            chunksize=1)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            self.ion_readers = [ChiantiIonReader(ion, backend=backend, cache_dir=cache_dir)
+                                for ion in available_ions]
+
         self.data_source = DataSource.as_unique(self.session, short_name=ds_short_name)
         # To get the id if a new data source was created
         if self.data_source.data_source_id is None:
             self.session.flush()
 
-    def get_lvl_index2id(self, ion):
-        """ Return a DataFrame that maps levels indexes to ids """
+    @property
+    def masterlist_ions(self):
+        return get_masterlist_ions()
 
-        q_ion_lvls = self.session.query(Level.level_id.label("id"),
-                                        Level.level_index.label("index")). \
-            filter(and_(Level.ion == ion,
-                        Level.data_source == self.data_source))
+    @staticmethod
+    def get_transition_level_ids(level_ids, atomic_number, ion_charge, transitions):
+        """
+        Return the ids of the lower and upper levels of the transitions of an ion
 
-        lvl_index2id = list()
-        for id, index in q_ion_lvls:
-            lvl_index2id.append((index, id))
+        Parameters
+        ----------
+        level_ids : LevelIdMap
+        atomic_number, ion_charge : int
+        transitions : pandas.DataFrame
+            Indexed by (lower_level_index, upper_level_index)
+        """
+        level_index = np.concatenate([transitions.index.get_level_values(0),
+                                      transitions.index.get_level_values(1)])
+        lower_level_ids, upper_level_ids = np.split(
+            level_ids.get_ids(atomic_number, ion_charge, level_index), 2)
+        return lower_level_ids, upper_level_ids
 
-        lvl_index2id_dtype = [("index", np.int), ("id", np.int)]
-        lvl_index2id = np.array(lvl_index2id, dtype=lvl_index2id_dtype)
-        lvl_index2id = pd.DataFrame.from_records(lvl_index2id, index="index")
+    def ingest_ion_levels(self, ion, bound_levels, bulk=False):
+        """
+        Persist the bound levels of an ion
 
-        return lvl_index2id
+        Returns
+        -------
+            LevelIdMap of the inserted levels if `bulk`, otherwise None
+        """
 
-    def ingest_levels(self):
+        # ToDo: Determine parity from configuration
+
+        if bulk:
+            self.session.flush()  # The ion must exist before the levels are inserted
+            inserter = BulkInserter(self.session)
+            level_ids = inserter.insert(Level, {
+                "atomic_number": ion.atomic_number,
+                "ion_charge": ion.ion_charge,
+                "data_source_id": self.data_source.data_source_id,
+                "level_index": bound_levels.index,
+                "configuration": bound_levels["configuration"].values,
+                "term": bound_levels["term"].values,
+                "L": bound_levels["L"].values,
+                "J": bound_levels["J"].values,
+                "spin_multiplicity": bound_levels["spin_multiplicity"].values
+            })
+            for column, method in [('energy', 'meas'), ('energy_theoretical', 'theor')]:
+                exists = (bound_levels[column] != -1).values  # check if the value exists
+                inserter.insert(LevelEnergy, {
+                    "level_id": level_ids[exists],
+                    "_value": to_model_unit(LevelEnergy,
+                                            bound_levels[column].values[exists]*u.cm**-1),
+                    "method": method,
+                    "data_source_id": self.data_source.data_source_id
+                })
+            self.batcher.release()
+            return LevelIdMap.from_ids(ion.atomic_number, ion.ion_charge, bound_levels.index, level_ids)
+
+        for index, row in bound_levels.iterrows():
+
+            level = Level(
+                ion=ion, data_source=self.data_source, level_index=index,
+                configuration=row["configuration"], term=row["term"],
+                L=row["L"], J=row["J"], spin_multiplicity=row["spin_multiplicity"]
+            )
+
+            level.energies = []
+            for column, method in [('energy', 'meas'), ('energy_theoretical', 'theor')]:
+                if row[column] != -1:  # check if the value exists
+                    level.energies.append(
+                        LevelEnergy(quantity=row[column]*u.cm**-1,
+                                    data_source=self.data_source,
+                                    method=method),
+                    )
+            self.batcher.add(level)
+
+        self.batcher.release()
+        return None
+
+    def ingest_ion_lines(self, ion, bound_lines, level_ids, bulk=False):
+        """ Persist the bound lines of an ion, whose levels are looked up in `level_ids` """
+
+        lower_level_ids, upper_level_ids = self.get_transition_level_ids(
+            level_ids, ion.atomic_number, ion.ion_charge, bound_lines)
+
+        if bulk:
+            inserter = BulkInserter(self.session)
+            line_ids = inserter.insert(Line, {
+                "lower_level_id": lower_level_ids,
+                "upper_level_id": upper_level_ids,
+                "data_source_id": self.data_source.data_source_id
+            })
+            inserter.insert(LineWavelength, {
+                "line_id": line_ids,
+                "_value": to_model_unit(LineWavelength, bound_lines["wavelength"].values*u.AA),
+                "medium": MEDIUM_VACUUM,
+                "method": bound_lines["method"].values,
+                "data_source_id": self.data_source.data_source_id
+            })
+            inserter.insert(LineAValue, {
+                "line_id": line_ids,
+                "_value": to_model_unit(LineAValue, bound_lines["a_value"].values*u.s**-1),
+                "data_source_id": self.data_source.data_source_id
+            })
+            inserter.insert(LineGFValue, {
+                "line_id": line_ids,
+                "_value": bound_lines["gf_value"].values,
+                "data_source_id": self.data_source.data_source_id
+            })
+            self.batcher.release()
+            return
+
+        for (_, row), lower_level_id, upper_level_id in zip(bound_lines.iterrows(),
+                                                             lower_level_ids, upper_level_ids):
+
+            # Create a new line
+            line = Line(
+                lower_level_id=int(lower_level_id),
+                upper_level_id=int(upper_level_id),
+                data_source=self.data_source,
+                wavelengths=[
+                    LineWavelength(quantity=row["wavelength"]*u.AA,
+                                   data_source=self.data_source,
+                                   medium=MEDIUM_VACUUM,
+                                   method=row["method"])
+                ],
+                a_values=[
+                    LineAValue(quantity=row["a_value"]*u.s**-1,
+                               data_source=self.data_source)
+                ],
+                gf_values=[
+                    LineGFValue(quantity=row["gf_value"],
+                                data_source=self.data_source)
+                ]
+            )
+
+            self.batcher.add(line)
+
+        self.batcher.release()
+
+    def ingest_ion_collisions(self, ion, bound_collisions, level_ids, bulk=False):
+        """ Persist the bound electron collisions of an ion, whose levels are looked up in `level_ids` """
+
+        lower_level_ids, upper_level_ids = self.get_transition_level_ids(
+            level_ids, ion.atomic_number, ion.ion_charge, bound_collisions)
+
+        if bulk:
+            inserter = BulkInserter(self.session)
+            e_col_ids = inserter.insert(ECollision, {
+                "lower_level_id": lower_level_ids,
+                "upper_level_id": upper_level_ids,
+                "data_source_id": self.data_source.data_source_id,
+                "bt92_ttype": bound_collisions["ttype"].values,
+                "bt92_cups": bound_collisions["cups"].values
+            })
+            inserter.insert(ECollisionEnergy, {
+                "e_col_id": e_col_ids,
+                "_value": to_model_unit(ECollisionEnergy, bound_collisions["energy"].values*u.rydberg),
+                "data_source_id": self.data_source.data_source_id
+            })
+            inserter.insert(ECollisionGFValue, {
+                "e_col_id": e_col_ids,
+                "_value": bound_collisions["gf_value"].values,
+                "data_source_id": self.data_source.data_source_id
+            })
+
+            # One row for every temperature of every collision
+            temperatures = [np.asarray(_, dtype=float) for _ in bound_collisions["temperatures"]]
+            strengths = [np.asarray(_, dtype=float) for _ in bound_collisions["collision_strengths"]]
+            n_temps = [min(len(temp), len(strength)) for temp, strength in zip(temperatures, strengths)]
+            if sum(n_temps) > 0:
+                inserter.insert(ECollisionTempStrength, {
+                    "e_col_id": np.repeat(e_col_ids, n_temps),
+                    "temp": np.concatenate([temp[:n] for temp, n in zip(temperatures, n_temps)]),
+                    "strength": np.concatenate([strength[:n] for strength, n in zip(strengths, n_temps)])
+                })
+            self.batcher.release()
+            return
+
+        for (_, row), lower_level_id, upper_level_id in zip(bound_collisions.iterrows(),
+                                                             lower_level_ids, upper_level_ids):
+
+            # Create a new electron collision
+            e_col = ECollision(
+                lower_level_id=int(lower_level_id),
+                upper_level_id=int(upper_level_id),
+                data_source=self.data_source,
+                bt92_ttype=row["ttype"],
+                bt92_cups=row["cups"],
+                energies=[
+                    ECollisionEnergy(quantity=row["energy"]*u.rydberg,
+                                     data_source=self.data_source)
+                ],
+                gf_values=[
+                    ECollisionGFValue(quantity=row["gf_value"],
+                                      data_source=self.data_source)
+                ]
+            )
+
+            e_col.temp_strengths = [
+                ECollisionTempStrength(temp=temp, strength=strength)
+                for temp, strength in zip(row["temperatures"], row["collision_strengths"])
+                ]
+
+            self.batcher.add(e_col)
+
+        self.batcher.release()
+
+    def ingest_levels(self, bulk=False):
 
         print("Ingesting levels from {}".format(self.data_source.short_name))
 
@@ -348,30 +978,14 @@ class ChiantiIngester(object):
 
             print("Ingesting levels for {} {}".format(convert_atomic_number2symbol(atomic_number), ion_charge))
 
-            # ToDo: Determine parity from configuration
-
-            for index, row in bound_levels.iterrows():
-
-                level = Level(
-                    ion=ion, data_source=self.data_source, level_index=index,
-                    configuration=row["configuration"], term=row["term"],
-                    L=row["L"], J=row["J"], spin_multiplicity=row["spin_multiplicity"]
-                )
-
-                level.energies = []
-                for column, method in [('energy', 'meas'), ('energy_theoretical', 'theor')]:
-                    if row[column] != -1:  # check if the value exists
-                        level.energies.append(
-                            LevelEnergy(quantity=row[column]*u.Unit("cm-1"),
-                                        data_source=self.data_source,
-                                        method=method),
-                        )
-                self.session.add(level)
+            self.ingest_ion_levels(ion, bound_levels, bulk=bulk)
 
-    def ingest_lines(self):
+    def ingest_lines(self, bulk=False):
 
         print("Ingesting lines from {}".format(self.data_source.short_name))
 
+        level_ids = LevelIdMap(self.session, self.data_source)
+
         for rdr in self.ion_readers:
 
             atomic_number = rdr.ion.Z
@@ -387,47 +1001,14 @@ class ChiantiIngester(object):
 
             print("Ingesting lines for {} {}".format(convert_atomic_number2symbol(atomic_number), ion_charge))
 
-            lvl_index2id = self.get_lvl_index2id(ion)
-
-            for index, row in bound_lines.iterrows():
-
-                # index: (lower_level_index, upper_level_index)
-                lower_level_index, upper_level_index = index
+            self.ingest_ion_lines(ion, bound_lines, level_ids, bulk=bulk)
 
-                try:
-                    lower_level_id = int(lvl_index2id.loc[lower_level_index])
-                    upper_level_id = int(lvl_index2id.loc[upper_level_index])
-                except KeyError:
-                    raise IngesterError("Levels from this source have not been found."
-                                        "You must ingest levels before transitions")
-
-                # Create a new line
-                line = Line(
-                    lower_level_id=lower_level_id,
-                    upper_level_id=upper_level_id,
-                    data_source=self.data_source,
-                    wavelengths=[
-                        LineWavelength(quantity=row["wavelength"]*u.AA,
-                                       data_source=self.data_source,
-                                       medium=MEDIUM_VACUUM,
-                                       method=row["method"])
-                    ],
-                    a_values=[
-                        LineAValue(quantity=row["a_value"]*u.Unit("s**-1"),
-                                   data_source=self.data_source)
-                    ],
-                    gf_values=[
-                        LineGFValue(quantity=row["gf_value"],
-                                    data_source=self.data_source)
-                    ]
-                )
-
-                self.session.add(line)
-
-    def ingest_collisions(self):
+    def ingest_collisions(self, bulk=False):
 
         print("Ingesting collisions from {}".format(self.data_source.short_name))
 
+        level_ids = LevelIdMap(self.session, self.data_source)
+
         for rdr in self.ion_readers:
 
             atomic_number = rdr.ion.Z
@@ -443,54 +1024,175 @@ class ChiantiIngester(object):
 
             print("Ingesting collisions for {} {}".format(convert_atomic_number2symbol(atomic_number), ion_charge))
 
-            lvl_index2id = self.get_lvl_index2id(ion)
-
-            for index, row in bound_collisions.iterrows():
+            self.ingest_ion_collisions(ion, bound_collisions, level_ids, bulk=bulk)
 
-                # index: (lower_level_index, upper_level_index)
-                lower_level_index, upper_level_index = index
+    def iter_ion_data(self, levels=True, lines=False, collisions=False, checkpoints=None, release=False):
+        """
+        Read the ions one by one
 
+        Parameters
+        ----------
+        levels, lines, collisions: bool
+            read levels/lines/collisions
+        checkpoints: IonCheckpoints
+            do not read the data that already has a checkpoint (default: None)
+        release: bool
+            release the reader of an ion (see `ChiantiIonReader.release`)
+            once its data has been yielded (default: False)
+
+        Yields
+        ------
+        atomic_number, ion_charge : int
+        bound_levels, bound_lines, bound_collisions : pandas.DataFrame
+            None if not requested, already ingested or not available
+        """
+        for rdr in self.ion_readers:
+            atomic_number, ion_charge = rdr.ion.Z, rdr.ion.Ion - 1
+            ion_data = [atomic_number, ion_charge]
+            for requested, stage in [(levels, "levels"),
+                                     (lines, "lines"),
+                                     (collisions, "collisions")]:
+                if checkpoints is not None and checkpoints.is_done(atomic_number, ion_charge, stage):
+                    requested = False
                 try:
-                    lower_level_id = int(lvl_index2id.loc[lower_level_index])
-                    upper_level_id = int(lvl_index2id.loc[upper_level_index])
-                except KeyError:
-                    raise IngesterError("Levels from this source have not been found."
-                                        "You must ingest levels before transitions")
-
-                # Create a new electron collision
-                e_col = ECollision(
-                    lower_level_id=lower_level_id,
-                    upper_level_id=upper_level_id,
-                    data_source=self.data_source,
-                    bt92_ttype=row["ttype"],
-                    bt92_cups=row["cups"],
-                    energies=[
-                        ECollisionEnergy(quantity=row["energy"]*u.rydberg,
-                                         data_source=self.data_source)
-                    ],
-                    gf_values=[
-                        ECollisionGFValue(quantity=row["gf_value"],
-                                          data_source=self.data_source)
-                    ]
-                )
-
-                e_col.temp_strengths = [
-                    ECollisionTempStrength(temp=temp, strength=strength)
-                    for temp, strength in zip(row["temperatures"], row["collision_strengths"])
-                    ]
-
-                self.session.add(e_col)
-
-    def ingest(self, levels=True, lines=False, collisions=False):
-
-        if levels:
-            self.ingest_levels()
-            self.session.flush()
+                    ion_data.append(getattr(rdr, "bound_" + stage) if requested else None)
+                except ChiantiIonReaderError:
+                    ion_data.append(None)
+            yield tuple(ion_data)
+            if release:
+                rdr.release()
+
+    def ingest_ions(self, levels=True, lines=False, collisions=False, bulk=False,
+                    pipeline=False, resume=False, update=False):
+        """
+        Persist the data ion by ion
 
-        if lines:
-            self.ingest_lines()
-            self.session.flush()
+        The levels, lines and collisions of an ion are ingested in one step:
+        the bound levels are determined once, the ids of the levels inserted
+        in bulk are used for the lines and collisions without a query, and the
+        reader of the ion is released afterwards.
 
-        if collisions:
-            self.ingest_collisions()
-            self.session.flush()
+        Parameters
+        ----------
+        levels, lines, collisions: bool
+            ingest levels/lines/collisions
+        bulk: bool
+            insert the rows with `BulkInserter` (default: False)
+        pipeline: bool
+            read the next ions in a background thread while the current one
+            is written (default: False)
+        resume: bool
+            commit the session after every ion together with its checkpoints
+            (see `IonCheckpoints`) and skip the data that already has a
+            checkpoint (default: False)
+        update: bool
+            like `resume`, but replace the data whose content hash differs from
+            its checkpoint and remove the selected ions that are no longer
+            available (default: False). Replacing the levels of an ion removes
+            its lines and collisions, so an IngesterError is raised if they
+            have checkpoints and are not ingested as well.
+        """
+
+        checkpoints = None
+        if resume or update:
+            if self.batcher.commit:
+                raise ValueError("resume and update commit the session once per ion and can not be "
+                                 "combined with commit=True")
+            stages = [stage for requested, stage in [(levels, "levels"),
+                                                     (lines, "lines"),
+                                                     (collisions, "collisions")] if requested]
+            checkpoints = IonCheckpoints(self.session, self.data_source, stages=stages)
+
+        print("Ingesting ions from {}".format(self.data_source.short_name))
+
+        # Data that has a checkpoint is only read to compare its content hash in an update
+        ions = self.iter_ion_data(levels, lines, collisions,
+                                  checkpoints=checkpoints if not update else None, release=True)
+        if pipeline:
+            ions = iter_prefetched(ions)
+
+        for atomic_number, ion_charge, bound_levels, bound_lines, bound_collisions in ions:
+
+            ion = Ion.as_unique(self.session, atomic_number=atomic_number, ion_charge=ion_charge)
+            ion_name = "{} {}".format(convert_atomic_number2symbol(atomic_number), ion_charge)
+
+            stages = list()
+            for requested, data, stage in [(levels, bound_levels, "levels"),
+                                           (lines, bound_lines, "lines"),
+                                           (collisions, bound_collisions, "collisions")]:
+                if not requested:
+                    continue
+                content_hash = None
+                if checkpoints is not None:
+                    content_hash = hash_content(data)
+                    if not checkpoints.needs_ingest(atomic_number, ion_charge, stage,
+                                                    content_hash=content_hash, replace=update):
+                        print("Skipping {} for ion {}: already ingested".format(stage, ion_name))
+                        continue
+                if data is None:
+                    print("{} not found for ion {}".format(stage.capitalize(), ion_name))
+                stages.append((stage, content_hash))
+
+            if not stages:
+                continue
+            ingested_stages = [stage for stage, _ in stages]
+
+            print("Ingesting ion {}".format(ion_name))
+
+            level_ids = None
+            if bound_levels is not None and "levels" in ingested_stages:
+                level_ids = self.ingest_ion_levels(ion, bound_levels, bulk=bulk)
+
+            ingest_lines = bound_lines is not None and "lines" in ingested_stages
+            ingest_collisions = bound_collisions is not None and "collisions" in ingested_stages
+            if (ingest_lines or ingest_collisions) and level_ids is None:
+                level_ids = LevelIdMap(self.session, self.data_source, atomic_numbers=[atomic_number])
+            if ingest_lines:
+                self.ingest_ion_lines(ion, bound_lines, level_ids, bulk=bulk)
+            if ingest_collisions:
+                self.ingest_ion_collisions(ion, bound_collisions, level_ids, bulk=bulk)
+
+            if checkpoints is not None:
+                self.session.flush()
+                for stage, content_hash in stages:
+                    checkpoints.mark(atomic_number, ion_charge, stage, content_hash=content_hash)
+                self.session.commit()
+
+        if update:
+            checkpoints.remove_missing(self.selected_ions)
+            self.session.commit()
+            print(checkpoints.summary())
+
+    def ingest(self, levels=True, lines=False, collisions=False, bulk=False, pipeline=False,
+               resume=False, update=False):
+        """
+        Persist levels, lines and collisions into the database
+
+        The data is ingested ion by ion in a single pass (see `ingest_ions`).
+
+        Parameters
+        ----------
+        levels, lines, collisions: bool
+            ingest levels/lines/collisions
+        bulk: bool
+            insert the rows with `BulkInserter` instead of creating
+            one ORM object per row (default: False)
+        pipeline: bool
+            read the next ions in a background thread while the current one
+            is written (see `ingest_ions`, default: False)
+        resume: bool
+            commit the session after every ion together with a checkpoint of the
+            ion and skip the ions that already have one (see `ingest_ions`,
+            default: False). Start the ingest with `resume=True` to be able to
+            resume it after a failure.
+        update: bool
+            ingest a new CHIANTI version into the data source of a previous
+            ingest (pass its `ds_short_name`, the default name contains the
+            version). Like `resume`, but the data of the ions that have changed
+            is replaced and the ions that are no longer available are removed
+            (see `ingest_ions`, default: False)
+        """
+
+        self.ingest_ions(levels, lines, collisions, bulk=bulk, pipeline=pipeline,
+                         resume=resume, update=update)
+        self.session.flush()
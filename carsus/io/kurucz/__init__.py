@@ -1 +1 @@
-from .gfall import GFALLReader, GFALLIngester
\ No newline at end of file
+from .gfall import GFALLReader, GFALLMultiReader, GFALLIngester
\ No newline at end of file
@@ -1,21 +1,256 @@
+import os
 import re, logging
+import hashlib
+import multiprocessing
+import gzip
+import bz2
+import glob
+
+from contextlib import contextmanager
+from itertools import islice
+from pandas import HDFStore
 
 import numpy as np
 import pandas as pd
 
 from astropy import units as u
-from sqlalchemy import and_
 from pyparsing import ParseException
 from carsus.model import DataSource, Ion, Level, LevelEnergy,\
     Line, LineWavelength, LineGFValue, MEDIUM_VACUUM, MEDIUM_AIR
-from carsus.io.base import IngesterError
+from carsus.io.base import IngesterError, BulkInserter, IonCheckpoints, LevelIdMap, SessionBatcher, \
+    hash_content, iter_prefetched, to_model_unit
+from carsus.io.util import parse_fortran_format, read_fixed_width_records, convert_fortran_field
 from carsus.util import convert_atomic_number2symbol, parse_selected_species
 
+# Compatibility with Python 2, where lzma is only available as a backport:
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
 
 GFALL_AIR_THRESHOLD = 200  # [nm], wavelengths above this value are given in air
 
+GFALL_CHUNKSIZE = 100000  # records read at once in the streaming mode
+
+GFALL_INDEX_BLOCKSIZE = 2**26  # bytes scanned at once when indexing
+
+# A level label is a configuration followed by a term, e.g. 's2p *3P',
+# '3d7 4s a5F' or '4p5 5s 2[3/2]'. The term is the last word if it has the
+# form of a term: a seniority letter, a parity mark, the multiplicity and L,
+# or a jK term.
+GFALL_LABEL_PATTERN = (r'^(?:(?P<configuration>\S.*?)\s+)?'
+                       r'(?P<term>[a-z]?\*?(?:\d+[A-Z]|\d*\[[\d/]+\])[\d*]*)$')
+
+GFALL_CACHE_VERSION = 4  # increased when the layout of the cached DataFrames changes
+
+# Extensions of compressed gfall files and the functions opening them
+GFALL_COMPRESSION_OPENERS = {'.gz': gzip.open, '.bz2': bz2.BZ2File}
+if lzma is not None:
+    GFALL_COMPRESSION_OPENERS.update({'.xz': lzma.open, '.lzma': lzma.open})
+
 logger = logging.getLogger(__name__)
 
+
+def is_compressed(fname):
+    """ Return True if `fname` has the extension of a compressed file """
+    return os.path.splitext(fname)[1].lower() in ('.gz', '.bz2', '.xz', '.lzma')
+
+
+def has_random_access(fname):
+    """ Return True if `fname` is an uncompressed file that can be read at byte offsets """
+    return not hasattr(fname, 'read') and not is_compressed(fname)
+
+
+@contextmanager
+def open_gfall(fname):
+    """
+    Open a gfall file for reading bytes
+
+    Compressed files are decompressed while they are read. File-like
+    objects are used as they are and are not closed.
+
+    Parameters
+    ----------
+    fname: ~str or file-like
+        path to a gfall file, optionally compressed with gzip (.gz),
+        bzip2 (.bz2) or xz (.xz, .lzma), or an open file
+
+    Yields
+    ------
+        file-like
+    """
+    if hasattr(fname, 'read'):
+        yield fname
+        return
+
+    extension = os.path.splitext(fname)[1].lower()
+    if is_compressed(fname) and extension not in GFALL_COMPRESSION_OPENERS:
+        raise ValueError('Reading {0} requires the lzma module; on Python 2 install '
+                         'backports.lzma'.format(fname))
+    opener = GFALL_COMPRESSION_OPENERS.get(extension, open)
+    f = opener(fname, 'rb')
+    try:
+        yield f
+    finally:
+        f.close()
+
+
+def _factorize_keys(keys):
+    """
+    Encode rows of several key arrays as integer codes
+
+    The codes are numbered in order of first appearance. Equal rows get
+    equal codes, missing values compare equal like in `drop_duplicates`.
+
+    Parameters
+    ----------
+    keys: list of numpy.ndarray
+        key columns of equal length
+
+    Returns
+    -------
+        numpy.ndarray
+    """
+    codes = np.zeros(len(keys[0]), dtype=np.int64)
+    for key in keys:
+        key_codes, uniques = pd.factorize(key)
+        # Compress after every column so that the combined codes can't overflow
+        codes = pd.factorize(codes * (len(uniques) + 1) + key_codes + 1)[0]
+    return codes
+
+
+def _sort_key(values):
+    """
+    Return an array that `np.lexsort` orders like `DataFrame.sort_values`
+
+    Numbers are used as they are; other values are replaced by the codes of
+    their sorted distinct values, with missing values last.
+    """
+    if values.dtype.kind in 'biuf':
+        return values
+    codes, uniques = pd.factorize(values, sort=True)
+    codes[codes < 0] = len(uniques)
+    return codes
+
+
+def parse_gfall_labels(labels):
+    """
+    Split level labels into configuration and term
+
+    Every distinct label is parsed once. Labels that do not end with a term
+    are taken as the configuration, e.g. '3d8' or '4f7(8S)5d'.
+
+    Parameters
+    ----------
+    labels: numpy.ndarray
+        level labels with the whitespace normalized, as in `gfall`
+
+    Returns
+    -------
+        tuple
+            (configuration, term) arrays, NaN where they are missing
+    """
+    codes, unique_labels = pd.factorize(labels)
+    parsed = pd.Series(unique_labels, dtype=object).str.extract(GFALL_LABEL_PATTERN)
+    configuration = parsed['configuration'].values.astype(object)
+    term = parsed['term'].values.astype(object)
+    no_term = pd.isnull(term)
+    configuration[no_term] = np.asarray(unique_labels, dtype=object)[no_term]
+
+    missing = codes < 0
+    configuration, term = configuration.take(codes), term.take(codes)
+    configuration[missing] = np.nan
+    term[missing] = np.nan
+    return configuration, term
+
+
+def split_records(fname, n_pieces):
+    """
+    Split a file into byte ranges that start and end on line boundaries
+
+    Parameters
+    ----------
+    fname: str
+    n_pieces: int
+        number of ranges of about equal size
+
+    Returns
+    -------
+        list of tuples
+            (start, stop) byte offsets in file order
+    """
+    size = os.path.getsize(fname)
+    boundaries = [0]
+    with open(fname, 'rb') as f:
+        for i in range(1, n_pieces):
+            # Finish the line that contains the byte before the split point
+            f.seek(max(size * i // n_pieces - 1, 0))
+            f.readline()
+            boundaries.append(min(f.tell(), size))
+    boundaries.append(size)
+    boundaries = sorted(set(boundaries))
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
+
+def expand_gfall_fnames(fname):
+    """
+    Return the gfall files given by paths, glob patterns or open files
+
+    Parameters
+    ----------
+    fname: ~str, file-like or list
+        a path, a glob pattern, an open file or a list of them
+
+    Returns
+    -------
+        list
+            the paths matching every pattern are sorted
+    """
+    patterns = list(fname) if isinstance(fname, (list, tuple)) else [fname]
+    fnames = list()
+    for pattern in patterns:
+        if hasattr(pattern, 'read') or not glob.has_magic(pattern):
+            fnames.append(pattern)
+            continue
+        matches = sorted(glob.glob(pattern))
+        if not matches:
+            raise ValueError('No gfall files match {0}'.format(pattern))
+        fnames += matches
+    return fnames
+
+
+def _read_gfall_file(args):
+    """ Parse a gfall file in a worker process """
+    fname, reader_kwargs = args
+    return GFALLReader(fname, **reader_kwargs).gfall
+
+
+def _read_gfall_range(args):
+    """
+    Read (and parse) the gfall records in a byte range in a worker process
+
+    Returns
+    -------
+        tuple
+            (number of raw records, DataFrame indexed from 0)
+    """
+    fname, start, stop, reader_kwargs, parse = args
+    reader = GFALLReader(fname, **reader_kwargs)
+    with open(fname, 'rb') as f:
+        f.seek(start)
+        data = f.read(stop - start)
+    gfall_raw = reader.read_gfall_records(data)
+    n_records = len(gfall_raw)
+    gfall_raw = reader.select_ions(gfall_raw)
+    if parse:
+        return n_records, reader.parse_gfall(gfall_raw)
+    return n_records, gfall_raw
+
+
 class GFALLReader(object):
     """
         Class for extracting lines and levels data from kurucz gfall files
@@ -29,6 +264,18 @@ class GFALLReader(object):
         gfall_raw:
             Return pandas DataFrame representation of gfall
 
+        iter_chunks(chunksize):
+            Iterate over parsed gfall chunks without reading the whole file
+
+        iter_ions(chunksize):
+            Iterate over the levels and lines of one ion at a time
+
+        index:
+            Return the byte ranges of the ions in the file
+
+        read_ions_raw(ions):
+            Parse only the records of the given ions
+
     """
 
     gfall_fortran_format = ('F11.4,F7.3,F6.2,F12.3,F5.2,1X,A10,F12.3,F5.2,1X,'
@@ -46,29 +293,90 @@ class GFALLReader(object):
                'hyperfine_note_second', 'line_strength_class', 'line_code',
                'lande_g_first', 'lande_g_second', 'isotopic_shift']
 
+    # Columns that `parse_gfall` always needs
+    gfall_required_columns = ['element_code', 'e_first', 'label_first',
+                              'e_second', 'label_second']
+
+    # Columns used by `extract_levels` and `extract_lines`
+    gfall_ingest_columns = ['wavelength', 'loggf', 'element_code', 'e_first', 'j_first',
+                            'label_first', 'e_second', 'j_second', 'label_second']
+
     default_unique_level_identifier = ['energy', 'j']
-    def __init__(self, fname, unique_level_identifier=None):
+    def __init__(self, fname, unique_level_identifier=None, cache_dir=None, n_workers=None,
+                 ions=None, columns=None, energy_tolerance=None):
         """
 
         Parameters
         ----------
-        fname: str
-            path to the gfall file
+        fname: str or file-like
+            path to the gfall file or an open gfall file. Files compressed
+            with gzip (.gz), bzip2 (.bz2) or xz (.xz, .lzma) are decompressed
+            while they are parsed. Compressed and open files are read
+            sequentially: `index` is not available, `n_workers` is ignored
+            and open files are not cached.
 
         unique_level_identifier: list
             list of attributes to identify unique levels from. Will always use
             atomic_number and ion charge in addition.
+
+        cache_dir: str
+            directory for an HDF5 cache of the `gfall`, `levels` and `lines`
+            DataFrames and of the ion `index`. The cache is keyed by the
+            content, size and modification time of the gfall file and by the
+            options that change the DataFrames, so it is invalidated
+            automatically.
+            (default: None, no cache)
+
+        n_workers: int
+            number of processes that read and parse parts of the file in
+            parallel (default: None, read in this process)
+
+        ions: list of tuples
+            (atomic_number, ion_charge) of the ions to read. Records of other
+            ions are dropped right after reading; with the NumPy engine only
+            the byte ranges of these ions are parsed (see `index`).
+            (default: None, read all ions)
+
+        columns: list of str
+            names of the `gfall_columns` to convert, the other fields are
+            skipped. `gfall_required_columns` are always converted and
+            `gfall_ingest_columns` are needed for `levels` and `lines`.
+            (default: None, convert all)
+
+        energy_tolerance: float
+            levels of an ion whose energies differ by at most this value
+            [1/cm] and that agree in the other unique level identifiers are
+            merged into one level (see `merge_close_energies`)
+            (default: None, only equal energies identify the same level)
         """
         self.fname = fname
+        if columns is not None:
+            columns = [column for column in self.gfall_columns
+                       if column in columns or column in self.gfall_required_columns]
+        self.columns = columns
+        self.ions = sorted(set((int(atomic_number), int(ion_charge))
+                               for atomic_number, ion_charge in ions)) if ions is not None else None
+        if cache_dir is not None and hasattr(fname, 'read'):
+            logger.warn('Open gfall files can not be cached, give the path instead.')
+            cache_dir = None
+        self.cache_dir = cache_dir
+        self.n_workers = n_workers
+        self.energy_tolerance = energy_tolerance
         self._gfall_raw = None
         self._gfall = None
         self._levels = None
         self._lines = None
+        self._index = None
+        self._cache_key = None
         if unique_level_identifier is None:
             logger.warn('A specific combination to identify unique levels from '
                         'the gfall data has not been given. Defaulting to '
                         '["energy", "j"].')
             self.unique_level_identifier = self.default_unique_level_identifier
+        else:
+            self.unique_level_identifier = list(unique_level_identifier)
+        if energy_tolerance is not None and 'energy' not in self.unique_level_identifier:
+            raise ValueError('energy_tolerance needs "energy" in the unique_level_identifier')
 
 
     @property
@@ -80,29 +388,105 @@ class GFALLReader(object):
     @property
     def gfall(self):
         if self._gfall is None:
-            self._gfall = self.parse_gfall()
+            self._gfall = self.read_cached('gfall', self.parse_gfall)
         return self._gfall
 
     @property
     def levels(self):
         if self._levels is None:
-            self._levels = self.extract_levels()
+            self._levels = self.read_cached('levels', self.extract_levels)
         return self._levels
 
     @property
     def lines(self):
         if self._lines is None:
-            self._lines = self.extract_lines()
+            self._lines = self.read_cached('lines', self.extract_lines)
         return self._lines
 
-    def read_gfall_raw(self, fname=None):
+    @property
+    def cache_key(self):
+        """ MD5 hash of the gfall file and of the options that change the DataFrames """
+        if self._cache_key is None:
+            md5_hash = hashlib.md5()
+            with open(self.fname, 'rb') as f:
+                for block in iter(lambda: f.read(2**20), b''):
+                    md5_hash.update(block)
+            stat = os.stat(self.fname)
+            md5_hash.update('size={0};mtime={1};unique_level_identifier={2};ions={3};'
+                            'columns={4};energy_tolerance={5};version={6}'.format(
+                stat.st_size, stat.st_mtime, ','.join(self.unique_level_identifier),
+                self.ions, self.columns, self.energy_tolerance,
+                GFALL_CACHE_VERSION).encode())
+            self._cache_key = md5_hash.hexdigest()
+        return self._cache_key
+
+    @property
+    def cache_fname(self):
+        return os.path.join(self.cache_dir, 'gfall_{0}.h5'.format(self.cache_key))
+
+    def read_cached(self, key, read_func):
+        """
+        Return the DataFrame `key` from the cache or compute and cache it
+
+        Parameters
+        ----------
+        key: str
+            'gfall', 'levels' or 'lines'
+        read_func: callable
+            computes the DataFrame on a cache miss
+
+        Returns
+        -------
+            pandas.DataFrame
+
+        The cache is written under a temporary name together with the
+        DataFrames already cached and renamed, so that readers in other
+        processes never see an incomplete cache.
+        """
+        if self.cache_dir is None:
+            return read_func()
+
+        if os.path.exists(self.cache_fname):
+            with HDFStore(self.cache_fname, mode='r') as store:
+                if key in store:
+                    logger.info('Loading {0} from the cache {1}'.format(key, self.cache_fname))
+                    return store[key]
+
+        df = read_func()
+
+        # read_func may have cached other DataFrames in the meantime
+        cached = {}
+        if os.path.exists(self.cache_fname):
+            with HDFStore(self.cache_fname, mode='r') as store:
+                for cached_key in store.keys():
+                    cached[cached_key] = store[cached_key]
+
+        if not os.path.isdir(self.cache_dir):
+            try:
+                os.makedirs(self.cache_dir)
+            except OSError:
+                # Created by another process
+                if not os.path.isdir(self.cache_dir):
+                    raise
+        cached[key] = df
+        tmp_fname = '{0}.{1}.tmp'.format(self.cache_fname, os.getpid())
+        with HDFStore(tmp_fname, mode='w') as store:
+            for cached_key, cached_df in cached.items():
+                store.put(cached_key, cached_df)
+        os.rename(tmp_fname, self.cache_fname)
+        return df
+
+    def read_gfall_raw(self, fname=None, engine='numpy'):
         """
         Reading in a normal gfall.dat
 
         Parameters
         ----------
-        fname: ~str
-            path to gfall.dat
+        fname: ~str or file-like
+            path to gfall.dat, optionally compressed, or an open file
+        engine: ~str
+            'numpy' (default) slices the records column-wise in a byte array,
+            'fwf' uses `pandas.read_fwf`
 
         Returns
         -------
@@ -115,6 +499,27 @@ class GFALLReader(object):
 
         logger.info('Parsing GFALL {0}'.format(fname))
 
+        if engine == 'numpy':
+            if not has_random_access(fname):
+                if self.n_workers is not None and self.n_workers > 1:
+                    logger.info('Compressed and open files are read in one process')
+                # Decompress and parse chunk by chunk, so that the decompressed
+                # file is never held in memory as a whole
+                chunks = list(self.iter_gfall_raw(fname=fname))
+                if not chunks:
+                    return self.select_ions(self.read_gfall_records(b''))
+                return pd.concat(chunks)
+            if self.ions is not None and fname == self.fname:
+                return self.read_ions_raw(self.ions)
+            if self.n_workers is not None and self.n_workers > 1:
+                return self.read_gfall_parallel(fname, parse=False)
+            with open(fname, 'rb') as f:
+                data = f.read()
+            return self.select_ions(self.read_gfall_records(data))
+
+        if engine != 'fwf':
+            raise ValueError('Unknown engine {0}'.format(engine))
+
         # FORMAT(F11.4,F7.3,F6.2,F12.3,F5.2,1X,A10,F12.3,F5.2,1X,A10,
         # 3F6.2,A4,2I2,I3,F6.3,I3,F6.3,2I5,1X,A1,A1,1X,A1,A1,i1,A3,2I5,I6)
 
@@ -134,71 +539,488 @@ class GFALLReader(object):
         #remove empty lines
         gfall = gfall[~gfall.isnull().all(axis=1)]
 
-        return gfall
+        if self.columns is not None:
+            gfall = gfall[self.columns]
 
-    def parse_gfall(self, gfall_raw=None):
+        return self.select_ions(gfall)
+
+    def select_ions(self, gfall_raw):
+        """ Drop the records of ions that are not in `ions` from a raw gfall DataFrame """
+        if self.ions is None:
+            return gfall_raw
+
+        element_code = gfall_raw['element_code'].values
+        atomic_number = element_code.astype(np.int64)
+        ion_charge = ((element_code - atomic_number) * 100).round().astype(np.int64)
+        selected_keys = [100 * ion[0] + ion[1] for ion in self.ions]
+        return gfall_raw.loc[np.in1d(100 * atomic_number + ion_charge, selected_keys)]
+
+    def read_gfall_records(self, data):
         """
-        Parse raw gfall DataFrame
+        Parse gfall records with the NumPy engine
 
         Parameters
         ----------
-        gfall_raw: pandas.DataFrame
+        data: bytes
+            gfall records separated by newlines
 
         Returns
         -------
             pandas.DataFrame
-                a level DataFrame
+                with the dtypes of the 'fwf' engine: integer fields are
+                floats and fields without any value are float NaN
+        """
+        fields = parse_fortran_format(self.gfall_fortran_format)
+        gfall_raw = read_fixed_width_records(data, fields, self.gfall_columns, usecols=self.columns)
+        for column in gfall_raw.columns:
+            values = gfall_raw[column]
+            if values.dtype.kind in 'iu' or (values.dtype == object and values.isnull().all()):
+                gfall_raw[column] = values.astype(np.float64)
+        return gfall_raw
+
+    def read_gfall_parallel(self, fname=None, parse=True):
         """
+        Read gfall with `n_workers` processes
 
+        The file is split on record boundaries into one piece per worker and
+        the pieces are concatenated in file order.
 
-        gfall = gfall_raw if gfall_raw is not None else self.gfall_raw.copy()
-        gfall = gfall.rename(columns={'e_first':'energy_first',
-                                      'e_second':'energy_second'})
-        double_columns = [item.replace('_first', '') for item in gfall.columns if
-                          item.endswith('first')]
+        Parameters
+        ----------
+        fname: ~str
+            path to gfall.dat
+        parse: bool
+            return the parsed DataFrame (see `parse_gfall`) instead of the
+            raw one
 
-        # due to the fact that energy is stored in 1/cm
-        order_lower_upper = (gfall["energy_first"].abs() <
-                             gfall["energy_second"].abs())
+        Returns
+        -------
+            pandas.DataFrame
+                indexed like `gfall_raw`
+        """
+        if fname is None:
+            fname = self.fname
 
-        for column in double_columns:
-            data = pd.concat([gfall['{0}_first'.format(column)][order_lower_upper],
-                              gfall['{0}_second'.format(column)][~order_lower_upper]])
+        logger.info('Parsing GFALL {0} with {1} processes'.format(fname, self.n_workers))
+
+        reader_kwargs = {'unique_level_identifier': self.unique_level_identifier,
+                         'ions': self.ions, 'columns': self.columns}
+        tasks = [(fname, start, stop, reader_kwargs, parse)
+                 for start, stop in split_records(fname, self.n_workers)]
+
+        pool = multiprocessing.Pool(self.n_workers)
+        try:
+            results = pool.map(_read_gfall_range, tasks)
+        finally:
+            pool.close()
+            pool.join()
+
+        offset = 0
+        pieces = list()
+        for n_records, gfall in results:
+            gfall.index += offset
+            offset += n_records
+            pieces.append(gfall)
+
+        if not pieces:
+            gfall_raw = self.read_gfall_records(b'')
+            return self.parse_gfall(gfall_raw) if parse else gfall_raw
+        return pd.concat(pieces)
+
+    def build_index(self, fname=None, blocksize=GFALL_INDEX_BLOCKSIZE):
+        """
+        Map the ions in a gfall file to the byte ranges of their records
+
+        The file is memory-mapped and scanned in blocks; only the
+        `element_code` field of every record is converted.
+
+        Parameters
+        ----------
+        fname: ~str
+            path to gfall.dat
+        blocksize: int
+            number of bytes scanned at once
+
+        Returns
+        -------
+            pandas.DataFrame
+                one row per contiguous block of records of an ion with the
+                columns atomic_number, ion_charge, start, stop (byte offsets),
+                first_record (position of the first record in `gfall_raw`)
+                and n_records
+        """
+        if fname is None:
+            fname = self.fname
 
-            gfall['{0}_lower'.format(column)] = data
+        logger.info('Indexing GFALL {0}'.format(fname))
+
+        fields = parse_fortran_format(self.gfall_fortran_format)
+        code_column = self.gfall_columns.index('element_code')
+        code_start = sum(width for _, width in fields[:code_column])
+        code_width = fields[code_column][1]
+
+        record_starts, record_stops, element_codes = list(), list(), list()
+        raw = np.memmap(fname, dtype=np.uint8, mode='r') if os.path.getsize(fname) else []
+
+        offset = 0
+        while offset < len(raw):
+            block = raw[offset:offset + blocksize]
+            stops = np.flatnonzero(block == ord('\n')) + 1
+            if offset + len(block) < len(raw):
+                if len(stops) == 0:
+                    raise ValueError('No record ends within {0} bytes at offset {1}'.format(
+                        blocksize, offset))
+                block = block[:stops[-1]]
+            elif len(stops) == 0 or stops[-1] != len(block):
+                stops = np.append(stops, len(block))  # last line without a newline
+            starts = np.concatenate([[0], stops[:-1]])
+            line_ends = stops - (block[stops - 1] == ord('\n'))
+
+            field = np.full((code_width, len(starts)), ord(' '), dtype=np.uint8)
+            for i in range(code_width):
+                position = starts + code_start + i
+                inside = position < line_ends
+                field[i, inside] = block[position[inside]]
+
+            record_starts.append(starts + offset)
+            record_stops.append(stops + offset)
+            element_codes.append(convert_fortran_field(field, 'F'))
+            offset += len(block)
+
+        record_starts = np.concatenate(record_starts or [np.array([], dtype=np.int64)])
+        record_stops = np.concatenate(record_stops or [np.array([], dtype=np.int64)])
+        element_codes = np.concatenate(element_codes or [np.array([])])
+
+        # Blank lines are not records
+        is_record = ~np.isnan(element_codes)
+        record_starts = record_starts[is_record]
+        record_stops = record_stops[is_record]
+        element_codes = element_codes[is_record]
+
+        run_starts = np.flatnonzero(np.diff(element_codes) != 0) + 1
+        run_starts = np.concatenate([[0], run_starts]).astype(np.int64)[:len(element_codes)]
+        run_stops = np.append(run_starts[1:], len(element_codes))[:len(run_starts)]
+
+        run_codes = element_codes[run_starts]
+        atomic_number = run_codes.astype(np.int64)
+        index = pd.DataFrame({
+            'atomic_number': atomic_number,
+            'ion_charge': ((run_codes - atomic_number) * 100).round().astype(np.int64),
+            'start': record_starts[run_starts],
+            'stop': record_stops[run_stops - 1],
+            'first_record': run_starts,
+            'n_records': run_stops - run_starts},
+            columns=['atomic_number', 'ion_charge', 'start', 'stop',
+                     'first_record', 'n_records'])
+        return index
 
-            data = pd.concat([gfall['{0}_first'.format(column)][~order_lower_upper], \
-                              gfall['{0}_second'.format(column)][order_lower_upper]])
+    @property
+    def index(self):
+        if self._index is None:
+            self._index = self.read_index()
+        return self._index
+
+    @property
+    def index_fname(self):
+        if self.cache_dir is None:
+            return None
+        path_hash = hashlib.md5(os.path.realpath(self.fname).encode()).hexdigest()
+        return os.path.join(self.cache_dir, 'gfall_index_{0}.h5'.format(path_hash))
 
-            gfall['{0}_upper'.format(column)] = data
+    def read_index(self):
+        """
+        Return the ion index, from `cache_dir` if it was saved there
 
-            del gfall['{0}_first'.format(column)]
-            del gfall['{0}_second'.format(column)]
+        Without `cache_dir` the index is built in memory. Otherwise it is
+        built and saved if the saved index does not exist or was built for a
+        different size or modification time of the file.
+        """
+        if not has_random_access(self.fname):
+            raise ValueError('Only uncompressed gfall files can be indexed')
+
+        if self.index_fname is None:
+            return self.build_index()
+
+        stat = os.stat(self.fname)
+
+        if os.path.exists(self.index_fname):
+            with HDFStore(self.index_fname, mode='r') as store:
+                attrs = store.get_storer('index').attrs
+                if attrs.size == stat.st_size and attrs.mtime == stat.st_mtime:
+                    return store['index']
+            logger.info('The index {0} is outdated'.format(self.index_fname))
+
+        index = self.build_index()
+        tmp_fname = '{0}.{1}.tmp'.format(self.index_fname, os.getpid())
+        try:
+            if not os.path.isdir(self.cache_dir):
+                os.makedirs(self.cache_dir)
+            with HDFStore(tmp_fname, mode='w') as store:
+                store.put('index', index)
+                attrs = store.get_storer('index').attrs
+                attrs.size = stat.st_size
+                attrs.mtime = stat.st_mtime
+            os.rename(tmp_fname, self.index_fname)
+        except (IOError, OSError):
+            logger.warn('The index could not be saved to {0}'.format(self.index_fname))
+        return index
+
+    def read_ions_raw(self, ions):
+        """
+        Parse only the records of the given ions
 
-        # Clean labels
-        gfall["label_lower"] = gfall["label_lower"].str.strip()
-        gfall["label_upper"] = gfall["label_upper"].str.strip()
+        The byte ranges of the ions are taken from `index` and read from the
+        memory-mapped file.
 
-        gfall["label_lower"] = gfall["label_lower"].str.replace('\s+', ' ')
-        gfall["label_upper"] = gfall["label_upper"].str.replace('\s+', ' ')
+        Parameters
+        ----------
+        ions: list of tuples
+            (atomic_number, ion_charge) of the ions
+
+        Returns
+        -------
+            pandas.DataFrame
+                the rows of `gfall_raw` that belong to the ions, with the
+                same index
+        """
+        index = self.index
+        ions = pd.DataFrame.from_records(list(ions), columns=['atomic_number', 'ion_charge'])
+        return self.read_runs_raw(index.merge(ions, on=['atomic_number', 'ion_charge']))
+
+    def read_runs_raw(self, runs):
+        """
+        Parse the records of rows of `index`
+
+        Parameters
+        ----------
+        runs: pandas.DataFrame
+            rows of `index`
+
+        Returns
+        -------
+            pandas.DataFrame
+                the records of the runs in the order of the file, indexed
+                like `gfall_raw`
+        """
+        runs = runs.sort_values('start')
+
+        raw = np.memmap(self.fname, dtype=np.uint8, mode='r') if len(runs) else None
+        data = b''.join([raw[start:stop].tobytes() + b'\n'
+                         for start, stop in runs[['start', 'stop']].values])
+        gfall_raw = self.read_gfall_records(data)
+
+        gfall_raw.index = np.concatenate(
+            [np.arange(first_record, first_record + n_records)
+             for first_record, n_records in runs[['first_record', 'n_records']].values] or
+            [np.array([], dtype=np.int64)])
+        return gfall_raw
+
+    def iter_gfall_raw(self, chunksize=GFALL_CHUNKSIZE, fname=None):
+        """
+        Read gfall in chunks of lines
+
+        Parameters
+        ----------
+        chunksize: int
+            number of lines read at once
+        fname: ~str or file-like
+            path to gfall.dat, optionally compressed, or an open file
+
+        Yields
+        -------
+            pandas.DataFrame
+                raw gfall chunks, indexed like `gfall_raw`
+        """
+        if fname is None:
+            fname = self.fname
+
+        logger.info('Parsing GFALL {0} in chunks of {1} lines'.format(fname, chunksize))
+
+        offset = 0
+        with open_gfall(fname) as f:
+            while True:
+                chunk_lines = list(islice(f, chunksize))
+                if not chunk_lines:
+                    break
+                if isinstance(chunk_lines[0], bytes):
+                    data = b''.join(chunk_lines)
+                else:
+                    data = u''.join(chunk_lines).encode('ascii')  # file opened in text mode
+                gfall_raw = self.read_gfall_records(data)
+                gfall_raw.index += offset
+                offset += len(gfall_raw)
+                yield self.select_ions(gfall_raw)
+
+    def parse_gfall(self, gfall_raw=None):
+        """
+        Parse raw gfall DataFrame
+
+        Parameters
+        ----------
+        gfall_raw: pandas.DataFrame
+
+        Returns
+        -------
+            pandas.DataFrame
+                a level DataFrame
+        """
+
+
+        if (gfall_raw is None and self._gfall_raw is None and self.ions is None and
+                self.n_workers is not None and self.n_workers > 1 and
+                has_random_access(self.fname)):
+            return self.read_gfall_parallel(parse=True)
+
+        gfall = gfall_raw if gfall_raw is not None else self.gfall_raw
+        renamed_columns = {'e_first':'energy_first', 'e_second':'energy_second'}
+        gfall_columns = [renamed_columns.get(column, column) for column in gfall.columns]
+        values = dict((renamed_columns.get(column, column), gfall[column].values)
+                      for column in gfall.columns)
+        double_columns = [item.replace('_first', '') for item in gfall_columns if
+                          item.endswith('first') and
+                          item.replace('_first', '_second') in values]
+
+        # due to the fact that energy is stored in 1/cm
+        order_lower_upper = (np.abs(values["energy_first"]) <
+                             np.abs(values["energy_second"]))
+
+        # Select every lower/upper pair in a single pass instead of aligning
+        # partial Series on the index
+        paired_columns = set()
+        for column in double_columns:
+            paired_columns.update(['{0}_first'.format(column),
+                                   '{0}_second'.format(column)])
+        data = [(column, values[column]) for column in gfall_columns
+                if column not in paired_columns]
+        for column in double_columns:
+            first = values['{0}_first'.format(column)]
+            second = values['{0}_second'.format(column)]
+            data.append(('{0}_lower'.format(column),
+                         np.where(order_lower_upper, first, second)))
+            data.append(('{0}_upper'.format(column),
+                         np.where(order_lower_upper, second, first)))
+        data = dict(data)
+        columns = [column for column in gfall_columns if column not in paired_columns]
+        for column in double_columns:
+            columns += ['{0}_lower'.format(column), '{0}_upper'.format(column)]
+
+        # Clean labels: normalize each distinct label only once and encode
+        # the lower and upper labels with the same sorted categories
+        n_lines = len(gfall)
+        label_codes, labels = pd.factorize(
+            np.concatenate([data["label_lower"], data["label_upper"]]))
+        labels = pd.Series(labels, dtype=object).str.strip().str.replace('\s+', ' ').values
+        categories = pd.Index(np.unique(labels))
+        label_codes = np.where(label_codes >= 0,
+                               categories.get_indexer(labels)[label_codes], -1)
 
         # Ignore lines with the labels "AVARAGE ENERGIES" and "CONTINUUM"
         ignored_labels = ["AVERAGE", "ENERGIES", "CONTINUUM"]
-        gfall = gfall.loc[~((gfall["label_lower"].isin(ignored_labels)) |
-                            (gfall["label_upper"].isin(ignored_labels)))].copy()
-
-        gfall['energy_lower_predicted'] = gfall["energy_lower"] < 0
-        gfall["energy_lower"] = gfall["energy_lower"].abs()
-        gfall['energy_upper_predicted'] = gfall["energy_upper"] < 0
-        gfall["energy_upper"] = gfall["energy_upper"].abs()
+        ignored_codes = categories.get_indexer(ignored_labels)
+        ignored = np.in1d(label_codes, ignored_codes[ignored_codes >= 0])
+        selected = ~(ignored[:n_lines] | ignored[n_lines:])
+
+        for column in columns:
+            data[column] = data[column][selected]
+        # The categories depend on the records at hand, so plain strings are
+        # returned to keep chunks, pieces and ion subsets comparable
+        data["label_lower"] = np.asarray(pd.Categorical.from_codes(
+            label_codes[:n_lines][selected], categories))
+        data["label_upper"] = np.asarray(pd.Categorical.from_codes(
+            label_codes[n_lines:][selected], categories))
+
+        energy_lower = data["energy_lower"]
+        energy_upper = data["energy_upper"]
+        data['energy_lower_predicted'] = energy_lower < 0
+        data["energy_lower"] = np.abs(energy_lower)
+        data['energy_upper_predicted'] = energy_upper < 0
+        data["energy_upper"] = np.abs(energy_upper)
+
+        element_code = data.pop('element_code')
+        data['atomic_number'] = element_code.astype(int)
+        data['ion_charge'] = ((element_code -
+                               data['atomic_number']) * 100).round().astype(int)
+
+        columns.remove('element_code')
+        columns += ['energy_lower_predicted', 'energy_upper_predicted',
+                    'atomic_number', 'ion_charge']
+
+        return pd.DataFrame(data, index=gfall.index[selected], columns=columns)
+
+    def merge_close_energies(self, gfall):
+        """
+        Give the same energy to the levels that differ only by round-off
 
-        gfall['atomic_number'] = gfall.element_code.astype(int)
-        gfall['ion_charge'] = ((gfall.element_code.values -
-                                gfall.atomic_number.values) * 100).round().astype(int)
+        The lower and upper levels of every ion are sorted by energy within
+        groups of equal other unique level identifiers (e.g. `j`). A level
+        starts at the lowest energy not yet assigned and takes all energies
+        up to `energy_tolerance` above it, so a chain of energies that are
+        each within the tolerance of their neighbour is split instead of
+        merged into one level. Every level takes the energy of its first
+        occurrence in `gfall`.
 
-        del gfall['element_code']
+        Parameters
+        ----------
+        gfall: pandas.DataFrame
 
-        return gfall
+        Returns
+        -------
+            tuple
+                (gfall with the merged energies, DataFrame of the merged
+                levels with their original `energy` and the `merged_energy`)
+        """
+        other_level_id = [item for item in self.unique_level_identifier if item != 'energy']
+        n_lines = len(gfall)
+
+        energy = np.concatenate([gfall['energy_lower'].values, gfall['energy_upper'].values])
+        level_groups = dict([(column, np.tile(gfall[column].values, 2))
+                             for column in ['atomic_number', 'ion_charge']])
+        for column in other_level_id:
+            level_groups[column] = np.concatenate([gfall[column + '_lower'].values,
+                                                   gfall[column + '_upper'].values])
+        group_codes = _factorize_keys(
+            [level_groups[column] for column in ['atomic_number', 'ion_charge'] + other_level_id])
+
+        order = np.lexsort([energy, group_codes])
+        sorted_energy = energy[order]
+        new_level = np.ones(len(order), dtype=bool)
+        # Missing energies compare False and start a level of their own
+        new_level[1:] = ((group_codes[order][1:] != group_codes[order][:-1]) |
+                         ~(np.diff(sorted_energy) <= self.energy_tolerance))
+
+        # Chains of neighbours that span more than the tolerance are rare, only
+        # they are split level by level
+        starts = np.flatnonzero(new_level)
+        stops = np.append(starts[1:], len(order))
+        chains = sorted_energy[stops - 1] - sorted_energy[starts] > self.energy_tolerance
+        for start, stop in zip(starts[chains], stops[chains]):
+            chain_energy = sorted_energy[start:stop]
+            level_start = 0
+            while True:
+                level_start = np.searchsorted(
+                    chain_energy, chain_energy[level_start] + self.energy_tolerance, side='right')
+                if level_start >= len(chain_energy):
+                    break
+                new_level[start + level_start] = True
+
+        level_codes = np.empty(len(order), dtype=np.int64)
+        level_codes[order] = np.cumsum(new_level) - 1
+
+        first = np.full(len(order), len(order), dtype=np.int64)
+        np.minimum.at(first, level_codes, np.arange(len(order)))
+        merged_energy = energy[first[level_codes]]
+
+        merged = (merged_energy != energy) & ~np.isnan(energy)
+        merged_levels = pd.DataFrame(
+            dict([(column, values[merged]) for column, values in level_groups.items()] +
+                 [('energy', energy[merged]), ('merged_energy', merged_energy[merged])]),
+            columns=['atomic_number', 'ion_charge'] + other_level_id + ['energy', 'merged_energy'])
+        merged_levels = merged_levels.drop_duplicates().reset_index(drop=True)
+
+        gfall = gfall.copy()
+        gfall['energy_lower'] = merged_energy[:n_lines]
+        gfall['energy_upper'] = merged_energy[n_lines:]
+        return gfall, merged_levels
 
     def extract_levels(self, gfall=None, selected_columns=None):
         """
@@ -221,42 +1043,64 @@ class GFALLReader(object):
         if gfall is None:
             gfall = self.gfall
 
+        if self.energy_tolerance is not None:
+            gfall, merged_levels = self.merge_close_energies(gfall)
+            if len(merged_levels) > 0:
+                logger.info('Merged {0} levels with the energy of a level within {1} 1/cm'.format(
+                    len(merged_levels), self.energy_tolerance))
+
         if selected_columns is None:
             selected_columns = ['atomic_number', 'ion_charge', 'energy', 'j',
                                 'label', 'theoretical']
 
         column_renames = {'energy_{0}': 'energy', 'j_{0}': 'j', 'label_{0}': 'label',
                           'energy_{0}_predicted': 'theoretical'}
+        column_sources = dict([(value, key) for key, value in column_renames.items()])
+
+        # Stack the lower and upper levels column by column
+        levels = dict()
+        for column in selected_columns:
+            if column in column_sources:
+                levels[column] = np.concatenate([
+                    gfall[column_sources[column].format('lower')].values,
+                    gfall[column_sources[column].format('upper')].values])
+            else:
+                levels[column] = np.tile(gfall[column].values, 2)
 
-        e_lower_levels = gfall.rename(
-            columns=dict([(key.format('lower'), value)
-                          for key, value in column_renames.items()]))
-
-        e_upper_levels = gfall.rename(
-            columns=dict([(key.format('upper'), value)
-                          for key, value in column_renames.items()]))
-
-        levels = pd.concat([e_lower_levels[selected_columns],
-                            e_upper_levels[selected_columns]])
         unique_level_id = ['atomic_number', 'ion_charge'] + self.unique_level_identifier
 
-        levels.drop_duplicates(unique_level_id, inplace=True)
-        levels = levels.sort_values(['atomic_number', 'ion_charge', 'energy',
-                                     'j', 'label'])
-
-        levels["method"] = levels["theoretical"].\
-            apply(lambda x: "theor" if x else "meas")  # Theoretical or measured
-        levels.drop("theoretical", 1, inplace=True)
-
-        levels["level_index"] = levels.groupby(['atomic_number', 'ion_charge'])['j'].\
-            transform(lambda x: np.arange(len(x), dtype=np.int64)).values
-        levels["level_index"] = levels["level_index"].astype(int)
-
-        # ToDo: The commented block below does not work with all lines. Find a way to parse it.
-        # levels[["configuration", "term"]] = levels["label"].str.split(expand=True)
-        # levels["configuration"] = levels["configuration"].str.strip()
-        # levels["term"] = levels["term"].str.strip()
-
+        # Drop the duplicate levels, keeping the first occurrence. The key
+        # columns are hashed into a single integer code; codes are numbered in
+        # order of appearance, so a level occurs first where its code exceeds
+        # all the previous ones
+        level_codes = _factorize_keys([levels[column] for column in unique_level_id])
+        first = np.ones(len(level_codes), dtype=bool)
+        first[1:] = np.diff(np.maximum.accumulate(level_codes)) > 0
+        selected = np.flatnonzero(first)
+
+        sort_columns = ['atomic_number', 'ion_charge', 'energy', 'j', 'label']
+        sort_keys = [_sort_key(levels[column][selected]) for column in sort_columns]
+        selected = selected[np.lexsort(sort_keys[::-1])]
+        levels = dict([(column, values[selected]) for column, values in levels.items()])
+
+        theoretical = levels.pop("theoretical")
+        levels["method"] = np.where(theoretical, "theor", "meas").astype(object)  # Theoretical or measured
+
+        # Number the levels of each ion
+        atomic_number, ion_charge = levels["atomic_number"], levels["ion_charge"]
+        ion_start = np.ones(len(selected), dtype=bool)
+        ion_start[1:] = ((atomic_number[1:] != atomic_number[:-1]) |
+                         (ion_charge[1:] != ion_charge[:-1]))
+        ion_start = np.flatnonzero(ion_start)
+        levels["level_index"] = np.arange(len(selected), dtype=np.int64) - \
+            np.repeat(ion_start, np.diff(np.append(ion_start, len(selected))))
+
+        columns = [column for column in selected_columns if column != "theoretical"]
+        if "label" in levels:
+            levels["configuration"], levels["term"] = parse_gfall_labels(levels["label"])
+            columns.insert(columns.index("label") + 1, "configuration")
+            columns.insert(columns.index("label") + 2, "term")
+        levels = pd.DataFrame(levels, columns=columns + ["method", "level_index"])
         levels.set_index(["atomic_number", "ion_charge", "level_index"], inplace=True)
         return levels
 
@@ -267,6 +1111,8 @@ class GFALLReader(object):
         Parameters
         ----------
         gfall: pandas.DataFrame
+        levels: pandas.DataFrame
+            levels of `gfall` as returned by `extract_levels`
         selected_columns: list
             list of which columns to select (optional - default=None which selects
             a default set of columns)
@@ -282,6 +1128,9 @@ class GFALLReader(object):
         if levels is None:
             levels = self.levels
 
+        if self.energy_tolerance is not None:
+            gfall, _ = self.merge_close_energies(gfall)
+
         if selected_columns is None:
             selected_columns = ['atomic_number', 'ion_charge']
             selected_columns += [item + '_lower' for item in self.unique_level_identifier]
@@ -290,31 +1139,288 @@ class GFALLReader(object):
 
 
         logger.info('Extracting line data: {0}'.format(', '.join(selected_columns)))
-        unique_level_id = ['atomic_number', 'ion_charge'] + self.unique_level_identifier
-        levels_idx = levels.reset_index()
-        levels_idx = levels_idx.set_index(unique_level_id)
+        level_id_lower = [item + '_lower' for item in self.unique_level_identifier]
+        level_id_upper = [item + '_upper' for item in self.unique_level_identifier]
+
+        # Assigning levels to lines: the keys of the levels and of both line
+        # endpoints are encoded together, so that one lookup table maps them
+        # to the level index
+        n_levels, n_lines = len(levels), len(gfall)
+        keys = [np.concatenate([levels.index.get_level_values(column).values,
+                                gfall[column].values, gfall[column].values])
+                for column in ['atomic_number', 'ion_charge']]
+        keys += [np.concatenate([levels[column].values,
+                                 gfall[column_lower].values, gfall[column_upper].values])
+                 for column, column_lower, column_upper in zip(
+                     self.unique_level_identifier, level_id_lower, level_id_upper)]
+        codes = _factorize_keys(keys)
+
+        level_index = np.full(len(codes), -1, dtype=np.int64)
+        level_index[codes[:n_levels]] = levels.index.get_level_values('level_index').values
+        level_index_lower = level_index[codes[n_levels:n_levels + n_lines]]
+        level_index_upper = level_index[codes[n_levels + n_lines:]]
+        if (level_index_lower < 0).any() or (level_index_upper < 0).any():
+            # Lines with unknown levels get a missing level index
+            level_index_lower = np.where(level_index_lower < 0, np.nan, level_index_lower)
+            level_index_upper = np.where(level_index_upper < 0, np.nan, level_index_upper)
+
+        columns = level_id_upper + level_id_lower
+        columns += [column for column in selected_columns if column not in
+                    ['atomic_number', 'ion_charge', 'loggf'] + columns]
+        lines = dict([(column, gfall[column].values) for column in columns])
+        lines["gf"] = np.power(10, gfall["loggf"].values)
+
+        index = pd.MultiIndex.from_arrays(
+            [gfall['atomic_number'].values, gfall['ion_charge'].values,
+             level_index_lower, level_index_upper],
+            names=['atomic_number', 'ion_charge', 'level_index_lower', 'level_index_upper'])
+        lines = pd.DataFrame(lines, index=index, columns=columns + ["gf"])
 
-        lines = gfall[selected_columns].copy()
-        lines["gf"] = np.power(10, lines["loggf"])
-        lines = lines.drop(["loggf"], 1)
+        return lines
 
-        # Assigning levels to lines
+    def iter_chunks(self, chunksize=GFALL_CHUNKSIZE):
+        """
+        Iterate over parsed gfall chunks
 
-        levels_unique_idxed = self.levels.reset_index().set_index(['atomic_number', 'ion_charge'] + self.unique_level_identifier)
+        Only one chunk of the file is held in memory at a time.
 
-        lines_lower_unique_idx = (['atomic_number', 'ion_charge'] +
-                                  [item + '_lower' for item in self.unique_level_identifier])
-        lines_upper_unique_idx = (['atomic_number', 'ion_charge'] +
-                                  [item + '_upper' for item in self.unique_level_identifier])
-        lines_lower_idx = lines.set_index(lines_lower_unique_idx)
-        lines_lower_idx['level_index_lower'] = levels_unique_idxed['level_index']
-        lines_upper_idx = lines_lower_idx.reset_index().set_index(lines_upper_unique_idx)
-        lines_upper_idx['level_index_upper'] = levels_unique_idxed['level_index']
-        lines = lines_upper_idx.reset_index().set_index(
-            ['atomic_number', 'ion_charge', 'level_index_lower', 'level_index_upper'])
+        Parameters
+        ----------
+        chunksize: int
+            number of lines read at once
 
+        Yields
+        -------
+            pandas.DataFrame
+                parsed gfall chunks, see `parse_gfall`
+        """
+        for gfall_raw in self.iter_gfall_raw(chunksize):
+            yield self.parse_gfall(gfall_raw)
 
-        return lines
+    def iter_ions(self, chunksize=GFALL_CHUNKSIZE):
+        """
+        Iterate over the levels and lines of one ion at a time
+
+        The records of an ion need not be contiguous, e.g. in a file sorted
+        by wavelength. Uncompressed files are read ion by ion from the byte
+        ranges in `index`, so only the records of one ion are held in memory.
+        Compressed and open files are parsed in chunks and grouped by ion.
+        The ions are yielded in the order of their first record and level
+        indexes are the same as in `levels`.
+
+        Parameters
+        ----------
+        chunksize: int
+            number of lines read at once from compressed and open files
+
+        Yields
+        -------
+            tuple
+                ((atomic_number, ion_charge), levels, lines) with the same
+                DataFrame layout as `levels` and `lines`
+        """
+        if has_random_access(self.fname):
+            index = self.index
+            if self.ions is not None:
+                index = index.loc[pd.MultiIndex.from_arrays(
+                    [index['atomic_number'], index['ion_charge']]).isin(self.ions)]
+            ion_runs = index.groupby(['atomic_number', 'ion_charge'], sort=False)
+            ion_gfalls = ((ion, self.parse_gfall(self.read_runs_raw(runs)))
+                          for ion, runs in ion_runs)
+        else:
+            chunks = [self._gfall] if self._gfall is not None else list(self.iter_chunks(chunksize))
+            ion_gfalls = list()
+            if chunks:
+                ion_gfalls = pd.concat(chunks).groupby(['atomic_number', 'ion_charge'], sort=False)
+
+        for ion, gfall in ion_gfalls:
+            levels = self.extract_levels(gfall)
+            lines = self.extract_lines(gfall, levels)
+            yield ion, levels, lines
+
+
+class GFALLMultiReader(GFALLReader):
+    """
+        Class for extracting lines and levels data from several kurucz gf files
+
+        Every file is parsed by its own `GFALLReader`, in parallel if
+        `n_workers` is given, and the parsed records are merged into one
+        `gfall` DataFrame. `levels` and `lines` are extracted from the merged
+        records, so there is one level index per ion.
+
+        Lines that are found in more than one file, i.e. with the same ion,
+        lower and upper level and wavelength, are kept from the first file
+        only. If the gf value of such a line differs between the files, the
+        duplicate is conflicting and a ValueError is raised.
+
+        Attributes
+        ----------
+        fnames: list of paths to the gf files
+
+        Methods
+        --------
+        read_gfall_files:
+            Return the parsed gfall DataFrames of the files
+
+        merge_gfall(gfalls):
+            Merge parsed gfall DataFrames and drop the duplicate lines
+
+    """
+
+    def __init__(self, fnames, unique_level_identifier=None, cache_dir=None, n_workers=None,
+                 ions=None, columns=None, energy_tolerance=None):
+        """
+
+        Parameters
+        ----------
+        fnames: list or str
+            paths to the gf files (or open files), or a glob pattern
+
+        The other parameters are those of `GFALLReader`; `cache_dir` caches
+        every file and the merged DataFrames.
+        """
+        fnames = expand_gfall_fnames(fnames)
+        if cache_dir is not None and any(hasattr(fname, 'read') for fname in fnames):
+            logger.warn('Open gfall files can not be cached, give the paths instead.')
+            cache_dir = None
+        super(GFALLMultiReader, self).__init__(fnames, unique_level_identifier, cache_dir,
+                                               n_workers, ions, columns, energy_tolerance)
+        self.fnames = fnames
+
+    @property
+    def reader_kwargs(self):
+        return {'unique_level_identifier': self.unique_level_identifier,
+                'cache_dir': self.cache_dir, 'ions': self.ions, 'columns': self.columns}
+
+    @property
+    def cache_key(self):
+        """ MD5 hash of the cache keys of all files """
+        if self._cache_key is None:
+            md5_hash = hashlib.md5()
+            for fname in self.fnames:
+                md5_hash.update(GFALLReader(fname, **self.reader_kwargs).cache_key.encode())
+            md5_hash.update('energy_tolerance={0}'.format(self.energy_tolerance).encode())
+            self._cache_key = md5_hash.hexdigest()
+        return self._cache_key
+
+    @property
+    def index(self):
+        raise ValueError('Several gfall files can not be indexed, index each file instead')
+
+    def read_gfall_raw(self, fname=None, engine='numpy'):
+        """ Read the raw records of one of the files, see `GFALLReader.read_gfall_raw` """
+        if fname is None:
+            raise ValueError('The raw records are not merged, give the name of one of the files')
+        return super(GFALLMultiReader, self).read_gfall_raw(fname, engine)
+
+    def read_gfall_files(self):
+        """
+        Parse the files with `n_workers` processes
+
+        Returns
+        -------
+            list of pandas.DataFrame
+                the parsed gfall DataFrame of every file
+        """
+        tasks = [(fname, self.reader_kwargs) for fname in self.fnames]
+        open_files = any(hasattr(fname, 'read') for fname in self.fnames)
+        if self.n_workers is None or self.n_workers < 2 or len(tasks) < 2 or open_files:
+            return [_read_gfall_file(task) for task in tasks]
+
+        logger.info('Parsing {0} GFALL files with {1} processes'.format(
+            len(tasks), self.n_workers))
+
+        pool = multiprocessing.Pool(min(self.n_workers, len(tasks)))
+        try:
+            return pool.map(_read_gfall_file, tasks)
+        finally:
+            pool.close()
+            pool.join()
+
+    def merge_gfall(self, gfalls):
+        """
+        Merge parsed gfall DataFrames and drop the lines found in earlier ones
+
+        Parameters
+        ----------
+        gfalls: list of pandas.DataFrame
+            parsed gfall DataFrames, in order of precedence
+
+        Returns
+        -------
+            pandas.DataFrame
+                the records of all DataFrames with a new index
+        """
+        file_number = np.repeat(np.arange(len(gfalls)), [len(gfall) for gfall in gfalls])
+        gfall = pd.concat(gfalls, ignore_index=True)
+
+        line_id = ['atomic_number', 'ion_charge']
+        line_id += [item + '_lower' for item in self.unique_level_identifier]
+        line_id += [item + '_upper' for item in self.unique_level_identifier]
+        line_id += ['wavelength']
+        line_codes = _factorize_keys([gfall[column].values for column in line_id
+                                      if column in gfall.columns])
+        data_codes = line_codes
+        if 'loggf' in gfall.columns:
+            data_codes = _factorize_keys([line_codes, gfall['loggf'].values])
+
+        # The first file of every line and of every line with its gf value
+        line_first_file = np.full(len(gfall), len(gfalls), dtype=np.int64)
+        np.minimum.at(line_first_file, line_codes, file_number)
+        data_first_file = np.full(len(gfall), len(gfalls), dtype=np.int64)
+        np.minimum.at(data_first_file, data_codes, file_number)
+
+        conflicting = data_first_file[data_codes] != line_first_file[line_codes]
+        if conflicting.any():
+            ions = gfall.loc[conflicting, ['atomic_number', 'ion_charge']].drop_duplicates()
+            raise ValueError('{0} lines of {1} have different gf values in different files'.format(
+                conflicting.sum(), ', '.join(['{0} {1}'.format(
+                    convert_atomic_number2symbol(atomic_number), ion_charge)
+                    for atomic_number, ion_charge in ions.values])))
+
+        duplicate = file_number > line_first_file[line_codes]
+        if duplicate.any():
+            logger.info('Dropping {0} lines that are found in more than one file'.format(
+                duplicate.sum()))
+            gfall = gfall.loc[~duplicate].reset_index(drop=True)
+        return gfall
+
+    def parse_gfall(self, gfall_raw=None):
+        """
+        Parse and merge the files, or parse raw records of one of the files
+
+        Parameters
+        ----------
+        gfall_raw: pandas.DataFrame
+
+        Returns
+        -------
+            pandas.DataFrame
+        """
+        if gfall_raw is not None:
+            return super(GFALLMultiReader, self).parse_gfall(gfall_raw)
+        return self.merge_gfall(self.read_gfall_files())
+
+    def iter_chunks(self, chunksize=GFALL_CHUNKSIZE):
+        """ Yield the merged `gfall` as one chunk; duplicates are only found in all records """
+        yield self.gfall
+
+    def iter_ions(self, chunksize=GFALL_CHUNKSIZE):
+        """
+        Iterate over the levels and lines of one ion at a time
+
+        The records of an ion may be spread over the files, so the merged
+        `gfall` is read as a whole.
+
+        Yields
+        -------
+            tuple
+                ((atomic_number, ion_charge), levels, lines)
+        """
+        for ion, gfall in self.gfall.groupby(['atomic_number', 'ion_charge']):
+            levels = self.extract_levels(gfall)
+            lines = self.extract_lines(gfall, levels)
+            yield ion, levels, lines
 
 
 class GFALLIngester(object):
@@ -324,13 +1430,30 @@ class GFALLIngester(object):
         Attributes
         ----------
         session: SQLAlchemy session
-        fname: str
-            The name of the gfall file to read
+        fname: str or list
+            The name of the gfall file to read, optionally compressed
+            (.gz, .bz2, .xz). Several files, given as a list or a glob
+            pattern, are merged (see `GFALLMultiReader`)
         ions: str
             Ingest levels and lines only for these ions. If set to None then ingest all.
             (default: None)
         data_source: DataSource instance
             The data source of the ingester
+        cache_dir: str
+            Directory for the cache of the parsed gfall file
+            (default: None, no cache)
+        n_workers: int
+            Number of processes that parse the gfall file
+            (default: None, parse in this process)
+        energy_tolerance: float
+            Merge the levels of an ion whose energies differ by at most this
+            value [1/cm] (default: None, no merging)
+        batch_size: int
+            Flush the session and expunge the ingested objects every `batch_size`
+            objects and after every ion (default: None, only after every ion
+            if `commit` is set, otherwise the session is left as it is)
+        commit: bool
+            Commit the session every time it is flushed (default: False)
 
         gfall_reader : GFALLReaderinstance
 
@@ -339,42 +1462,82 @@ class GFALLIngester(object):
         ingest(session)
             Persists data into the database
     """
-    def __init__(self, session, fname, ions=None, ds_short_name="ku_latest"):
+    def __init__(self, session, fname, ions=None, ds_short_name="ku_latest",
+                 cache_dir=None, n_workers=None, energy_tolerance=None,
+                 batch_size=None, commit=False):
         self.session = session
-        self.gfall_reader = GFALLReader(fname)
+        self.batcher = SessionBatcher(session, batch_size=batch_size, commit=commit)
         if ions is not None:
             try:
                 ions = parse_selected_species(ions)
             except ParseException:
                 raise ValueError('Input is not a valid species string {}'.format(ions))
-            ions = pd.DataFrame.from_records(ions, columns=["atomic_number", "ion_charge"])
-            self.ions = ions.set_index(['atomic_number', 'ion_charge'])
+            self.ions = pd.DataFrame.from_records(ions, columns=["atomic_number", "ion_charge"]).\
+                set_index(['atomic_number', 'ion_charge'])
         else:
             self.ions = None
 
+        fnames = expand_gfall_fnames(fname)
+        if len(fnames) > 1:
+            self.gfall_reader = GFALLMultiReader(fnames, cache_dir=cache_dir, n_workers=n_workers,
+                                                 ions=ions, columns=GFALLReader.gfall_ingest_columns,
+                                                 energy_tolerance=energy_tolerance)
+        else:
+            self.gfall_reader = GFALLReader(fnames[0], cache_dir=cache_dir, n_workers=n_workers,
+                                            ions=ions, columns=GFALLReader.gfall_ingest_columns,
+                                            energy_tolerance=energy_tolerance)
+
         self.data_source = DataSource.as_unique(self.session, short_name=ds_short_name)
         if self.data_source.data_source_id is None:  # To get the id if a new data source was created
             self.session.flush()
 
-    def get_lvl_index2id(self, ion):
-        """ Return a DataFrame that maps levels indexes to ids """
-
-        q_ion_lvls = self.session.query(Level.level_id.label("id"),
-                                        Level.level_index.label("index")). \
-            filter(and_(Level.ion == ion,
-                        Level.data_source == self.data_source))
-
-        lvl_index2id = list()
-        for id, index in q_ion_lvls:
-            lvl_index2id.append((index, id))
+    def add_ions(self, index):
+        """ Create the ions of a levels or lines index that are not in the database yet """
+        ions = index.droplevel(list(range(2, index.nlevels))).unique()
+        for atomic_number, ion_charge in ions:
+            Ion.as_unique(self.session, atomic_number=int(atomic_number), ion_charge=int(ion_charge))
+        self.session.flush()
 
-        lvl_index2id_dtype = [("index", np.int), ("id", np.int)]
-        lvl_index2id = np.array(lvl_index2id, dtype=lvl_index2id_dtype)
-        lvl_index2id = pd.DataFrame.from_records(lvl_index2id, index="index")
-
-        return lvl_index2id
+    def get_line_level_ids(self, lines):
+        """
+        Return the ids of the lower and upper levels of the lines
 
-    def ingest_levels(self, levels=None):
+        The ids are looked up in one `LevelIdMap` of the ions of the lines.
+        An IngesterError lists all levels that have not been ingested.
+        """
+        lines = lines.reset_index()
+        level_ids = LevelIdMap(self.session, self.data_source,
+                               atomic_numbers=lines["atomic_number"].unique())
+
+        atomic_number = np.tile(lines["atomic_number"].values, 2)
+        ion_charge = np.tile(lines["ion_charge"].values, 2)
+        level_index = np.concatenate([lines["level_index_lower"].values,
+                                      lines["level_index_upper"].values])
+        lower_level_ids, upper_level_ids = np.split(
+            level_ids.get_ids(atomic_number, ion_charge, level_index), 2)
+        return lower_level_ids, upper_level_ids
+
+    def ingest_levels_bulk(self, levels):
+        """ Insert the levels and their energies with `BulkInserter` """
+        self.add_ions(levels.index)
+        levels = levels.reset_index()
+        inserter = BulkInserter(self.session)
+
+        level_ids = inserter.insert(Level, {
+            "atomic_number": levels["atomic_number"],
+            "ion_charge": levels["ion_charge"],
+            "level_index": levels["level_index"],
+            "J": levels["j"],
+            "data_source_id": self.data_source.data_source_id
+        })
+        inserter.insert(LevelEnergy, {
+            "level_id": level_ids,
+            "_value": to_model_unit(LevelEnergy, levels["energy"].values * u.cm**-1),
+            "method": levels["method"],
+            "data_source_id": self.data_source.data_source_id
+        })
+
+    def ingest_levels(self, levels=None, bulk=False):
 
         if levels is None:
             levels = self.gfall_reader.levels
@@ -388,6 +1551,11 @@ class GFALLIngester(object):
 
         print("Ingesting levels from {}".format(self.data_source.short_name))
 
+        if bulk:
+            self.ingest_levels_bulk(levels)
+            self.batcher.release()
+            return
+
         for ion_index, ion_levels in levels.groupby(level=["atomic_number", "ion_charge"]):
 
             atomic_number, ion_charge = ion_index
@@ -399,18 +1567,47 @@ class GFALLIngester(object):
 
                 level_index = index[2]  # index: (atomic_number, ion_charge, level_index)
 
-                ion.levels.append(
-                    Level(level_index=level_index,
+                # Not appended to `ion.levels`, which would keep all levels of the ion in memory
+                self.batcher.add(
+                    Level(ion=ion,
+                          level_index=level_index,
                           data_source=self.data_source,
                           J=row["j"],
                           energies=[
-                              LevelEnergy(quantity=row["energy"]*u.Unit("cm-1"),
+                              LevelEnergy(quantity=row["energy"]*u.cm**-1,
                                           method=row["method"],
                                           data_source=self.data_source)
                           ])
                 )
 
-    def ingest_lines(self, lines=None):
+            self.batcher.release()
+
+    def ingest_lines_bulk(self, lines):
+        """ Insert the lines and their wavelengths and gf values with `BulkInserter` """
+        self.add_ions(lines.index)
+        lower_level_ids, upper_level_ids = self.get_line_level_ids(lines)
+
+        inserter = BulkInserter(self.session)
+        line_ids = inserter.insert(Line, {
+            "lower_level_id": lower_level_ids,
+            "upper_level_id": upper_level_ids,
+            "data_source_id": self.data_source.data_source_id
+        })
+
+        wavelength = lines["wavelength"].values
+        inserter.insert(LineWavelength, {
+            "line_id": line_ids,
+            "_value": to_model_unit(LineWavelength, wavelength * u.nm),
+            "medium": np.where(wavelength <= GFALL_AIR_THRESHOLD, MEDIUM_VACUUM, MEDIUM_AIR),
+            "data_source_id": self.data_source.data_source_id
+        })
+        inserter.insert(LineGFValue, {
+            "line_id": line_ids,
+            "_value": lines["gf"].values,
+            "data_source_id": self.data_source.data_source_id
+        })
+
+    def ingest_lines(self, lines=None, bulk=False):
 
         if lines is None:
             lines = self.gfall_reader.lines
@@ -424,33 +1621,29 @@ class GFALLIngester(object):
 
         print("Ingesting lines from {}".format(self.data_source.short_name))
 
+        if bulk:
+            self.ingest_lines_bulk(lines)
+            self.batcher.release()
+            return
+
+        lines = lines.copy()
+        lines["lower_level_id"], lines["upper_level_id"] = self.get_line_level_ids(lines)
+
         for ion_index, ion_lines in lines.groupby(level=["atomic_number", "ion_charge"]):
 
             atomic_number, ion_charge = ion_index
-            ion = Ion.as_unique(self.session, atomic_number=atomic_number, ion_charge=ion_charge)
+            Ion.as_unique(self.session, atomic_number=atomic_number, ion_charge=ion_charge)
 
             print("Ingesting lines for {} {}".format(convert_atomic_number2symbol(atomic_number), ion_charge))
 
-            lvl_index2id = self.get_lvl_index2id(ion)
-
             for index, row in ion_lines.iterrows():
 
-                # index: (atomic_number, ion_charge, lower_level_index, upper_level_index)
-                lower_level_index, upper_level_index = index[2:]
-
-                try:
-                    lower_level_id = int(lvl_index2id.loc[lower_level_index])
-                    upper_level_id = int(lvl_index2id.loc[upper_level_index])
-                except KeyError:
-                    raise IngesterError("Levels from this source have not been found."
-                                        "You must ingest levels before transitions")
-
                 medium = MEDIUM_VACUUM if row["wavelength"] <= GFALL_AIR_THRESHOLD else MEDIUM_AIR
 
                 # Create a new line
                 line = Line(
-                    lower_level_id=lower_level_id,
-                    upper_level_id=upper_level_id,
+                    lower_level_id=int(row["lower_level_id"]),
+                    upper_level_id=int(row["upper_level_id"]),
                     data_source=self.data_source,
                     wavelengths=[
                         LineWavelength(quantity=row["wavelength"] * u.nm,
@@ -463,16 +1656,92 @@ class GFALLIngester(object):
                     ]
                 )
 
-                self.session.add(line)
+                self.batcher.add(line)
+
+            self.batcher.release()
 
-    def ingest(self, levels=True, lines=True):
+    def ingest(self, levels=True, lines=True, chunksize=None, bulk=False, pipeline=False,
+               resume=False, update=False):
+        """
+        Persist levels and lines into the database
+
+        Parameters
+        ----------
+        levels, lines: bool
+            ingest levels/lines
+        chunksize: int
+            if given, the gfall file is read ion by ion with
+            `GFALLReader.iter_ions` and every ion is ingested as soon as it
+            has been read. Compressed and open files are parsed in chunks of
+            `chunksize` lines. (default: None, read the whole file first)
+        bulk: bool
+            insert the rows with `BulkInserter` instead of creating
+            one ORM object per row (default: False)
+        pipeline: bool
+            read the gfall file in a background thread, which reads the next
+            ions while the current one is written (default: False). The file is
+            read ion by ion as with `chunksize` (default: GFALL_CHUNKSIZE).
+        resume: bool
+            commit the session after every ion together with a checkpoint of the
+            ion (see `IonCheckpoints`) and skip the ions that already have one
+            (default: False). Start the ingest with `resume=True` to be able to
+            resume it after a failure. The file is read ion by ion as with `pipeline`.
+        update: bool
+            ingest a new release of the gfall file into the same data source
+            (default: False). Like `resume`, but the levels and lines of an ion
+            whose content hash differs from its checkpoint are replaced, and the
+            ions that are no longer in the file are removed. A summary of the
+            added, modified and removed ions is printed. Replacing the levels
+            of an ion removes its lines, so an IngesterError is raised if they
+            have changed and `lines` is False.
+        """
+        if (pipeline or resume or update) and chunksize is None:
+            chunksize = GFALL_CHUNKSIZE
+
+        checkpoints = None
+        if resume or update:
+            if self.batcher.commit:
+                raise ValueError("resume and update commit the session once per ion and can not be "
+                                 "combined with commit=True")
+            stages = [stage for requested, stage in [(levels, "levels"), (lines, "lines")] if requested]
+            checkpoints = IonCheckpoints(self.session, self.data_source, stages=stages)
+
+        if chunksize is not None:
+            ions = self.gfall_reader.iter_ions(chunksize)
+            if pipeline:
+                ions = iter_prefetched(ions)
+            for ion, ion_levels, ion_lines in ions:
+                atomic_number, ion_charge = ion
+                for requested, stage, ingest_stage, data in [(levels, "levels", self.ingest_levels, ion_levels),
+                                                             (lines, "lines", self.ingest_lines, ion_lines)]:
+                    if not requested:
+                        continue
+                    content_hash = None
+                    if checkpoints is not None:
+                        content_hash = hash_content(data)
+                        if not checkpoints.needs_ingest(atomic_number, ion_charge, stage,
+                                                        content_hash=content_hash, replace=update):
+                            print("Skipping {} for {} {}: already ingested".format(
+                                stage, convert_atomic_number2symbol(atomic_number), ion_charge))
+                            continue
+                    ingest_stage(data, bulk=bulk)
+                    self.session.flush()
+                    if checkpoints is not None:
+                        checkpoints.mark(atomic_number, ion_charge, stage, content_hash=content_hash)
+                if checkpoints is not None:
+                    self.session.commit()
+
+            if update:
+                selected_ions = set(self.ions.index.tolist()) if self.ions is not None else None
+                checkpoints.remove_missing(selected_ions)
+                self.session.commit()
+                print(checkpoints.summary())
+            return
 
         if levels:
-            self.ingest_levels()
+            self.ingest_levels(bulk=bulk)
             self.session.flush()
 
         if lines:
-            self.ingest_lines()
+            self.ingest_lines(bulk=bulk)
             self.session.flush()
-
-
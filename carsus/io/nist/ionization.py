@@ -3,16 +3,15 @@ Input module for the NIST Ionization Energies database
 http://physics.nist.gov/PhysRefData/ASD/ionEnergy.html
 """
 
-import requests
 import pandas as pd
 
-from bs4 import BeautifulSoup
 from StringIO import StringIO
+from sqlalchemy import and_, inspect
 from astropy import units as u
 from uncertainties import ufloat_fromstr
 from pyparsing import ParseException
 from carsus.model import Ion, IonizationEnergy, Level, LevelEnergy
-from carsus.io.base import BaseParser, BaseIngester
+from carsus.io.base import BaseParser, BaseIngester, BulkInserter, to_model_unit
 from carsus.io.nist.ionization_grammar import level
 
 IONIZATION_ENERGIES_URL = 'https://physics.nist.gov/cgi-bin/ASD/ie.pl'
@@ -54,6 +53,8 @@ def download_ionization_energies(
 
     data = {k: v for k, v in data.iteritems() if v is not False}
 
+    import requests
+
     print "Downloading ionization energies from the NIST Atomic Spectra Database"
     r = requests.post(IONIZATION_ENERGIES_URL, data=data)
     return r.text
@@ -78,6 +79,8 @@ class NISTIonizationEnergiesParser(BaseParser):
     """
 
     def load(self, input_data):
+        from bs4 import BeautifulSoup
+
         soup = BeautifulSoup(input_data, 'html5lib')
         pre_tag = soup.pre
         for a in pre_tag.find_all("a"):
@@ -217,35 +220,108 @@ class NISTIonizationEnergiesIngester(BaseIngester):
         data = self.downloader(spectra=self.spectra)
         self.parser(data)
 
-    def ingest_ionization_energies(self, ioniz_energies=None):
+    def add_ions(self, index):
+        """ Create the ions of an (atomic_number, ion_charge) index that are not in the database yet """
+        for atomic_number, ion_charge in index:
+            Ion.as_unique(self.session, atomic_number=int(atomic_number), ion_charge=int(ion_charge))
+        self.session.flush()
+
+    def remove_ionization_energies(self, index):
+        """
+        Delete the ionization energies from the data source of the ions
+        of an (atomic_number, ion_charge) index
+        """
+        ion_charges = dict()
+        for atomic_number, ion_charge in index:
+            ion_charges.setdefault(int(atomic_number), list()).append(int(ion_charge))
+        table = IonizationEnergy.__table__
+        for atomic_number, charges in ion_charges.items():
+            self.session.execute(table.delete().where(and_(
+                table.c.type == inspect(IonizationEnergy).polymorphic_identity,
+                table.c.data_source_id == self.data_source.data_source_id,
+                table.c.atomic_number == atomic_number,
+                table.c.ion_charge.in_(charges))))
+
+    def ingest_ionization_energies(self, ioniz_energies=None, bulk=False):
 
         if ioniz_energies is None:
             ioniz_energies = self.parser.prepare_ioniz_energies()
 
         print("Ingesting ionization energies from {}".format(self.data_source.short_name))
 
+        if bulk:
+            self.add_ions(ioniz_energies.index)
+            self.remove_ionization_energies(ioniz_energies.index)
+            ioniz_energies = ioniz_energies.reset_index()
+            BulkInserter(self.session).insert(IonizationEnergy, {
+                "atomic_number": ioniz_energies["atomic_number"],
+                "ion_charge": ioniz_energies["ion_charge"],
+                "_value": to_model_unit(IonizationEnergy,
+                                        ioniz_energies["ionization_energy_value"].values * u.eV),
+                "uncert": ioniz_energies["ionization_energy_uncert"],
+                "method": ioniz_energies["ionization_energy_method"],
+                "data_source_id": self.data_source.data_source_id
+            })
+            return
+
         for index, row in ioniz_energies.iterrows():
             atomic_number, ion_charge = index
             # Query for an existing ion; create if doesn't exists
             ion = Ion.as_unique(self.session,
                                 atomic_number=atomic_number, ion_charge=ion_charge)
-            ion.energies = [
-                IonizationEnergy(ion=ion,
-                                 data_source=self.data_source,
+            # Replace the ionization energy from this data source
+            energies = list()
+            for energy in ion.ionization_energies:
+                if energy.data_source == self.data_source:
+                    if inspect(energy).pending:
+                        self.session.expunge(energy)
+                    else:
+                        self.session.delete(energy)
+                else:
+                    energies.append(energy)
+            energies.append(
+                IonizationEnergy(data_source=self.data_source,
                                  quantity=row['ionization_energy_value'] * u.eV,
                                  uncert=row['ionization_energy_uncert'],
                                  method=row['ionization_energy_method'])
-            ]
+            )
+            ion.ionization_energies = energies
             # No need to add ion to the session, because
             # that was done in `as_unique`
 
-    def ingest_ground_levels(self, ground_levels=None):
+    def ingest_ground_levels(self, ground_levels=None, bulk=False):
 
         if ground_levels is None:
             ground_levels = self.parser.prepare_ground_levels()
 
         print("Ingesting ground levels from {}".format(self.data_source.short_name))
 
+        if bulk:
+            self.add_ions(ground_levels.index)
+            ground_levels = ground_levels.reset_index()
+            inserter = BulkInserter(self.session)
+
+            def to_int(values):
+                return values.map(lambda x: None if pd.isnull(x) else int(x))
+
+            level_ids = inserter.insert(Level, {
+                "atomic_number": ground_levels["atomic_number"],
+                "ion_charge": ground_levels["ion_charge"],
+                "configuration": ground_levels["configuration"],
+                "term": ground_levels["term"],
+                "L": ground_levels["L"],
+                "spin_multiplicity": to_int(ground_levels["spin_multiplicity"]),
+                "parity": to_int(ground_levels["parity"]),
+                "J": ground_levels["J"],
+                "data_source_id": self.data_source.data_source_id
+            })
+            inserter.insert(LevelEnergy, {
+                "level_id": level_ids,
+                "_value": 0,
+                "data_source_id": self.data_source.data_source_id
+            })
+            return
+
         for index, row in ground_levels.iterrows():
             atomic_number, ion_charge = index
 
@@ -277,16 +353,27 @@ class NISTIonizationEnergiesIngester(BaseIngester):
                       ])
             )
 
-    def ingest(self, ionization_energies=True, ground_levels=True):
+    def ingest(self, ionization_energies=True, ground_levels=True, bulk=False):
+        """
+        Persist ionization energies and ground levels into the database
+
+        Parameters
+        ----------
+        ionization_energies, ground_levels: bool
+            ingest ionization energies/ground levels
+        bulk: bool
+            insert the rows with `BulkInserter` instead of creating
+            one ORM object per row (default: False)
+        """
 
         # Download data if needed
         if self.parser.base is None:
             self.download()
 
         if ionization_energies:
-            self.ingest_ionization_energies()
+            self.ingest_ionization_energies(bulk=bulk)
             self.session.flush()
 
         if ground_levels:
-            self.ingest_ground_levels()
+            self.ingest_ground_levels(bulk=bulk)
             self.session.flush()
@@ -3,13 +3,11 @@ Input module for the NIST Atomic Weights and Isotopic Compositions database
 http://www.nist.gov/pml/data/comp.cfm
 """
 
-import requests
 import pandas as pd
 
-from bs4 import BeautifulSoup
 from astropy import units as u
 from carsus.model import AtomWeight
-from carsus.io.base import BasePyparser, BaseIngester
+from carsus.io.base import BasePyparser, BaseIngester, BulkInserter, to_model_unit
 from carsus.io.util import to_nom_val_and_std_dev
 from carsus.io.nist.weightscomp_grammar import isotope, COLUMNS, ATOM_NUM_COL, MASS_NUM_COL,\
     AM_VAL_COL, AM_SD_COL, INTERVAL, STABLE_MASS_NUM, ATOM_WEIGHT_COLS, AW_STABLE_MASS_NUM_COL,\
@@ -40,6 +38,9 @@ def download_weightscomp(ascii='ascii2', isotype='some'):
         Preformatted text data
 
     """
+    import requests
+    from bs4 import BeautifulSoup
+
     print "Downloading data from the NIST Atomic Weights and Isotopic Compositions database."
     r = requests.get(WEIGHTSCOMP_URL, params={'ascii': ascii, 'isotype': isotype})
     soup = BeautifulSoup(r.text, 'html5lib')
@@ -160,13 +161,22 @@ class NISTWeightsCompIngester(BaseIngester):
         data = self.downloader()
         self.parser(data)
 
-    def ingest_atomic_weights(self, atomic_weights=None):
+    def ingest_atomic_weights(self, atomic_weights=None, bulk=False):
 
         if atomic_weights is None:
             atomic_weights = self.parser.prepare_atomic_dataframe()
 
         print "Ingesting atomic weights from {}".format(self.data_source.short_name)
 
+        if bulk:
+            BulkInserter(self.session).insert(AtomWeight, {
+                "atomic_number": atomic_weights.index.values,
+                "_value": to_model_unit(AtomWeight, atomic_weights[AW_VAL_COL].values * u.u),
+                "uncert": atomic_weights[AW_SD_COL].values,
+                "data_source_id": self.data_source.data_source_id
+            })
+            return
+
         for atomic_number, row in atomic_weights.iterrows():
             weight = AtomWeight(atomic_number=atomic_number,
                                      data_source=self.data_source,
@@ -174,12 +184,12 @@ class NISTWeightsCompIngester(BaseIngester):
                                      uncert=row[AW_SD_COL])
             self.session.add(weight)
 
-    def ingest(self, atomic_weights=True):
+    def ingest(self, atomic_weights=True, bulk=False):
         """ *Only* ingests atomic weights *for now* """
 
         if self.parser.base is None:
             self.download()
 
         if atomic_weights:
-            self.ingest_atomic_weights()
+            self.ingest_atomic_weights(bulk=bulk)
             self.session.flush()
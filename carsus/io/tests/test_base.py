@@ -1,8 +1,16 @@
 import pytest
+import numpy as np
 import pandas as pd
 
+from numpy.testing import assert_almost_equal
 from pandas.util.testing import assert_frame_equal
+from astropy import units as u
+from carsus.io import base
+from carsus.io.base import ParserError, BulkInserter, IonCheckpoints, LevelIdMap, SessionBatcher, IngesterError, \
+    hash_content, iter_prefetched, to_model_unit
 from carsus.io.nist.weightscomp_grammar import AW_SD_COL, AW_VAL_COL
+from carsus.model import DataSource, Ion, Level, LevelEnergy, Line, LineWavelength, IngestCheckpoint, \
+    MEDIUM_VACUUM
 
 
 @pytest.mark.parametrize("test_input,expected",[
@@ -22,4 +30,313 @@ def test_pyparser_load(test_input, expected, aw_pyparser):
 def test_pyparser_callable(aw_pyparser):
     aw_pyparser(input_data="atomic_weight = 6.8083492038(23)")
     assert aw_pyparser.base.loc[0, AW_VAL_COL] == "6.8083492038"
-    assert aw_pyparser.base.loc[0, AW_SD_COL] == "23"
\ No newline at end of file
+    assert aw_pyparser.base.loc[0, AW_SD_COL] == "23"
+
+@pytest.mark.parametrize("batchsize", [1, 10])
+def test_bulk_inserter_insert(memory_session, batchsize):
+    data_source = DataSource.as_unique(memory_session, short_name="bulk")
+    ion = Ion.as_unique(memory_session, atomic_number=1, ion_charge=0)
+    ion.levels = [Level(level_index=i, data_source=data_source) for i in range(3)]
+    memory_session.flush()
+    level_ids = [level.level_id for level in ion.levels]
+
+    inserter = BulkInserter(memory_session, batchsize=batchsize)
+    line_ids = inserter.insert(Line, {
+        "lower_level_id": level_ids[:2],
+        "upper_level_id": level_ids[1:],
+        "data_source_id": data_source.data_source_id
+    })
+    inserter.insert(LineWavelength, {
+        "line_id": line_ids,
+        "_value": [1215.67, 1025.72],
+        "uncert": [0.01, np.nan],
+        "method": ["meas", None],
+        "data_source_id": data_source.data_source_id
+    })
+    # Ids allocated after the bulk insert continue the block
+    assert inserter.allocate_ids(Line, 2).tolist() == [line_ids[-1] + 1, line_ids[-1] + 2]
+
+    lines = memory_session.query(Line).filter(Line.data_source == data_source).\
+        order_by(Line.line_id).all()
+    assert [line.line_id for line in lines] == line_ids.tolist()
+    assert [line.lower_level.level_index for line in lines] == [0, 1]
+    assert [line.upper_level.level_index for line in lines] == [1, 2]
+
+    wavelengths = [line.wavelengths[0] for line in lines]
+    assert_almost_equal([wavelength.quantity.to(u.AA).value for wavelength in wavelengths],
+                        [1215.67, 1025.72])
+    assert wavelengths[0].method == "meas"
+    assert wavelengths[1].uncert is None  # NaN is stored as NULL
+    assert wavelengths[1].method is None
+    assert all(wavelength.medium == MEDIUM_VACUUM for wavelength in wavelengths)
+
+
+def test_bulk_inserter_insert_empty(memory_session):
+    inserter = BulkInserter(memory_session)
+    assert len(inserter.insert(Line, pd.DataFrame(columns=["lower_level_id", "upper_level_id"]))) == 0
+
+
+@pytest.fixture
+def level_id_map_session(memory_session):
+    data_source = DataSource.as_unique(memory_session, short_name="levels")
+    for atomic_number, ion_charge, level_indices in [(4, 2, [0, 1, 3]), (7, 5, [0, 2])]:
+        ion = Ion.as_unique(memory_session, atomic_number=atomic_number, ion_charge=ion_charge)
+        ion.levels = [Level(level_index=i, data_source=data_source) for i in level_indices]
+    # Levels of other data sources and without an index are not in the map
+    ion.levels.append(Level(level_index=5, data_source=DataSource.as_unique(memory_session, short_name="other")))
+    ion.levels.append(Level(data_source=data_source))
+    memory_session.flush()
+    return memory_session
+
+
+def test_level_id_map_lookup(level_id_map_session):
+    data_source = DataSource.as_unique(level_id_map_session, short_name="levels")
+    levels = level_id_map_session.query(Level).\
+        filter(Level.data_source == data_source).\
+        filter(Level.level_index != None).all()
+    level_ids = LevelIdMap(level_id_map_session, data_source)
+
+    assert len(level_ids) == len(levels) == 5
+    exp_ids = [level.level_id for level in levels]
+    ids = level_ids.lookup([level.atomic_number for level in levels],
+                           [level.ion_charge for level in levels],
+                           [level.level_index for level in levels])
+    assert ids.tolist() == exp_ids
+
+    # Unknown ions and level indices
+    assert level_ids.lookup([4, 4, 7, 26, 4], [2, 2, 5, 0, 9], [2, 4, 5, 0, -1]).tolist() == [-1] * 5
+
+
+def test_level_id_map_atomic_numbers(level_id_map_session):
+    data_source = DataSource.as_unique(level_id_map_session, short_name="levels")
+    level_ids = LevelIdMap(level_id_map_session, data_source, atomic_numbers=[7])
+    assert len(level_ids) == 2
+    assert level_ids.lookup(4, 2, 0) == -1
+    assert level_ids.lookup(7, 5, 2) != -1
+
+
+def test_level_id_map_get_ids_missing(level_id_map_session):
+    data_source = DataSource.as_unique(level_id_map_session, short_name="levels")
+    level_ids = LevelIdMap(level_id_map_session, data_source)
+    with pytest.raises(IngesterError) as excinfo:
+        level_ids.get_ids([4, 4, 4, 7, 26], [2, 2, 2, 5, 0], [0, 2, 2, 1, 0])
+    # All missing levels are reported at once
+    assert "3 levels" in str(excinfo.value)
+    assert "Be 2: 2; N 5: 1; Fe 0: 0" in str(excinfo.value)
+
+
+def test_level_id_map_from_ids(level_id_map_session):
+    data_source = DataSource.as_unique(level_id_map_session, short_name="levels")
+    level_ids = LevelIdMap(level_id_map_session, data_source, atomic_numbers=[7])
+    level_index = [0, 2]
+    ids = level_ids.lookup(7, 5, level_index)
+    level_ids_from_ids = LevelIdMap.from_ids(7, 5, level_index, ids)
+    assert len(level_ids_from_ids) == 2
+    assert level_ids_from_ids.lookup(7, 5, level_index).tolist() == ids.tolist()
+    assert level_ids_from_ids.lookup([4, 7], [2, 5], [0, 1]).tolist() == [-1, -1]
+
+
+def test_level_id_map_empty(memory_session):
+    data_source = DataSource.as_unique(memory_session, short_name="empty")
+    memory_session.flush()
+    level_ids = LevelIdMap(memory_session, data_source)
+    assert len(level_ids) == 0
+    assert level_ids.lookup([1, 2], 0, 0).tolist() == [-1, -1]
+
+
+def test_ion_checkpoints(level_id_map_session):
+    data_source = DataSource.as_unique(level_id_map_session, short_name="levels")
+    checkpoints = IonCheckpoints(level_id_map_session, data_source)
+    assert not checkpoints.is_done(4, 2, "levels")
+    # The levels of Be 2 have been ingested without a checkpoint
+    with pytest.raises(IngesterError):
+        checkpoints.needs_ingest(4, 2, "levels")
+    assert checkpoints.needs_ingest(4, 2, "lines")
+
+    checkpoints.mark(4, 2, "levels")
+    checkpoints.mark(4, 2, "levels")
+    assert not checkpoints.needs_ingest(4, 2, "levels")
+    level_id_map_session.commit()
+
+    # The checkpoints are read from the database
+    checkpoints = IonCheckpoints(level_id_map_session, data_source)
+    assert checkpoints.content_hashes == {(4, 2, "levels"): None}
+    other_checkpoints = IonCheckpoints(level_id_map_session, DataSource.as_unique(level_id_map_session,
+                                                                                 short_name="other"))
+    assert not other_checkpoints.is_done(4, 2, "levels")
+
+
+def test_ion_checkpoints_replace(level_id_map_session):
+    data_source = DataSource.as_unique(level_id_map_session, short_name="levels")
+    ion = Ion.as_unique(level_id_map_session, atomic_number=4, ion_charge=2)
+    lower, upper = ion.levels[:2]
+    level_id_map_session.add(Line(lower_level=lower, upper_level=upper, data_source=data_source,
+                                  wavelengths=[LineWavelength(quantity=10 * u.AA, data_source=data_source)]))
+    checkpoints = IonCheckpoints(level_id_map_session, data_source)
+    for stage in ["levels", "lines"]:
+        checkpoints.mark(4, 2, stage, content_hash="old")
+    level_id_map_session.commit()
+
+    # The lines would be removed without being ingested again
+    checkpoints = IonCheckpoints(level_id_map_session, data_source, stages=["levels"])
+    with pytest.raises(IngesterError) as excinfo:
+        checkpoints.needs_ingest(4, 2, "levels", content_hash="new", replace=True)
+    assert "lines=True" in str(excinfo.value)
+    assert level_id_map_session.query(Line).count() == 1
+
+    checkpoints = IonCheckpoints(level_id_map_session, data_source, stages=["levels", "lines"])
+    assert not checkpoints.needs_ingest(4, 2, "levels", content_hash="old", replace=True)
+    assert not checkpoints.needs_ingest(4, 2, "levels", content_hash="new")
+    # The levels and the lines, which refer to them, are removed
+    assert checkpoints.needs_ingest(4, 2, "levels", content_hash="new", replace=True)
+    assert not checkpoints.is_done(4, 2, "lines")
+    assert level_id_map_session.query(Level).filter(Level.data_source == data_source).\
+        filter(Level.atomic_number == 4).count() == 0
+    assert level_id_map_session.query(Line).count() == 0
+    assert level_id_map_session.execute(Line.__table__.count()).scalar() == 0
+    assert level_id_map_session.query(LineWavelength).count() == 0
+    # The levels of the other ion are kept
+    assert level_id_map_session.query(Level).filter(Level.data_source == data_source).count() == 3
+    assert checkpoints.modified == {(4, 2)}
+
+
+def test_ion_checkpoints_remove_missing(level_id_map_session):
+    data_source = DataSource.as_unique(level_id_map_session, short_name="levels")
+    checkpoints = IonCheckpoints(level_id_map_session, data_source)
+    checkpoints.mark(4, 2, "levels")
+    checkpoints.mark(7, 5, "levels")
+    level_id_map_session.commit()
+
+    checkpoints = IonCheckpoints(level_id_map_session, data_source)
+    assert not checkpoints.needs_ingest(7, 5, "levels")
+    checkpoints.remove_missing(selected_ions={(7, 5)})
+    assert checkpoints.removed == set()
+    checkpoints.remove_missing()
+    assert checkpoints.removed == {(4, 2)}
+    assert level_id_map_session.query(IngestCheckpoint).count() == 1
+    assert "Removed: 1 ions (Be 2)" in checkpoints.summary()
+    assert "Unchanged: 1 ions" in checkpoints.summary()
+
+
+def test_to_model_unit():
+    assert_almost_equal(to_model_unit(LevelEnergy, [0., 8065.544] * u.Unit("cm-1")), [0., 1.], decimal=6)
+    assert_almost_equal(to_model_unit(LineWavelength, [1., 2.] * u.nm), [10., 20.])
+    # Plain numbers are in the unit of the model
+    assert_almost_equal(to_model_unit(LineWavelength, [1., 2.]), [1., 2.])
+    with pytest.raises(u.UnitConversionError):
+        to_model_unit(LineWavelength, [1., 2.] * u.kg)
+
+
+@pytest.mark.parametrize("without_hash_pandas_object", [False, True])
+def test_hash_content(monkeypatch, without_hash_pandas_object):
+    if without_hash_pandas_object:
+        # As with pandas < 0.20
+        monkeypatch.setattr(base, "hash_pandas_object", None)
+    data = pd.DataFrame({"energy": [0., 1.5], "j": [0.5, 1.5]})
+    assert hash_content(data) == hash_content(data.copy())
+    assert hash_content(data) != hash_content(data.assign(j=[0.5, 2.5]))
+    assert hash_content(data) != hash_content(data.iloc[:1])
+    assert hash_content(None) != hash_content(data)
+
+    # Columns of arrays
+    data["temperatures"] = [np.array([1., 2.]), np.array([3., 4.])]
+    assert hash_content(data) == hash_content(data.copy())
+    assert hash_content(data) != hash_content(data.assign(temperatures=[np.array([1., 2.]), np.array([3., 5.])]))
+
+
+def test_session_batcher(memory_session):
+    data_source = DataSource.as_unique(memory_session, short_name="batches")
+    ion = Ion.as_unique(memory_session, atomic_number=1, ion_charge=0)
+    memory_session.flush()
+    batcher = SessionBatcher(memory_session, batch_size=3)
+
+    for i in range(7):
+        batcher.add(Level(ion=ion, level_index=i, data_source=data_source,
+                          energies=[LevelEnergy(quantity=i * u.eV, data_source=data_source)]))
+        # A full batch is flushed and expunged
+        assert len(memory_session.new) == 2 * ((i + 1) % 3)
+    batcher.release()
+
+    assert len(memory_session.new) == 0
+    assert not any(isinstance(obj, (Level, LevelEnergy)) for obj in memory_session)
+    # The objects of the unique cache stay in the session
+    assert ion in memory_session and data_source in memory_session
+    assert memory_session.query(Level).filter(Level.data_source == data_source).count() == 7
+
+
+def test_session_batcher_keeps_other_objects(memory_session):
+    data_source = DataSource.as_unique(memory_session, short_name="batches")
+    ion = Ion.as_unique(memory_session, atomic_number=1, ion_charge=0)
+    persistent_level = Level(ion=ion, level_index=0, data_source=data_source)
+    memory_session.add(persistent_level)
+    memory_session.flush()
+    pending_level = Level(ion=ion, level_index=1, data_source=data_source)
+    memory_session.add(pending_level)
+
+    batcher = SessionBatcher(memory_session, batch_size=2)
+    for i in range(2, 5):
+        batcher.add(Level(ion=ion, level_index=i, data_source=data_source))
+    batcher.release()
+    # Only the objects added with the batcher are expunged
+    assert persistent_level in memory_session and pending_level in memory_session
+    assert memory_session.query(Level).filter(Level.data_source == data_source).count() == 5
+
+
+def test_session_batcher_default(memory_session):
+    data_source = DataSource.as_unique(memory_session, short_name="batches")
+    ion = Ion.as_unique(memory_session, atomic_number=1, ion_charge=0)
+    batcher = SessionBatcher(memory_session)
+    levels = [Level(ion=ion, level_index=i, data_source=data_source) for i in range(3)]
+    for level in levels:
+        batcher.add(level)
+    batcher.release()
+    # Without batch_size and commit the session is left as it is
+    assert all(level in memory_session.new for level in levels)
+
+
+def test_session_batcher_commit(memory_session):
+    data_source = DataSource.as_unique(memory_session, short_name="batches")
+    ion = Ion.as_unique(memory_session, atomic_number=1, ion_charge=0)
+    batcher = SessionBatcher(memory_session, batch_size=2, commit=True)
+    for i in range(3):
+        batcher.add(Level(ion=ion, level_index=i, data_source=data_source))
+
+    # The first batch has been committed
+    memory_session.rollback()
+    assert memory_session.query(Level).filter(Level.data_source == data_source).count() == 2
+
+
+def test_session_batcher_invalid_batch_size(memory_session):
+    with pytest.raises(ValueError):
+        SessionBatcher(memory_session, batch_size=0)
+
+
+@pytest.mark.parametrize("maxsize", [1, 2, 100])
+def test_iter_prefetched(maxsize):
+    assert list(iter_prefetched(iter(range(50)), maxsize=maxsize)) == list(range(50))
+
+
+def test_iter_prefetched_error():
+    def produce():
+        yield 1
+        raise ParserError("broken input")
+
+    items = iter_prefetched(produce())
+    assert next(items) == 1
+    with pytest.raises(ParserError):
+        next(items)
+
+
+def test_iter_prefetched_stop():
+    produced = list()
+
+    def produce():
+        for i in range(1000):
+            produced.append(i)
+            yield i
+
+    items = iter_prefetched(produce(), maxsize=2)
+    assert next(items) == 0
+    items.close()
+    # The producer stops when the consumer does, after filling the queue
+    assert len(produced) < 10
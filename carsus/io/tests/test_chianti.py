@@ -1,8 +1,14 @@
+import os
+import pickle
 import pytest
 
+from sqlalchemy.orm import aliased
 from numpy.testing import assert_almost_equal
-from carsus.io.chianti_ import ChiantiIonReader, ChiantiIngester
-from carsus.model import Level, Ion, Line, ECollision
+from pandas.util.testing import assert_frame_equal
+from carsus.io.chianti_ import ChiantiIonReader, ChiantiIngester, chianti_
+from carsus.io.chianti_.chianti_ import ChiantiIonInfo
+from carsus.model import Level, Ion, Line, ECollision, LevelEnergy, LineWavelength, LineAValue, LineGFValue, \
+    ECollisionEnergy, ECollisionGFValue, ECollisionTempStrength
 
 
 slow = pytest.mark.skipif(
@@ -47,6 +53,90 @@ def test_chianti_reader_read_levels(ch_ion_reader, level_index, energy, energy_t
     assert_almost_equal(row['energy_theoretical'], energy_theoretical)
 
 
+@slow
+def test_chianti_reader_detach(ch_ion_reader):
+    detached_reader = pickle.loads(pickle.dumps(ChiantiIonReader("ne_2").detach()))
+    assert detached_reader.ion.Z == 10 and detached_reader.ion.Ion == 2
+    for name in ["levels", "lines", "collisions", "bound_levels", "bound_lines", "bound_collisions"]:
+        assert_frame_equal(getattr(detached_reader, name), getattr(ch_ion_reader, name))
+
+
+@slow
+def test_chianti_ingester_n_workers(memory_session):
+    ions = 'ne 1; cl 3; n 4'
+    serial_ingester = ChiantiIngester(memory_session, ions=ions)
+    parallel_ingester = ChiantiIngester(memory_session, ions=ions, n_workers=2)
+    for serial_reader, parallel_reader in zip(serial_ingester.ion_readers, parallel_ingester.ion_readers):
+        assert parallel_reader.ion.Spectroscopic == serial_reader.ion.Spectroscopic
+        for name in ["bound_levels", "bound_lines", "bound_collisions"]:
+            assert_frame_equal(getattr(parallel_reader, name), getattr(serial_reader, name))
+
+
+@slow
+@pytest.mark.parametrize("ion_name", ["ne_2", "n_5", "fe_12"])
+def test_chianti_reader_native_backend(ion_name):
+    ion_rdr = ChiantiIonReader(ion_name)
+    native_ion_rdr = ChiantiIonReader(ion_name, backend="native")
+    assert native_ion_rdr.ion.Spectroscopic == ion_rdr.ion.Spectroscopic
+    for name in ["levels", "lines", "collisions", "bound_levels", "bound_lines", "bound_collisions"]:
+        assert_frame_equal(getattr(native_ion_rdr, name), getattr(ion_rdr, name))
+
+
+@slow
+def test_chianti_reader_cache(tmpdir, monkeypatch, ch_ion_reader):
+    cache_dir = str(tmpdir.join("chianti_cache"))
+    ChiantiIonReader("ne_2", cache_dir=cache_dir)
+    assert len(os.listdir(cache_dir)) == 1
+
+    cached_reader = ChiantiIonReader("ne_2", cache_dir=cache_dir)
+    assert isinstance(cached_reader.ion, ChiantiIonInfo)
+    assert cached_reader.ion.Spectroscopic == ch_ion_reader.ion.Spectroscopic
+    for name in ["levels", "lines", "collisions", "bound_levels", "bound_lines", "bound_collisions"]:
+        assert_frame_equal(getattr(cached_reader, name), getattr(ch_ion_reader, name))
+
+    # The backends have separate caches
+    native_reader = ChiantiIonReader("ne_2", cache_dir=cache_dir, backend="native")
+    assert native_reader.cache_key != cached_reader.cache_key
+    assert len(os.listdir(cache_dir)) == 2
+
+    # A new CHIANTI version invalidates the cache
+    monkeypatch.setattr(chianti_, "versionRead", lambda: "0.0.0")
+    ChiantiIonReader("ne_2", cache_dir=cache_dir)
+    assert len(os.listdir(cache_dir)) == 3
+
+
+@slow
+@pytest.mark.parametrize("reader", ["native", "detached", "cached"])
+def test_chianti_reader_release(tmpdir, ch_ion_reader, reader):
+    if reader == "native":
+        ion_rdr = ChiantiIonReader("ne_2", backend="native")
+    elif reader == "detached":
+        ion_rdr = pickle.loads(pickle.dumps(ChiantiIonReader("ne_2").detach()))
+    else:
+        cache_dir = str(tmpdir.join("chianti_cache"))
+        ChiantiIonReader("ne_2", cache_dir=cache_dir)
+        ion_rdr = ChiantiIonReader("ne_2", cache_dir=cache_dir)
+    ion_rdr.bound_lines
+    ion_rdr.release()
+    assert ion_rdr._levels is None and ion_rdr._lines is None and ion_rdr._collisions is None
+    # The data is read again
+    assert_frame_equal(ion_rdr.bound_lines, ch_ion_reader.bound_lines)
+    assert_frame_equal(ion_rdr.bound_collisions, ch_ion_reader.bound_collisions)
+
+
+@slow
+@pytest.mark.parametrize("n_workers", [None, 2])
+def test_chianti_ingest_releases_readers(memory_session, n_workers):
+    ch_ingester = ChiantiIngester(memory_session, ions='ne 1; cl 3', n_workers=n_workers)
+    ch_ingester.ingest(levels=True, lines=True)
+    assert all(rdr._levels is None and rdr._lines is None for rdr in ch_ingester.ion_readers)
+
+
+def test_chianti_reader_unknown_backend():
+    with pytest.raises(ValueError):
+        ChiantiIonReader("ne_2", backend="fortran")
+
+
 @slow
 @pytest.mark.parametrize("atomic_number, ion_charge, levels_count",[
     (10, 1, 138),
@@ -77,4 +167,68 @@ def test_chianti_ingest_e_col_count(memory_session, ch_ingester, atomic_number,
     ch_ingester.ingest(levels=True, collisions=True)
     ion = Ion.as_unique(memory_session, atomic_number=atomic_number, ion_charge=ion_charge)
     cnt = memory_session.query(ECollision).join(ECollision.lower_level).filter(Level.ion==ion).count()
-    assert cnt == e_col_count
\ No newline at end of file
+    assert cnt == e_col_count
+
+
+def ingested_chianti_rows(session, data_source):
+    """ Return the ingested levels, lines and collisions with their quantities, without ids """
+    levels = session.query(Level.atomic_number, Level.ion_charge, Level.level_index, Level.configuration,
+                           Level.term, Level.L, Level.J, Level.spin_multiplicity,
+                           LevelEnergy._value, LevelEnergy.method,
+                           LevelEnergy.data_source_id == data_source.data_source_id).\
+        join(Level.energies).\
+        filter(Level.data_source == data_source).\
+        order_by(Level.atomic_number, Level.ion_charge, Level.level_index, LevelEnergy.method).all()
+
+    lower, upper = aliased(Level), aliased(Level)
+    wavelength, a_value, gf_value = aliased(LineWavelength), aliased(LineAValue), aliased(LineGFValue)
+    q_lines = session.query(lower.atomic_number, lower.ion_charge, lower.level_index, upper.level_index,
+                            wavelength._value, wavelength.medium, wavelength.method,
+                            a_value._value, gf_value._value).\
+        select_from(Line).\
+        join(lower, Line.lower_level_id == lower.level_id).\
+        join(upper, Line.upper_level_id == upper.level_id).\
+        join(wavelength, Line.wavelengths).\
+        join(a_value, Line.a_values).\
+        join(gf_value, Line.gf_values).\
+        filter(Line.data_source == data_source).\
+        order_by(lower.atomic_number, lower.ion_charge, lower.level_index, upper.level_index)
+
+    lower, upper = aliased(Level), aliased(Level)
+    energy, gf_value = aliased(ECollisionEnergy), aliased(ECollisionGFValue)
+    q_collisions = session.query(lower.atomic_number, lower.ion_charge, lower.level_index, upper.level_index,
+                                 ECollision.bt92_ttype, ECollision.bt92_cups,
+                                 energy._value, gf_value._value).\
+        select_from(ECollision).\
+        join(lower, ECollision.lower_level_id == lower.level_id).\
+        join(upper, ECollision.upper_level_id == upper.level_id).\
+        join(energy, ECollision.energies).\
+        join(gf_value, ECollision.gf_values).\
+        filter(ECollision.data_source == data_source).\
+        order_by(lower.atomic_number, lower.ion_charge, lower.level_index, upper.level_index)
+
+    lower, upper = aliased(Level), aliased(Level)
+    q_strengths = session.query(lower.atomic_number, lower.ion_charge, lower.level_index, upper.level_index,
+                                ECollisionTempStrength.temp, ECollisionTempStrength.strength).\
+        select_from(ECollisionTempStrength).\
+        join(ECollision, ECollisionTempStrength.e_col_id == ECollision.e_col_id).\
+        join(lower, ECollision.lower_level_id == lower.level_id).\
+        join(upper, ECollision.upper_level_id == upper.level_id).\
+        filter(ECollision.data_source == data_source).\
+        order_by(lower.atomic_number, lower.ion_charge, lower.level_index, upper.level_index,
+                 ECollisionTempStrength.temp)
+
+    return levels, q_lines.all(), q_collisions.all(), q_strengths.all()
+
+
+@slow
+def test_chianti_ingest_bulk_equals_orm(memory_session):
+    ions = 'ne 1; cl 3'
+    orm_ingester = ChiantiIngester(memory_session, ions=ions, ds_short_name="chianti_orm")
+    orm_ingester.ingest(levels=True, lines=True, collisions=True, bulk=False)
+    bulk_ingester = ChiantiIngester(memory_session, ions=ions, ds_short_name="chianti_bulk")
+    bulk_ingester.ingest(levels=True, lines=True, collisions=True, bulk=True)
+
+    orm_rows = ingested_chianti_rows(memory_session, orm_ingester.data_source)
+    assert all(len(rows) > 0 for rows in orm_rows)
+    assert ingested_chianti_rows(memory_session, bulk_ingester.data_source) == orm_rows
@@ -1,12 +1,26 @@
+import os
+import time
 import pytest
 import numpy as np
+import pandas as pd
 
 from sqlalchemy import and_
+from sqlalchemy.orm import aliased
 from numpy.testing import assert_almost_equal, assert_allclose
+from pandas.util.testing import assert_frame_equal
 from astropy.tests.helper import assert_quantity_allclose
 from astropy import units as u
-from carsus.io.kurucz import GFALLReader, GFALLIngester
-from carsus.model import Ion, Level, LevelEnergy, DataSource, Line
+from carsus.io.kurucz import GFALLReader, GFALLMultiReader, GFALLIngester
+from carsus.io.kurucz.gfall import GFALL_COMPRESSION_OPENERS, parse_gfall_labels
+from carsus.io.base import IngesterError
+from carsus.model import Ion, Level, LevelEnergy, DataSource, Line, LineWavelength, LineGFValue, \
+    IngestCheckpoint
+
+
+slow = pytest.mark.skipif(
+    not pytest.config.getoption("--runslow"),
+    reason="need --runslow option to run"
+)
 
 @pytest.fixture()
 def gfall_rdr(gfall_fname):
@@ -48,6 +62,31 @@ def test_grall_reader_gfall_raw(gfall_raw, index, wavelength, element_code, e_fi
     assert_allclose([row["e_first"], row["e_second"]], [e_first, e_second])
 
 
+def test_gfall_reader_numpy_engine_same_as_fwf(gfall_rdr, gfall_raw):
+    gfall_raw_fwf = gfall_rdr.read_gfall_raw(engine="fwf").reset_index(drop=True)
+    assert_frame_equal(gfall_raw, gfall_raw_fwf)
+
+
+@slow
+def test_gfall_reader_numpy_engine_benchmark(gfall_rdr, gfall_fname, tmpdir):
+    with open(gfall_fname) as f:
+        gfall_content = f.read()
+    gfall_big = tmpdir.join("gfall_big.dat")
+    gfall_big.write(gfall_content * 5000)
+
+    start = time.time()
+    gfall_raw_fwf = gfall_rdr.read_gfall_raw(str(gfall_big), engine="fwf")
+    fwf_time = time.time() - start
+
+    start = time.time()
+    gfall_raw_numpy = gfall_rdr.read_gfall_raw(str(gfall_big), engine="numpy")
+    numpy_time = time.time() - start
+
+    print("read_fwf: {0:.2f} s, numpy: {1:.2f} s".format(fwf_time, numpy_time))
+    # The blank lines of the test file are repeated, which read_fwf counts in the index
+    assert_frame_equal(gfall_raw_numpy.reset_index(drop=True), gfall_raw_fwf.reset_index(drop=True))
+
+
 @pytest.mark.parametrize("index, wavelength, atomic_number, ion_charge, "
                          "e_lower, e_upper, e_lower_predicted, e_upper_predicted",[
     (12, 67.5615, 4, 2, 983369.8, 1131383.0, False, False),
@@ -71,6 +110,16 @@ def test_gfall_reader_gfall_ignore_labels(gfall):
                          (gfall["label_upper"].isin(ignored_labels))]) == 0
 
 
+def test_gfall_reader_parse_gfall_lower_upper(gfall_rdr, gfall_raw):
+    gfall_raw = gfall_raw.copy()
+    gfall_raw["label_first"] = "  " + gfall_raw["label_first"].str.replace(" ", "   ")
+    gfall = gfall_rdr.parse_gfall(gfall_raw)
+    assert (gfall["energy_lower"] <= gfall["energy_upper"]).all()
+    assert not gfall["label_lower"].str.contains(r"^\s|\s\s").any()
+    assert not gfall["label_upper"].str.contains(r"^\s|\s\s").any()
+    assert_frame_equal(gfall, gfall_rdr.gfall)
+
+
 def test_gfall_reader_clean_levels_labels(levels):
     # One label for the ground level of Be III has an extra space
     levels0402 = levels.loc[(4, 2)]
@@ -91,6 +140,117 @@ def test_gfall_reader_levels(levels, atomic_number, ion_charge, level_index,
     assert row["method"] == method
 
 
+@pytest.mark.parametrize("label, configuration, term", [
+    ("s2p *3P", "s2p", "*3P"),
+    ("3d7 4s a5F", "3d7 4s", "a5F"),
+    ("4p5 5s 2[3/2]", "4p5 5s", "2[3/2]"),
+    ("(3P)4p x4D", "(3P)4p", "x4D"),
+    ("a5D", np.nan, "a5D"),
+    ("3d8", "3d8", np.nan),
+    ("4f7(8S)5d", "4f7(8S)5d", np.nan),
+    (np.nan, np.nan, np.nan)
+])
+def test_parse_gfall_labels(label, configuration, term):
+    configurations, terms = parse_gfall_labels(np.array([label, "s2s 1S", label], dtype=object))
+    assert pd.Series(configurations).equals(pd.Series([configuration, "s2s", configuration]))
+    assert pd.Series(terms).equals(pd.Series([term, "1S", term]))
+
+
+@pytest.mark.parametrize("atomic_number, ion_charge, level_index, configuration, term", [
+    (4, 2, 0, "1s2", "1S"),
+    (4, 2, 11, "s3p", "*3P"),
+])
+def test_gfall_reader_levels_configuration_term(levels, atomic_number, ion_charge, level_index,
+                                                configuration, term):
+    row = levels.loc[(atomic_number, ion_charge, level_index)]
+    assert row["configuration"] == configuration
+    assert row["term"] == term
+
+
+@slow
+def test_parse_gfall_labels_benchmark(levels):
+    n_tiles = 50000
+    labels = np.tile(levels["label"].values, n_tiles)
+
+    start = time.time()
+    split_labels = [label.rsplit(" ", 1) for label in labels]
+    loop_time = time.time() - start
+
+    start = time.time()
+    configuration, term = parse_gfall_labels(labels)
+    parse_time = time.time() - start
+
+    print("{0} labels: loop {1:.2f} s, parse_gfall_labels {2:.2f} s ({3:.0f} labels/s)".format(
+        len(labels), loop_time, parse_time, len(labels) / parse_time))
+    exp_configuration, exp_term = parse_gfall_labels(levels["label"].values)
+    assert pd.Series(configuration).equals(pd.Series(np.tile(exp_configuration, n_tiles)))
+    assert pd.Series(term).equals(pd.Series(np.tile(exp_term, n_tiles)))
+
+
+@pytest.mark.parametrize("unique_level_identifier", [
+    ["energy", "j"],
+    ["energy", "j", "label"],
+    ["label"]
+])
+def test_gfall_reader_levels_same_as_drop_duplicates(gfall_fname, unique_level_identifier):
+    gfall_rdr = GFALLReader(gfall_fname, unique_level_identifier=unique_level_identifier)
+    gfall = gfall_rdr.gfall
+    levels = list()
+    for side in ["lower", "upper"]:
+        side_levels = gfall[["atomic_number", "ion_charge", "energy_" + side, "j_" + side,
+                             "label_" + side, "energy_{0}_predicted".format(side)]]
+        side_levels.columns = ["atomic_number", "ion_charge", "energy", "j", "label", "theoretical"]
+        levels.append(side_levels)
+    levels = pd.concat(levels).drop_duplicates(
+        ["atomic_number", "ion_charge"] + unique_level_identifier)
+    levels = levels.sort_values(["atomic_number", "ion_charge", "energy", "j", "label"])
+    levels["method"] = np.where(levels.pop("theoretical"), "theor", "meas")
+    levels["level_index"] = levels.groupby(["atomic_number", "ion_charge"]).cumcount()
+    levels = levels.set_index(["atomic_number", "ion_charge", "level_index"])
+    assert_frame_equal(gfall_rdr.levels.drop(["configuration", "term"], axis=1), levels)
+
+
+def test_gfall_reader_energy_tolerance(gfall_fname, gfall, levels, lines):
+    gfall = gfall.copy()
+    gfall.loc[gfall.index[::2], "energy_upper"] += 1e-4
+    gfall_rdr = GFALLReader(gfall_fname, energy_tolerance=1e-3)
+    assert len(gfall_rdr.extract_levels(gfall)) == len(levels)
+    assert len(GFALLReader(gfall_fname).extract_levels(gfall)) > len(levels)
+
+    merged_gfall, merged_levels = gfall_rdr.merge_close_energies(gfall)
+    assert len(merged_levels) > 0
+    assert_allclose(merged_levels["energy"], merged_levels["merged_energy"], atol=1e-3)
+    # The shifted energies may change the order of levels with equal energies
+    def sorted_levels(levels):
+        levels = levels.reset_index().drop("level_index", axis=1).round({"energy": 2})
+        return levels.sort_values(["atomic_number", "ion_charge", "energy", "j"]).\
+            reset_index(drop=True)
+    tolerance_levels = gfall_rdr.extract_levels(gfall)
+    assert_frame_equal(sorted_levels(tolerance_levels), sorted_levels(levels))
+    tolerance_lines = gfall_rdr.extract_lines(gfall, tolerance_levels)
+    assert len(tolerance_lines) == len(lines)
+    assert not tolerance_lines.index.get_level_values("level_index_lower").isnull().any()
+    assert not tolerance_lines.index.get_level_values("level_index_upper").isnull().any()
+
+
+def test_gfall_reader_energy_tolerance_chain(gfall_fname):
+    # Each energy is within the tolerance of its neighbour, but not of the lowest one
+    gfall = pd.DataFrame({
+        "atomic_number": [4, 4, 4], "ion_charge": [2, 2, 2],
+        "energy_lower": [0.0, 0.0, 0.0], "energy_upper": [100.0, 100.0008, 100.0016],
+        "j_lower": [0.0, 0.0, 0.0], "j_upper": [1.0, 1.0, 1.0]})
+    gfall_rdr = GFALLReader(gfall_fname, energy_tolerance=1e-3)
+    merged_gfall, merged_levels = gfall_rdr.merge_close_energies(gfall)
+    assert_allclose(merged_gfall["energy_upper"], [100.0, 100.0, 100.0016])
+    assert_allclose(merged_levels["energy"], [100.0008])
+    assert_allclose(merged_levels["merged_energy"], [100.0])
+
+
+def test_gfall_reader_energy_tolerance_cache_key(gfall_fname):
+    assert (GFALLReader(gfall_fname, energy_tolerance=1e-3).cache_key !=
+            GFALLReader(gfall_fname).cache_key)
+
+
 @pytest.mark.parametrize("atomic_number, ion_charge, level_index_lower, level_index_upper,"
                          "wavelength, gf",[
     (4, 2, 0, 16, 8.8309, 0.12705741),
@@ -103,6 +263,288 @@ def test_gfall_reader_lines(lines, atomic_number, ion_charge,
     assert_almost_equal(row["gf"], gf)
 
 
+def test_gfall_reader_extract_lines_levels(gfall_rdr, gfall, levels, lines):
+    ion_levels = levels.loc[(4, 2)]
+    ion_levels.index = pd.MultiIndex.from_product(
+        [[4], [2], ion_levels.index], names=levels.index.names)
+    ion_lines = gfall_rdr.extract_lines(gfall, ion_levels)
+    # Missing level indices make the index levels float
+    assert_frame_equal(ion_lines.loc[(4, 2)], lines.loc[(4, 2)], check_index_type=False)
+    other_lines = ion_lines.drop(4, level="atomic_number")
+    assert len(other_lines) > 0
+    assert other_lines.index.get_level_values("level_index_lower").isnull().all()
+    assert other_lines.index.get_level_values("level_index_upper").isnull().all()
+
+
+def test_gfall_reader_iter_chunks(gfall_rdr, gfall):
+    gfall_chunks = pd.concat(list(gfall_rdr.iter_chunks(chunksize=10)))
+    assert_frame_equal(gfall_chunks, gfall)
+
+
+def test_gfall_reader_iter_ions(gfall_rdr, levels, lines):
+    ions = list()
+    for ion, ion_levels, ion_lines in gfall_rdr.iter_ions(chunksize=10):
+        ions.append(ion)
+        ion_level = ["atomic_number", "ion_charge"]
+        assert_frame_equal(
+            ion_levels, levels.xs(ion, level=ion_level, drop_level=False))
+        assert_frame_equal(
+            ion_lines.sort_index(),
+            lines.xs(ion, level=ion_level, drop_level=False).sort_index(), check_like=True)
+    assert ions == [(4, 2), (5, 3), (7, 5)]
+
+
+@pytest.fixture(params=["", ".gz"])
+def gfall_sorted_fname(request, gfall_fname, tmpdir):
+    # The records of the ions are mixed when sorted by wavelength
+    with open(gfall_fname, "rb") as f:
+        records = sorted([record for record in f if record.strip()],
+                         key=lambda record: float(record[:11]))
+    gfall_sorted = str(tmpdir.join("gfall_sorted.dat" + request.param))
+    opener = GFALL_COMPRESSION_OPENERS.get(request.param, open)
+    with opener(gfall_sorted, "wb") as f:
+        f.write(b"".join(records))
+    return gfall_sorted
+
+
+def test_gfall_reader_iter_ions_not_contiguous(gfall_sorted_fname, gfall_fname):
+    gfall_rdr = GFALLReader(gfall_sorted_fname)
+    levels, lines = gfall_rdr.levels, gfall_rdr.lines
+    ion_level = ["atomic_number", "ion_charge"]
+    ions = list()
+    for ion, ion_levels, ion_lines in GFALLReader(gfall_sorted_fname).iter_ions(chunksize=10):
+        ions.append(ion)
+        assert_frame_equal(ion_levels, levels.xs(ion, level=ion_level, drop_level=False))
+        assert_frame_equal(
+            ion_lines.sort_index(),
+            lines.xs(ion, level=ion_level, drop_level=False).sort_index(), check_like=True)
+    assert sorted(ions) == [(4, 2), (5, 3), (7, 5)]
+    assert len(lines) == len(GFALLReader(gfall_fname).lines)
+
+
+def test_gfall_reader_cache(gfall_fname, tmpdir, gfall, levels, lines):
+    cache_dir = str(tmpdir.join("cache"))
+    gfall_rdr = GFALLReader(gfall_fname, cache_dir=cache_dir)
+    assert_frame_equal(gfall_rdr.lines, lines)
+    assert os.listdir(cache_dir) == [os.path.basename(gfall_rdr.cache_fname)]
+    with pd.HDFStore(gfall_rdr.cache_fname, mode="r") as store:
+        assert sorted(store.keys()) == ["/gfall", "/levels", "/lines"]
+
+    cached_rdr = GFALLReader(gfall_fname, cache_dir=cache_dir)
+    cached_rdr.extract_levels = None  # must not be called
+    assert_frame_equal(cached_rdr.gfall, gfall)
+    assert_frame_equal(cached_rdr.levels, levels)
+    assert_frame_equal(cached_rdr.lines, lines)
+
+
+def test_gfall_reader_cache_invalidation(gfall_fname, tmpdir):
+    gfall_copy = tmpdir.join("gfall.dat")
+    with open(gfall_fname) as f:
+        gfall_copy.write(f.read())
+    cache_key = GFALLReader(str(gfall_copy), cache_dir=str(tmpdir)).cache_key
+
+    with open(gfall_fname) as f:
+        gfall_copy.write(f.read() * 2)
+    assert GFALLReader(str(gfall_copy), cache_dir=str(tmpdir)).cache_key != cache_key
+    assert GFALLReader(str(gfall_copy), cache_dir=str(tmpdir),
+                       unique_level_identifier=["energy", "j", "label"]).cache_key != cache_key
+
+
+def test_gfall_reader_build_index(gfall_fname):
+    gfall_rdr = GFALLReader(gfall_fname)
+    index = gfall_rdr.build_index(blocksize=1000)
+    assert index[["atomic_number", "ion_charge"]].values.tolist() == [[4, 2], [5, 3], [7, 5]]
+    assert index["n_records"].tolist() == [29, 8, 24]
+    assert index["first_record"].tolist() == [0, 29, 37]
+    with open(gfall_fname, "rb") as f:
+        f.seek(index.loc[1, "start"])
+        assert f.readline().split()[2] == b"5.03"
+
+
+def test_gfall_reader_read_ions_raw(gfall_fname):
+    gfall_rdr = GFALLReader(gfall_fname)
+    gfall_raw = gfall_rdr.gfall_raw
+    ions_raw = gfall_rdr.read_ions_raw([(7, 5), (4, 2)])
+    assert_frame_equal(
+        ions_raw, gfall_raw.loc[gfall_raw["element_code"].isin([4.02, 7.05])])
+    assert gfall_rdr.index_fname is None
+
+
+@pytest.fixture()
+def gfall_copy_fname(gfall_fname, tmpdir):
+    gfall_copy = tmpdir.join("gfall.dat")
+    with open(gfall_fname) as f:
+        gfall_copy.write(f.read())
+    return str(gfall_copy)
+
+
+def test_gfall_reader_index_cache(gfall_copy_fname, tmpdir):
+    cache_dir = str(tmpdir.join("gfall_cache"))
+    index = GFALLReader(gfall_copy_fname, cache_dir=cache_dir).index
+    assert os.listdir(cache_dir) == [os.path.basename(
+        GFALLReader(gfall_copy_fname, cache_dir=cache_dir).index_fname)]
+    assert sorted(os.listdir(str(tmpdir))) == ["gfall.dat", "gfall_cache"]
+
+    gfall_rdr = GFALLReader(gfall_copy_fname, cache_dir=cache_dir)
+    gfall_rdr.build_index = None  # must not be called
+    assert_frame_equal(gfall_rdr.index, index)
+
+    with open(gfall_copy_fname, "a") as f:
+        f.write(open(gfall_copy_fname).read())
+    os.utime(gfall_copy_fname, (0, 0))
+    assert len(GFALLReader(gfall_copy_fname, cache_dir=cache_dir).index) == 2 * len(index)
+
+
+def test_gfall_reader_columns(gfall_fname, levels, lines):
+    gfall_rdr = GFALLReader(gfall_fname, columns=["wavelength", "loggf", "j_first", "j_second"])
+    assert list(gfall_rdr.gfall_raw.columns) == GFALLReader.gfall_ingest_columns
+    assert_frame_equal(gfall_rdr.levels, levels)
+    assert_frame_equal(gfall_rdr.lines, lines)
+
+
+@pytest.mark.parametrize("n_workers", [2, 5])
+def test_gfall_reader_n_workers(gfall_fname, gfall_raw, gfall, n_workers):
+    gfall_rdr = GFALLReader(gfall_fname, n_workers=n_workers)
+    assert_frame_equal(gfall_rdr.gfall, gfall)
+    assert_frame_equal(gfall_rdr.gfall_raw, gfall_raw)
+
+
+@slow
+def test_gfall_reader_n_workers_benchmark(gfall_fname, tmpdir):
+    with open(gfall_fname) as f:
+        gfall_content = f.read()
+    gfall_big = tmpdir.join("gfall_big.dat")
+    gfall_big.write(gfall_content * 5000)
+
+    gfall = None
+    for n_workers in [1, 2, 4, 8]:
+        gfall_rdr = GFALLReader(str(gfall_big), n_workers=n_workers)
+        start = time.time()
+        gfall_workers = gfall_rdr.gfall
+        print("n_workers={0}: {1:.2f} s".format(n_workers, time.time() - start))
+        if gfall is None:
+            gfall = gfall_workers
+        else:
+            assert_frame_equal(gfall_workers, gfall)
+
+
+def test_gfall_reader_ions(gfall_fname, gfall, levels, lines):
+    gfall_rdr = GFALLReader(gfall_fname, ions=[(7, 5), (4, 2)])
+    ions_gfall = gfall.loc[gfall["atomic_number"] != 5]
+    assert_frame_equal(gfall_rdr.gfall, ions_gfall)
+    assert_frame_equal(gfall_rdr.levels, levels.drop(5, level="atomic_number"))
+    assert_frame_equal(gfall_rdr.lines, lines.drop(5, level="atomic_number"))
+
+
+@pytest.mark.parametrize("n_workers, chunksize, engine", [
+    (None, None, "fwf"),
+    (2, None, "numpy"),
+    (None, 10, "numpy")
+])
+def test_gfall_reader_ions_without_index(gfall_fname, gfall, n_workers, chunksize, engine):
+    gfall_rdr = GFALLReader(gfall_fname, ions=[(5, 3)], n_workers=n_workers)
+    if chunksize is not None:
+        ions_gfall = pd.concat(list(gfall_rdr.iter_chunks(chunksize)))
+    elif engine == "fwf":
+        ions_gfall = gfall_rdr.parse_gfall(gfall_rdr.read_gfall_raw(engine=engine))
+    else:
+        ions_gfall = gfall_rdr.read_gfall_parallel()
+    assert_frame_equal(ions_gfall.reset_index(drop=True),
+                       gfall.loc[gfall["atomic_number"] == 5].reset_index(drop=True))
+
+
+@pytest.fixture(params=[".gz", ".bz2", ".xz"])
+def gfall_compressed_fname(request, gfall_fname, tmpdir):
+    extension = request.param
+    if extension not in GFALL_COMPRESSION_OPENERS:
+        pytest.skip("lzma is not available")
+    gfall_compressed = str(tmpdir.join("gfall.dat" + extension))
+    with open(gfall_fname, "rb") as f:
+        gfall_content = f.read()
+    compressed_file = GFALL_COMPRESSION_OPENERS[extension](gfall_compressed, "wb")
+    compressed_file.write(gfall_content)
+    compressed_file.close()
+    return gfall_compressed
+
+
+@pytest.mark.parametrize("n_workers", [None, 2])
+def test_gfall_reader_compressed(gfall_compressed_fname, tmpdir, gfall, levels, lines, n_workers):
+    gfall_rdr = GFALLReader(gfall_compressed_fname, n_workers=n_workers,
+                            cache_dir=str(tmpdir.join("cache")))
+    assert_frame_equal(gfall_rdr.gfall, gfall)
+    assert_frame_equal(gfall_rdr.levels, levels)
+    assert_frame_equal(gfall_rdr.lines, lines)
+    assert os.path.exists(gfall_rdr.cache_fname)
+
+
+def test_gfall_reader_compressed_ions(gfall_compressed_fname, gfall):
+    gfall_rdr = GFALLReader(gfall_compressed_fname, ions=[(5, 3)])
+    assert_frame_equal(gfall_rdr.gfall, gfall.loc[gfall["atomic_number"] == 5])
+    with pytest.raises(ValueError):
+        gfall_rdr.index
+
+
+def test_gfall_reader_file_object(gfall_fname, gfall, levels):
+    with open(gfall_fname, "rb") as f:
+        gfall_rdr = GFALLReader(f, n_workers=2)
+        assert_frame_equal(gfall_rdr.gfall, gfall)
+    assert_frame_equal(gfall_rdr.levels, levels)
+
+
+@pytest.fixture()
+def gfall_split_fnames(gfall_fname, tmpdir):
+    # Be III and B IV in the first file, B IV and N VI in the second one
+    with open(gfall_fname) as f:
+        gfall_lines = f.readlines()
+    gfall_split = [tmpdir.join("gf0001.dat"), tmpdir.join("gf0002.dat")]
+    gfall_split[0].write("".join(gfall_lines[:39]))
+    gfall_split[1].write("".join(gfall_lines[31:]))
+    return [str(fname) for fname in gfall_split]
+
+
+@pytest.mark.parametrize("n_workers", [None, 2])
+def test_gfall_multi_reader(gfall_split_fnames, gfall, levels, lines, n_workers):
+    gfall_rdr = GFALLMultiReader(gfall_split_fnames, n_workers=n_workers)
+    assert_frame_equal(gfall_rdr.gfall, gfall.reset_index(drop=True))
+    assert_frame_equal(gfall_rdr.levels, levels)
+    assert_frame_equal(gfall_rdr.lines, lines)
+
+
+def test_gfall_multi_reader_glob(gfall_split_fnames, tmpdir, levels):
+    gfall_rdr = GFALLMultiReader(str(tmpdir.join("gf*.dat")))
+    assert gfall_rdr.fnames == gfall_split_fnames
+    assert_frame_equal(gfall_rdr.levels, levels)
+
+
+def test_gfall_multi_reader_conflicting_duplicates(gfall_split_fnames):
+    with open(gfall_split_fnames[1]) as f:
+        gfall_lines = f.readlines()
+    # Change the log(gf) of the first B IV line
+    gfall_lines[0] = gfall_lines[0][:11] + "-9.999" + gfall_lines[0][17:]
+    with open(gfall_split_fnames[1], "w") as f:
+        f.write("".join(gfall_lines))
+    gfall_rdr = GFALLMultiReader(gfall_split_fnames)
+    with pytest.raises(ValueError) as excinfo:
+        gfall_rdr.gfall
+    assert "B 3" in str(excinfo.value)
+
+
+def test_gfall_multi_reader_iter_ions(gfall_split_fnames, levels, lines):
+    gfall_rdr = GFALLMultiReader(gfall_split_fnames)
+    ion_level = ["atomic_number", "ion_charge"]
+    for ion, ion_levels, ion_lines in gfall_rdr.iter_ions():
+        assert_frame_equal(ion_levels, levels.xs(ion, level=ion_level, drop_level=False))
+        assert_frame_equal(ion_lines, lines.xs(ion, level=ion_level, drop_level=False))
+
+
+def test_gfall_ingester_multiple_files(memory_session, gfall_split_fnames, tmpdir, lines):
+    gfall_ingester = GFALLIngester(memory_session, str(tmpdir.join("gf*.dat")))
+    assert isinstance(gfall_ingester.gfall_reader, GFALLMultiReader)
+    gfall_ingester.ingest(levels=True, lines=True)
+    memory_session.commit()
+    assert memory_session.query(Line).count() == len(lines)
+
+
 @pytest.mark.parametrize("atomic_number, ion_charge, level_index, "
                           "exp_energy, exp_j, exp_method", [
     (4, 2, 0, 0.0*u.Unit("cm-1"), 0.0, "meas"),
@@ -179,4 +621,219 @@ def test_gfall_ingester_ingest_lines_wavelength_medium(memory_session, gfall_ing
                     Line.upper_level == upper_level)).one()
     wavelength = line.wavelengths[0]
     assert_quantity_allclose(wavelength.quantity, exp_wavelength)
-    assert wavelength.medium == exp_medium
\ No newline at end of file
+    assert wavelength.medium == exp_medium
+
+def test_gfall_ingester_ingest_chunks(memory_session, gfall_ingester, lines):
+    gfall_ingester.ingest(levels=True, lines=True, chunksize=10)
+    data_source = DataSource.as_unique(memory_session, short_name="ku_latest")
+    ion = Ion.as_unique(memory_session, atomic_number=4, ion_charge=2)
+    level = memory_session.query(Level).\
+        filter(and_(Level.data_source == data_source,
+                    Level.ion == ion,
+                    Level.level_index == 11)).one()
+    assert_almost_equal(level.J, 2.0)
+    exp_lines_count = len(lines.loc[4, 2]) + len(lines.loc[7, 5])
+    assert memory_session.query(Line).\
+        filter(Line.data_source == data_source).count() == exp_lines_count
+
+
+def test_gfall_ingester_ingest_chunks_not_contiguous(memory_session, gfall_sorted_fname, lines):
+    ingester = GFALLIngester(memory_session, gfall_sorted_fname)
+    ingester.ingest(levels=True, lines=True, chunksize=10)
+    assert memory_session.query(Line).\
+        filter(Line.data_source == ingester.data_source).count() == len(ingester.gfall_reader.lines)
+
+
+def ingested_gfall_rows(session, data_source):
+    """ Return the ingested levels and lines of a data source identified by level indices """
+    q_levels = session.query(Level.atomic_number, Level.ion_charge, Level.level_index,
+                             Level.J, Level.L, Level.configuration, Level.term,
+                             Level.spin_multiplicity, Level.parity,
+                             LevelEnergy._value, LevelEnergy.type, LevelEnergy.method,
+                             LevelEnergy.uncert, LevelEnergy.data_source_id).\
+        join(Level.energies).\
+        filter(Level.data_source == data_source).\
+        order_by(Level.atomic_number, Level.ion_charge, Level.level_index)
+
+    lower, upper = aliased(Level), aliased(Level)
+    wavelength, gf_value = aliased(LineWavelength), aliased(LineGFValue)
+    q_lines = session.query(lower.atomic_number, lower.ion_charge, lower.level_index,
+                            upper.level_index, Line.type,
+                            wavelength._value, wavelength.medium, wavelength.type,
+                            wavelength.data_source_id,
+                            gf_value._value, gf_value.type, gf_value.data_source_id).\
+        join(lower, Line.lower_level_id == lower.level_id).\
+        join(upper, Line.upper_level_id == upper.level_id).\
+        join(wavelength, Line.wavelengths).\
+        join(gf_value, Line.gf_values).\
+        filter(Line.data_source == data_source).\
+        order_by(lower.atomic_number, lower.ion_charge, lower.level_index, upper.level_index)
+
+    # Replace the ids of the data sources that differ between the ingests
+    levels = [row[:-1] + (row[-1] == data_source.data_source_id,) for row in q_levels]
+    lines = [row[:8] + (row[8] == data_source.data_source_id,) +
+             row[9:11] + (row[11] == data_source.data_source_id,) for row in q_lines]
+    return levels, lines
+
+
+@pytest.mark.parametrize("chunksize", [None, 10])
+def test_gfall_ingester_bulk_equals_orm(memory_session, gfall_fname, chunksize):
+    orm_ingester = GFALLIngester(memory_session, gfall_fname, ds_short_name="ku_orm")
+    orm_ingester.ingest(levels=True, lines=True, chunksize=chunksize, bulk=False)
+    bulk_ingester = GFALLIngester(memory_session, gfall_fname, ds_short_name="ku_bulk")
+    bulk_ingester.ingest(levels=True, lines=True, chunksize=chunksize, bulk=True)
+
+    orm_levels, orm_lines = ingested_gfall_rows(memory_session, orm_ingester.data_source)
+    bulk_levels, bulk_lines = ingested_gfall_rows(memory_session, bulk_ingester.data_source)
+    assert len(orm_levels) > 0 and len(orm_lines) > 0
+    assert bulk_levels == orm_levels
+    assert bulk_lines == orm_lines
+
+
+@pytest.mark.parametrize("bulk", [True, False])
+def test_gfall_ingester_ingest_lines_missing_levels(memory_session, gfall_ingester, levels, bulk):
+    # Drop two levels of Be III
+    gfall_ingester.ingest_levels(levels.drop([(4, 2, 0), (4, 2, 6)]), bulk=bulk)
+    with pytest.raises(IngesterError) as excinfo:
+        gfall_ingester.ingest_lines(bulk=bulk)
+    assert "Be 2: 0, 6" in str(excinfo.value)
+
+
+@pytest.mark.parametrize("batch_size", [None, 7])
+def test_gfall_ingester_batch_size(memory_session, gfall_fname, batch_size):
+    ingester = GFALLIngester(memory_session, gfall_fname, ds_short_name="ku_orm",
+                             batch_size=batch_size, commit=True)
+    ingester.ingest(levels=True, lines=True, bulk=False)
+    # The ingested objects have been released
+    assert not any(isinstance(obj, (Level, LevelEnergy, Line)) for obj in memory_session)
+
+    bulk_ingester = GFALLIngester(memory_session, gfall_fname, ds_short_name="ku_bulk")
+    bulk_ingester.ingest(levels=True, lines=True, bulk=True)
+    assert ingested_gfall_rows(memory_session, ingester.data_source) == \
+        ingested_gfall_rows(memory_session, bulk_ingester.data_source)
+
+
+@pytest.mark.parametrize("bulk", [True, False])
+def test_gfall_ingester_pipeline(memory_session, gfall_fname, bulk):
+    pipeline_ingester = GFALLIngester(memory_session, gfall_fname, ds_short_name="ku_pipeline")
+    pipeline_ingester.ingest(levels=True, lines=True, chunksize=10, bulk=bulk, pipeline=True)
+    ingester = GFALLIngester(memory_session, gfall_fname, ds_short_name="ku_latest")
+    ingester.ingest(levels=True, lines=True)
+
+    pipeline_levels, pipeline_lines = ingested_gfall_rows(memory_session, pipeline_ingester.data_source)
+    assert len(pipeline_lines) > 0
+    assert (pipeline_levels, pipeline_lines) == ingested_gfall_rows(memory_session, ingester.data_source)
+
+
+@pytest.mark.parametrize("pipeline", [False, True])
+def test_gfall_ingester_resume(memory_session, gfall_fname, pipeline):
+    ingester = GFALLIngester(memory_session, gfall_fname, ds_short_name="ku_resumed")
+    ingest_lines = ingester.ingest_lines
+    n_calls = [0]
+
+    def failing_ingest_lines(lines, bulk=True):
+        # Fail after the lines of the first ion have been written
+        ingest_lines(lines, bulk=bulk)
+        n_calls[0] += 1
+        if n_calls[0] == 2:
+            raise MemoryError
+
+    ingester.ingest_lines = failing_ingest_lines
+    with pytest.raises(MemoryError):
+        ingester.ingest(levels=True, lines=True, resume=True, pipeline=pipeline)
+    # Resume as in a new session
+    memory_session.rollback()
+    memory_session.info.pop('unique_cache')
+    # Only the first ion has been committed
+    assert memory_session.query(IngestCheckpoint).count() == 2
+
+    resumed_ingester = GFALLIngester(memory_session, gfall_fname, ds_short_name="ku_resumed")
+    resumed_ingester.ingest(levels=True, lines=True, resume=True, pipeline=pipeline)
+    ingester = GFALLIngester(memory_session, gfall_fname, ds_short_name="ku_latest")
+    ingester.ingest(levels=True, lines=True)
+
+    n_ions = len(ingester.gfall_reader.levels.reset_index()[["atomic_number", "ion_charge"]].drop_duplicates())
+    assert memory_session.query(IngestCheckpoint).count() == 2 * n_ions
+    assert ingested_gfall_rows(memory_session, resumed_ingester.data_source) == \
+        ingested_gfall_rows(memory_session, ingester.data_source)
+
+
+@pytest.mark.parametrize("pipeline, resume", [(True, False), (False, True)])
+def test_gfall_ingester_not_contiguous(memory_session, gfall_sorted_fname, pipeline, resume):
+    sorted_ingester = GFALLIngester(memory_session, gfall_sorted_fname, ds_short_name="ku_sorted")
+    sorted_ingester.ingest(levels=True, lines=True, pipeline=pipeline, resume=resume)
+    ingester = GFALLIngester(memory_session, gfall_sorted_fname, ds_short_name="ku_latest")
+    ingester.ingest(levels=True, lines=True)
+
+    sorted_levels, sorted_lines = ingested_gfall_rows(memory_session, sorted_ingester.data_source)
+    assert len(sorted_lines) == len(ingester.gfall_reader.lines)
+    assert (sorted_levels, sorted_lines) == ingested_gfall_rows(memory_session, ingester.data_source)
+
+
+def test_gfall_ingester_resume_without_checkpoints(memory_session, gfall_fname):
+    ingester = GFALLIngester(memory_session, gfall_fname)
+    ingester.ingest(levels=True, lines=False)
+    with pytest.raises(IngesterError):
+        ingester.ingest(levels=True, lines=True, resume=True)
+
+
+@pytest.fixture()
+def gfall_release_fname(gfall_fname, tmpdir):
+    # A new release of the file without N 5 and with another gf value of a B 3 line
+    gfall_release = tmpdir.mkdir("release").join("gfall.dat")
+    with open(gfall_fname) as f:
+        records = [record for record in f if record[18:24] != "  7.05"]
+    b3_record = [i for i, record in enumerate(records) if record[18:24] == "  5.03"][0]
+    records[b3_record] = records[b3_record][:11] + " -0.500" + records[b3_record][18:]
+    gfall_release.write("".join(records))
+    return str(gfall_release)
+
+
+@pytest.mark.parametrize("bulk", [True, False])
+def test_gfall_ingester_update(memory_session, gfall_fname, gfall_release_fname, bulk, capsys):
+    ingester = GFALLIngester(memory_session, gfall_fname, ds_short_name="ku_updated")
+    ingester.ingest(levels=True, lines=True, bulk=bulk, update=True)
+    assert "Added: 3 ions (Be 2, B 3, N 5)" in capsys.readouterr()[0]
+
+    updated_ingester = GFALLIngester(memory_session, gfall_release_fname, ds_short_name="ku_updated")
+    updated_ingester.ingest(levels=True, lines=True, bulk=bulk, update=True)
+    summary = capsys.readouterr()[0]
+    assert "Added: 0 ions" in summary
+    assert "Modified: 1 ions (B 3)" in summary
+    assert "Removed: 1 ions (N 5)" in summary
+    assert "Unchanged: 1 ions" in summary
+
+    release_ingester = GFALLIngester(memory_session, gfall_release_fname, ds_short_name="ku_release")
+    release_ingester.ingest(levels=True, lines=True)
+    assert ingested_gfall_rows(memory_session, updated_ingester.data_source) == \
+        ingested_gfall_rows(memory_session, release_ingester.data_source)
+    # No quantities of the replaced levels and lines are left
+    for model in [LevelEnergy, LineWavelength, LineGFValue]:
+        assert memory_session.query(model).filter(model.data_source == updated_ingester.data_source).count() == \
+            memory_session.query(model).filter(model.data_source == release_ingester.data_source).count()
+    assert memory_session.query(IngestCheckpoint).count() == 4
+
+
+def test_gfall_ingester_update_levels_without_lines(memory_session, gfall_fname, tmpdir):
+    # A new release with another energy of a Be 2 level
+    gfall_release = tmpdir.join("gfall.dat")
+    with open(gfall_fname) as f:
+        records = f.readlines()
+    be2_record = [i for i, record in enumerate(records) if record[18:24] == "  4.02"][0]
+    records[be2_record] = records[be2_record][:24] + "{0:12.3f}".format(
+        float(records[be2_record][24:36]) + 10) + records[be2_record][36:]
+    gfall_release.write("".join(records))
+
+    ingester = GFALLIngester(memory_session, gfall_fname, ds_short_name="ku_updated")
+    ingester.ingest(levels=True, lines=True, update=True)
+    n_lines = memory_session.query(Line).count()
+
+    updated_ingester = GFALLIngester(memory_session, str(gfall_release), ds_short_name="ku_updated")
+    with pytest.raises(IngesterError) as excinfo:
+        updated_ingester.ingest(levels=True, lines=False, update=True)
+    assert "Be 2" in str(excinfo.value)
+    memory_session.rollback()
+    assert memory_session.query(Line).count() == n_lines
+
+    updated_ingester.ingest(levels=True, lines=True, update=True)
+    assert memory_session.query(Line).count() == n_lines
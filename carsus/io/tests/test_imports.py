@@ -0,0 +1,27 @@
+import os
+import subprocess
+import sys
+
+
+IMPORT_TIME_SCRIPT = """
+import sys
+import time
+
+start = time.time()
+import carsus.io.chianti_, carsus.io.kurucz, carsus.io.nist, carsus.io.output, carsus.io.zeta
+print(time.time() - start)
+print(' '.join(name for name in sys.modules if name.split('.')[0] in {0}))
+"""
+
+DEFERRED_MODULES = ['requests', 'bs4', 'ChiantiPy', 'chianti']
+
+
+def test_import_time():
+    # Without $XUVTOP, as the CHIANTI masterlist must not be read on import
+    env = dict(os.environ)
+    env.pop('XUVTOP', None)
+    output = subprocess.check_output([sys.executable, '-c', IMPORT_TIME_SCRIPT.format(DEFERRED_MODULES)],
+                                     env=env)
+    import_time, imported_modules = output.decode().splitlines()[-2:]
+    print('Importing carsus.io took {0:.3f} s'.format(float(import_time)))
+    assert imported_modules.split() == []
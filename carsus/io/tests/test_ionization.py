@@ -4,7 +4,7 @@ import pandas as pd
 from pandas.util.testing import assert_series_equal
 from numpy.testing import assert_almost_equal
 from sqlalchemy.orm import joinedload
-from carsus.model import Ion
+from carsus.model import Ion, IonizationEnergy
 from carsus.io.nist.ionization import  NISTIonizationEnergiesParser, NISTIonizationEnergiesIngester
 
 
@@ -106,13 +106,14 @@ def test_prepare_ground_levels(ground_levels, expected_series_ground_levels):
     assert_series_equal(series, expected_series_ground_levels)
 
 
+@pytest.mark.parametrize("bulk", [True, False])
 @pytest.mark.parametrize("index, value, uncert",
                          zip(expected_indices,
                              expected_ioniz_energy_value[1],
                              expected_ioniz_energy_uncert[1]))
-def test_ingest_ionization_energies(index, value, uncert, memory_session, ioniz_energies_ingester):
+def test_ingest_ionization_energies(index, value, uncert, bulk, memory_session, ioniz_energies_ingester):
 
-    ioniz_energies_ingester.ingest(ionization_energies=True, ground_levels=False)
+    ioniz_energies_ingester.ingest(ionization_energies=True, ground_levels=False, bulk=bulk)
 
     atomic_number, ion_charge = index
     ion = memory_session.query(Ion).options(joinedload('ionization_energies')).get((atomic_number, ion_charge))
@@ -122,9 +123,28 @@ def test_ingest_ionization_energies(index, value, uncert, memory_session, ioniz_
     assert_almost_equal(ion_energy.uncert, uncert)
 
 
+@pytest.mark.parametrize("bulk", [True, False])
+def test_ingest_ionization_energies_replaces(bulk, memory_session, ioniz_energies_ingester, ioniz_energies):
+    other_ingester = NISTIonizationEnergiesIngester(memory_session, ds_short_name="other")
+    other_ingester.ingest_ionization_energies(ioniz_energies, bulk=bulk)
+    ioniz_energies_ingester.ingest_ionization_energies(ioniz_energies, bulk=bulk)
+    memory_session.flush()
+    # Ingesting again replaces the energies from the data source
+    ioniz_energies_ingester.ingest_ionization_energies(
+        ioniz_energies.assign(ionization_energy_value=ioniz_energies["ionization_energy_value"] + 1), bulk=bulk)
+    memory_session.flush()
+
+    for data_source, offset in [(ioniz_energies_ingester.data_source, 1), (other_ingester.data_source, 0)]:
+        energies = memory_session.query(IonizationEnergy).filter(IonizationEnergy.data_source == data_source).\
+            order_by(IonizationEnergy.atomic_number, IonizationEnergy.ion_charge).all()
+        assert_almost_equal([energy.quantity.value for energy in energies],
+                            ioniz_energies["ionization_energy_value"].sort_index().values + offset)
+
+
+@pytest.mark.parametrize("bulk", [True, False])
 @pytest.mark.parametrize("index, exp_j", zip(expected_indices, expected_j[1]))
-def test_ingest_ground_levels(index, exp_j, memory_session, ioniz_energies_ingester):
-    ioniz_energies_ingester.ingest(ionization_energies=True, ground_levels=True)
+def test_ingest_ground_levels(index, exp_j, bulk, memory_session, ioniz_energies_ingester):
+    ioniz_energies_ingester.ingest(ionization_energies=True, ground_levels=True, bulk=bulk)
 
     atomic_number, ion_charge = index
     ion = memory_session.query(Ion).options(joinedload('levels')).get((atomic_number, ion_charge))
@@ -95,9 +95,11 @@ def test_weightscomp_pyparser_prepare_atomic(atomic, expected):
     assert_frame_equal(atomic, expected, check_names=False)
 
 
+@pytest.mark.parametrize("bulk", [True, False])
 @pytest.mark.parametrize("atomic_number, value, uncert", expected_tuples)
-def test_weightscomp_ingest_nonexisting_atomic_weights(atomic_number, value, uncert, weightscomp_ingester, memory_session):
-    weightscomp_ingester.ingest()
+def test_weightscomp_ingest_nonexisting_atomic_weights(atomic_number, value, uncert, bulk,
+                                                       weightscomp_ingester, memory_session):
+    weightscomp_ingester.ingest(bulk=bulk)
     atom_weight = memory_session.query(AtomWeight).\
         filter(AtomWeight.atomic_number==atomic_number).\
         filter(AtomWeight.data_source==weightscomp_ingester.data_source).one()
@@ -0,0 +1,28 @@
+import pytest
+
+from carsus.io.zeta import KnoxLongZetaIngester
+from carsus.model import Zeta, Temperature
+
+
+def ingested_zeta_rows(session, data_source):
+    return session.query(Zeta.atomic_number, Zeta.ion_charge, Temperature.value, Zeta.zeta).\
+        join(Zeta.temp).\
+        filter(Zeta.data_source == data_source).\
+        order_by(Zeta.atomic_number, Zeta.ion_charge, Temperature.value).all()
+
+
+@pytest.mark.parametrize("bulk_first", [False, True])
+def test_zeta_ingest_bulk_equals_orm(memory_session, zeta_fname, bulk_first):
+    orm_ingester = KnoxLongZetaIngester(memory_session, zeta_fname, ds_name="knox_long_orm")
+    bulk_ingester = KnoxLongZetaIngester(memory_session, zeta_fname, ds_name="knox_long_bulk")
+    ingests = [(orm_ingester, False), (bulk_ingester, True)]
+    if bulk_first:
+        ingests.reverse()
+    for ingester, bulk in ingests:
+        ingester.ingest(bulk=bulk)
+
+    orm_rows = ingested_zeta_rows(memory_session, orm_ingester.data_source)
+    assert len(orm_rows) > 0
+    assert ingested_zeta_rows(memory_session, bulk_ingester.data_source) == orm_rows
+    # The temperatures are shared
+    assert memory_session.query(Temperature).count() == len(set(row[2] for row in orm_rows))
@@ -1,6 +1,15 @@
+import re
+import numpy as np
+import pandas as pd
+
 from pyparsing import ParseResults
 from carsus.util import convert_atomic_number2symbol
 
+FORTRAN_FIELD_PATTERN = re.compile(r'^(\d*)([FEIXA])(\d*)(?:\.\d+)?$')
+
+# Exact powers of ten for assembling fixed-point numbers from their digits
+POWERS_OF_TEN = np.array([float(10**i) for i in range(16)])
+
 def to_flat_dict(tokens, parent_key='', sep='_'):
     """
     Creates a flattened dictionary from the named values in tokens.
@@ -74,3 +83,145 @@ def convert_species_tuple2chianti_str(species):
     atomic_number, ion_number = species
     chianti_ion_name = convert_atomic_number2symbol(atomic_number).lower() + '_' + str(ion_number + 1)
     return chianti_ion_name
+
+
+def parse_fortran_format(fortran_format):
+    """
+    Parse a Fortran FORMAT specification into fixed-width fields
+
+    Parameters
+    ----------
+    fortran_format: str
+        e.g. 'F11.4,F7.3,1X,A10,2I5'. E fields are converted like F fields
+
+    Returns
+    -------
+        list of tuples
+            (type, width) for every field, e.g. ('F', 11). Repeat counts
+            are expanded so that each field corresponds to one column
+    """
+    fields = list()
+    for item in fortran_format.split(','):
+        match = FORTRAN_FIELD_PATTERN.match(item.strip())
+        if match is None:
+            raise ValueError('Unsupported Fortran format item {0}'.format(item))
+        repeat, field_type, width = match.groups()
+        if field_type == 'X':
+            # For blanks the count is the width: 1X is one blank character
+            fields.append((field_type, int(repeat or 1)))
+        else:
+            fields += [(field_type, int(width))] * int(repeat or 1)
+    return fields
+
+
+def read_fixed_width_records(data, fields, names, usecols=None):
+    """
+    Parse fixed-width records column-wise with NumPy
+
+    Records are loaded into a two-dimensional byte array and every field is
+    converted as a whole column instead of line by line. Blank lines are
+    skipped and short lines are padded with blanks.
+
+    Parameters
+    ----------
+    data: bytes or list of bytes
+        the content of a fixed-width file or its lines
+    fields: list of tuples
+        (type, width) of the fields as returned by `parse_fortran_format`
+    names: list of str
+        column names, one for every field
+    usecols: list of str
+        names of the columns to convert, the other fields are skipped
+        (default: None, convert all)
+
+    Returns
+    -------
+        pandas.DataFrame
+            F and E fields are converted to floats, I fields to integers (floats
+            if any value is missing), A fields to stripped strings; blank
+            values become NaN. X fields are not converted and are all NaN.
+    """
+    record_width = sum(width for _, width in fields)
+    lines = data.splitlines() if isinstance(data, bytes) else data
+    records = np.array(lines, dtype='S{0}'.format(record_width))
+    buf = records.view(np.uint8).reshape(len(records), record_width)
+    # numpy pads short records with null bytes
+    buf[buf == 0] = ord(' ')
+    # Transpose, so that each character position is contiguous over records
+    buf = np.ascontiguousarray(buf[~(buf == ord(' ')).all(axis=1)].T)
+
+    if usecols is not None:
+        names = [name if name in usecols else None for name in names]
+
+    columns = dict()
+    start = 0
+    for (field_type, width), name in zip(fields, names):
+        stop = start + width
+        if name is None:
+            pass
+        elif field_type == 'X':
+            columns[name] = np.full(buf.shape[1], np.nan)
+        else:
+            columns[name] = convert_fortran_field(buf[start:stop], field_type)
+        start = stop
+
+    return pd.DataFrame(columns, columns=[name for name in names if name is not None])
+
+
+def convert_fortran_field(field, field_type):
+    """
+    Convert a (width x records) byte array holding one field to a column
+
+    Numbers in fixed-point notation are assembled from their digits with array
+    arithmetic; the result is identical to `float(str)` because both the
+    digits and the power of ten are exact. Values in any other notation fall
+    back to NumPy's string conversion.
+    """
+    width, n_records = field.shape
+    blank = (field == ord(' ')).all(axis=0)
+
+    if field_type == 'A':
+        values = np.ascontiguousarray(field.T).view('S{0}'.format(width)).ravel()
+        # Strings repeat a lot, so only the distinct ones are stripped
+        unique_values, inverse = np.unique(values, return_inverse=True)
+        unique_values = np.char.strip(unique_values.astype(str)).astype(object)
+        values = unique_values[inverse]
+        values[blank] = np.nan
+        return values
+
+    if blank.all():
+        return np.full(n_records, np.nan)
+
+    if field_type == 'E':
+        # Exponents are not assembled from digits
+        values = np.ascontiguousarray(field.T).view('S{0}'.format(width)).ravel()
+        return np.where(blank, b'nan', values).astype(np.float64)
+
+    digits = field - ord('0')  # non-digits wrap around to values >= 10
+    is_digit = digits < 10
+    is_point = field == ord('.')
+    is_minus = field == ord('-')
+    negative = is_minus.any(axis=0)
+    irregular = ~(is_digit | is_point | is_minus |
+                  (field == ord('+')) | (field == ord(' '))).all(axis=0)
+    # More digits than a double holds exactly are left to the string conversion
+    irregular |= is_digit.sum(axis=0) > 15
+
+    mantissa = np.zeros(n_records, dtype=np.int64)
+    n_decimals = np.zeros(n_records, dtype=np.int64)
+    after_point = np.zeros(n_records, dtype=bool)
+    for i in range(width):
+        mantissa = np.where(is_digit[i], mantissa * 10 + digits[i], mantissa)
+        n_decimals += is_digit[i] & after_point
+        after_point |= is_point[i]
+
+    if field_type == 'I' and not blank.any() and not irregular.any():
+        return np.where(negative, -mantissa, mantissa)
+
+    converted = mantissa / POWERS_OF_TEN[np.minimum(n_decimals, 15)]
+    converted[negative] *= -1
+    if irregular.any():
+        values = np.ascontiguousarray(field[:, irregular].T).view('S{0}'.format(width)).ravel()
+        converted[irregular] = values.astype(np.float64)
+    converted[blank] = np.nan
+    return converted
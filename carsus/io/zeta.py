@@ -1,5 +1,6 @@
 import numpy as np
 import pandas as pd
+from carsus.io.base import BulkInserter
 from carsus.model import (
         Zeta,
         Temperature,
@@ -19,7 +20,7 @@ class KnoxLongZetaIngester(object):
         if self.data_source.data_source_id is None:
             self.session.flush()
 
-    def ingest_zeta_values(self):
+    def ingest_zeta_values(self, bulk=False):
         t_values = np.arange(2000, 42000, 2000)
 
         names = ['atomic_number', 'ion_charge']
@@ -35,6 +36,25 @@ class KnoxLongZetaIngester(object):
                     ['atomic_number', 'ion_charge']).T
                 )
 
+        if bulk:
+            temp_ids = list()
+            for i in zeta_df.index:
+                T = Temperature.as_unique(self.session, value=int(i))
+                if T.id is None:
+                    self.session.flush()
+                temp_ids.append(T.id)
+
+            # One row for every temperature and ion
+            n_temps, n_ions = zeta_df.shape
+            BulkInserter(self.session).insert(Zeta, {
+                "atomic_number": np.tile(zeta_df.columns.get_level_values(0), n_temps),
+                "ion_charge": np.tile(zeta_df.columns.get_level_values(1), n_temps),
+                "temp_id": np.repeat(temp_ids, n_ions),
+                "zeta": zeta_df.values.ravel(),
+                "data_source_id": self.data_source.data_source_id
+            })
+            return
+
         data = list()
         for i, s in zeta_df.iterrows():
             T = Temperature.as_unique(self.session, value=int(i))
@@ -52,6 +72,6 @@ class KnoxLongZetaIngester(object):
                             )
                     )
 
-    def ingest(self):
-        self.ingest_zeta_values()
+    def ingest(self, bulk=False):
+        self.ingest_zeta_values(bulk=bulk)
         self.session.commit()
@@ -44,7 +44,7 @@ Classes
 from sqlalchemy.orm import relationship
 from sqlalchemy.ext.hybrid import hybrid_property
 from sqlalchemy import Column, Integer, String, Float, ForeignKey,\
-    ForeignKeyConstraint, and_, cast
+    ForeignKeyConstraint, UniqueConstraint, and_, cast
 from sqlalchemy.ext.associationproxy import association_proxy
 from astropy import units as u
 from carsus.model.meta import Base, UniqueMixin, QuantityMixin
@@ -81,6 +81,8 @@ __all__ = [
         'ECollisionTempStrength',
 
         'DataSource',
+
+        'IngestCheckpoint',
         ]
 
 
@@ -514,3 +516,38 @@ class Temperature(UniqueMixin, Base):
 
     def __repr__(self):
         return "<Temperature {0} K>".format(self.value)
+
+
+class IngestCheckpoint(Base):
+    '''
+    Records that one stage ("levels", "lines", "collisions") of an ion has been
+    completely ingested from a data source. The ingesters commit the checkpoint
+    together with the data of the ion, so that an interrupted ingest can be resumed
+    and a new release of the data source can be ingested incrementally.
+    '''
+    __tablename__ = 'ingest_checkpoint'
+
+    id = Column(Integer, primary_key=True)
+
+    # Ion FKC
+    atomic_number = Column(Integer, nullable=False)
+    ion_charge = Column(Integer, nullable=False)
+
+    #: Ingested data of the ion, e.g. "levels"
+    stage = Column(String(20), nullable=False)
+    #: MD5 hash of the ingested data, to detect changes in a new release of the data source
+    content_hash = Column(String(32))
+
+    data_source_id = Column(
+            Integer,
+            ForeignKey('data_source.data_source_id'),
+            nullable=False)
+
+    data_source = relationship("DataSource", backref="ingest_checkpoints")
+
+    __table_args__ = (ForeignKeyConstraint(['atomic_number', 'ion_charge'],
+                                           ['ion.atomic_number', 'ion.ion_charge']),
+                      UniqueConstraint('data_source_id', 'atomic_number', 'ion_charge', 'stage'))
+
+    def __repr__(self):
+        return "<Checkpoint {0} Z={1} +{2}>".format(self.stage, self.atomic_number, self.ion_charge)
@@ -1,4 +1,8 @@
+import pickle
 import pytest
+import numpy as np
+
+from collections import OrderedDict
 
 from carsus.util.helpers import convert_camel2snake, \
     convert_atomic_number2symbol, convert_symbol2atomic_number
@@ -30,4 +34,15 @@ def test_convert_atomic_number2symbol(atomic_number, expected_symbol):
     ("Uuo", 118)
 ])
 def test_convert_symbol2atomic_number(symbol, expected_atomic_number):
-    assert convert_symbol2atomic_number(symbol) == expected_atomic_number
\ No newline at end of file
+    assert convert_symbol2atomic_number(symbol) == expected_atomic_number
+
+def test_atomic_symbols_constants():
+    from carsus.util.helpers import ATOMIC_SYMBOLS_DATA, SYMBOL2ATOMIC_NUMBER, ATOMIC_NUMBER2SYMBOL
+    assert SYMBOL2ATOMIC_NUMBER["Si"] == 14
+    assert ATOMIC_NUMBER2SYMBOL[14] == "Si"
+    assert list(ATOMIC_NUMBER2SYMBOL.keys())[:2] == [1, 2]
+    assert "Zn" in SYMBOL2ATOMIC_NUMBER and len(SYMBOL2ATOMIC_NUMBER) == len(ATOMIC_SYMBOLS_DATA)
+    assert ATOMIC_SYMBOLS_DATA["symbol"][0] == "H"
+    assert isinstance(SYMBOL2ATOMIC_NUMBER, OrderedDict) and isinstance(ATOMIC_NUMBER2SYMBOL, OrderedDict)
+    assert isinstance(ATOMIC_SYMBOLS_DATA, np.recarray)
+    assert pickle.loads(pickle.dumps(SYMBOL2ATOMIC_NUMBER)) == SYMBOL2ATOMIC_NUMBER